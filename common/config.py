@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 import logging
+import time
 import traceback
 
 import simplejson as json
@@ -7,18 +8,70 @@ from django.http import HttpResponse
 
 from common.utils.permission import superuser_required
 from sql.models import Config
+from sql.utils.tasks import add_archive_schedule, add_slow_query_collect_schedule, add_diagnostic_sample_schedule, \
+    add_dashboard_rollup_schedule, add_query_log_flush_schedule, del_schedule, task_info
 from django.db import transaction
 from django.core.cache import cache
 
 logger = logging.getLogger('default')
 
 
+# 进程内配置快照(版本号, 配置, 上次校验时间)，按间隔比对缓存中的版本号判断是否过期
+# 快照不直接交给实例，每个实例持有副本，避免修改sys_config影响其他请求
+CONFIG_VERSION_KEY = 'sys_config_version'
+CONFIG_CHECK_INTERVAL = 1
+_snapshot = (None, None, 0.0)
+
+
+def _config_version():
+    """获取缓存中的配置版本号，不存在时初始化"""
+    try:
+        version = cache.get(CONFIG_VERSION_KEY)
+        if version is None:
+            cache.add(CONFIG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+            version = cache.get(CONFIG_VERSION_KEY)
+        return version
+    except Exception as m:
+        logger.error(f"读取配置版本号失败:{m}{traceback.format_exc()}")
+        return None
+
+
+def _bump_config_version():
+    """配置变更后递增版本号，使其他进程的配置快照失效"""
+    try:
+        return cache.incr(CONFIG_VERSION_KEY)
+    except ValueError:
+        # 版本号被清除时使用当前时间重新初始化，保证大于已有快照的版本号
+        cache.set(CONFIG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        return cache.get(CONFIG_VERSION_KEY)
+    except Exception as m:
+        logger.error(f"更新配置版本号失败:{m}{traceback.format_exc()}")
+        return None
+
+
 class SysConfig(object):
     def __init__(self):
         self.sys_config = {}
         self.get_all_config()
 
     def get_all_config(self):
+        global _snapshot
+        version, config, checked_at = _snapshot
+        now = time.monotonic()
+        # 校验间隔内直接使用进程内快照
+        if config is not None and now - checked_at < CONFIG_CHECK_INTERVAL:
+            self.sys_config = dict(config)
+            return
+        current_version = _config_version()
+        if config is not None and current_version is not None and current_version == version:
+            _snapshot = (version, config, now)
+            self.sys_config = dict(config)
+            return
+        self.load_config(current_version)
+
+    def load_config(self, version=None):
+        """从缓存或数据库加载全部配置，并更新进程内快照"""
+        global _snapshot
         # 优先获取缓存数据
         try:
             sys_config = cache.get('sys_config')
@@ -50,6 +103,8 @@ class SysConfig(object):
                     cache.set('sys_config', self.sys_config, timeout=None)
                 except Exception as m:
                     logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        # 版本号不可用时不使用快照，保持每次读取缓存的行为
+        _snapshot = (version, dict(self.sys_config), time.monotonic()) if version is not None else (None, None, 0.0)
 
     def get(self, key, default_value=None):
         value = self.sys_config.get(key, default_value)
@@ -72,7 +127,7 @@ class SysConfig(object):
         except Exception as m:
             logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
         finally:
-            self.get_all_config()
+            self.load_config(_bump_config_version())
 
     def replace(self, configs):
         result = {'status': 0, 'msg': 'ok', 'data': []}
@@ -88,7 +143,7 @@ class SysConfig(object):
             result['status'] = 1
             result['msg'] = str(e)
         finally:
-            self.get_all_config()
+            self.load_config(_bump_config_version())
         return result
 
     def purge(self):
@@ -100,6 +155,7 @@ class SysConfig(object):
             logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
         with transaction.atomic():
             Config.objects.all().delete()
+        self.load_config(_bump_config_version())
 
 
 # 修改系统配置
@@ -108,5 +164,33 @@ def change_config(request):
     configs = request.POST.get('configs')
     archer_config = SysConfig()
     result = archer_config.replace(configs)
+    # 报表汇总任务由升级脚本添加，保存配置时补充添加
+    if not task_info('报表数据汇总'):
+        add_dashboard_rollup_schedule()
+    # 配置了保留天数时添加归档定时任务
+    if any(archer_config.get(key) for key in ('archive_query_log_days', 'archive_workflow_days',
+                                              'archive_slow_query_days')):
+        if not task_info('历史数据归档'):
+            add_archive_schedule()
+    else:
+        del_schedule('历史数据归档')
+    # 开启慢日志采集时添加采集定时任务
+    if archer_config.get('slow_query_collect'):
+        if not task_info('慢日志采集'):
+            add_slow_query_collect_schedule()
+    else:
+        del_schedule('慢日志采集')
+    # 开启查询日志异步写入时添加批量入库定时任务
+    if archer_config.get('query_log_async'):
+        if not task_info('查询日志批量写入'):
+            add_query_log_flush_schedule()
+    else:
+        del_schedule('查询日志批量写入')
+    # 开启问题诊断采样时添加采样定时任务
+    if archer_config.get('diagnostic_sample'):
+        if not task_info('问题诊断采样'):
+            add_diagnostic_sample_schedule()
+    else:
+        del_schedule('问题诊断采样')
     # 返回结果
     return HttpResponse(json.dumps(result), content_type='application/json')
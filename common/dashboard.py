@@ -1,11 +1,17 @@
 # -*- coding: UTF-8 -*-
+import hmac
+
 from django.contrib.auth.decorators import permission_required
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
 from django.shortcuts import render
 from django.views.decorators.cache import cache_page
 
 from sql.models import SqlWorkflow, QueryPrivilegesApply, Users, Instance
 
-from common.utils.chart_dao import ChartDao
+from common.config import SysConfig
+from common.utils.chart_dao import RollupChartDao
+from common.utils.metrics import exposition
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from pyecharts.globals import CurrentConfig
@@ -19,8 +25,8 @@ CurrentConfig.ONLINE_HOST = '/static/echarts/'
 @permission_required('sql.menu_dashboard', raise_exception=True)
 def pyecharts(request):
     """dashboard view"""
-    # 工单数量统计
-    chart_dao = ChartDao()
+    # 工单数量统计，报表数据读取汇总表
+    chart_dao = RollupChartDao()
     data = chart_dao.workflow_by_date(30)
     today = date.today()
     one_month_before = today - relativedelta(days=+30)
@@ -131,3 +137,12 @@ def pyecharts(request):
     }
 
     return render(request, "dashboard.html", {"chart": chart, "count_stats": dashboard_count_stats})
+
+
+def metrics(request):
+    """Prometheus监控指标，超级管理员或携带Authorization: Bearer {metrics_token}时可访问"""
+    token = SysConfig().get('metrics_token')
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (request.user.is_superuser or (token and hmac.compare_digest(authorization, f'Bearer {token}'))):
+        raise PermissionDenied
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,15 +1,28 @@
 import json
 import smtplib
+from decimal import Decimal
 from unittest.mock import patch, ANY
 import datetime
+import simplejson
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.db.models import Count
+from django.core.cache import cache
+from django.test import Client, TestCase, RequestFactory
+from django_q.models import Schedule
 
-from common.config import SysConfig
+from common.config import SysConfig, CONFIG_VERSION_KEY
 from common.utils.sendmsg import MsgSender
 from sql.engines import EngineBase
-from sql.models import Instance, SqlWorkflow, SqlWorkflowContent, QueryLog, ResourceGroup
-from common.utils.chart_dao import ChartDao
+from sql.models import Config, Instance, SqlWorkflow, SqlWorkflowContent, QueryLog, ResourceGroup, WorkflowStatsDaily, \
+    QueryLogStatsDaily, SlowQueryHistory, SlowQueryStatsDaily
+from common.utils.chart_dao import ChartDao, RollupChartDao
+from common.utils.chart_rollup import refresh_rollup, add_slow_query_stats
+from common.utils.pagination import search_filter, approximate_count, keyset_page, keyset_page_by, keyset_cursor
+from common.utils.json_serializer import dumps, encode_rows
+from common.utils.columnar_response import query_response, dictionary_encode, COLUMNAR_JSON
+from common.utils.metrics import Histogram, QUERY_STAGE_SECONDS, observe_query_spans
+from common.utils.timer import SpanRecorder
+from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime
 from common.auth import init_user
 
 User = get_user_model()
@@ -64,6 +77,34 @@ class ConfigOpsTests(TestCase):
         archer_config.set('other_config', 'testvalue3')
         self.assertEqual(archer_config.sys_config['other_config'], 'testvalue3')
 
+    def test_snapshot(self):
+        """校验间隔内读取进程内快照，不访问缓存"""
+        archer_config = SysConfig()
+        archer_config.set('snapshot_config', 'v1')
+        with patch('common.config.cache') as _cache:
+            self.assertEqual(SysConfig().get('snapshot_config'), 'v1')
+            _cache.get.assert_not_called()
+
+    @patch('common.config.CONFIG_CHECK_INTERVAL', 0)
+    def test_snapshot_version(self):
+        """版本号未变化时继续使用快照，其他进程修改配置递增版本号后重新加载"""
+        archer_config = SysConfig()
+        archer_config.set('snapshot_config', 'v1')
+        Config.objects.filter(item='snapshot_config').update(value='v2')
+        cache.delete('sys_config')
+        self.assertEqual(SysConfig().get('snapshot_config'), 'v1')
+        cache.incr(CONFIG_VERSION_KEY)
+        self.assertEqual(SysConfig().get('snapshot_config'), 'v2')
+
+    def test_snapshot_copy(self):
+        """修改实例的配置不影响快照和其他实例"""
+        archer_config = SysConfig()
+        archer_config.set('snapshot_config', 'v1')
+        archer_config.sys_config['snapshot_config'] = 'changed'
+        config = SysConfig()
+        config.sys_config['snapshot_config'] = 'changed'
+        self.assertEqual(SysConfig().get('snapshot_config'), 'v1')
+
 
 class SendMessageTest(TestCase):
     """发送消息测试"""
@@ -470,6 +511,289 @@ class ChartTest(TestCase):
         c.force_login(self.superuser1)
         r = c.get('/dashboard/')
         self.assertEqual(r.status_code, 200)
+        # 访问页面不添加定时任务，由升级脚本或保存配置时添加
+        self.assertFalse(Schedule.objects.filter(name='报表数据汇总').exists())
+        c.post('/config/change/', data={'configs': json.dumps([])})
+        self.assertTrue(Schedule.objects.filter(name='报表数据汇总').exists())
+        Schedule.objects.filter(name='报表数据汇总').delete()
+
+    def test_change_config_query_log_schedule(self):
+        """开启、关闭查询日志异步写入时添加、删除批量入库定时任务"""
+        c = Client()
+        c.force_login(self.superuser1)
+        c.post('/config/change/', data={'configs': json.dumps([{'key': 'query_log_async', 'value': 'true'}])})
+        self.assertTrue(Schedule.objects.filter(name='查询日志批量写入').exists())
+        c.post('/config/change/', data={'configs': json.dumps([{'key': 'query_log_async', 'value': 'false'}])})
+        self.assertFalse(Schedule.objects.filter(name='查询日志批量写入').exists())
+        Schedule.objects.all().delete()
+
+
+class ChartRollupTest(TestCase):
+    """报表汇总测试"""
+
+    def setUp(self):
+        self.now = datetime.datetime.now()
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        for i in range(5):
+            wf = SqlWorkflow.objects.create(
+                workflow_name=f'some_name{i}',
+                group_id=1 if i < 2 else 2,
+                group_name='g1' if i < 2 else 'g2',
+                engineer='some_user',
+                engineer_display='用户1' if i < 2 else '用户2',
+                audit_auth_groups='some_group',
+                status='workflow_finish',
+                is_backup=True,
+                instance=self.ins,
+                db_names='some_db',
+                syntax_type=1 if i < 2 else 2)
+            SqlWorkflow.objects.filter(pk=wf.pk).update(create_time=self.now - datetime.timedelta(days=1 + i % 2))
+        for i in range(3):
+            QueryLog.objects.create(instance_name='some_ins', db_name=f'db{i % 2}', sqllog='select 1',
+                                    effect_row=10, username='some_user', user_display='用户1')
+
+    def tearDown(self):
+        SqlWorkflow.objects.all().delete()
+        QueryLog.objects.all().delete()
+        WorkflowStatsDaily.objects.all().delete()
+        QueryLogStatsDaily.objects.all().delete()
+        self.ins.delete()
+
+    def test_refresh_rollup(self):
+        """汇总结果与明细一致，并且重复执行结果不变"""
+        refresh_rollup()
+        refresh_rollup()
+        dao = RollupChartDao()
+        self.assertEqual(dao.syntax_type()['rows'], (('DDL', 2), ('DML', 3)))
+        self.assertEqual(dao.workflow_by_group(30)['rows'], (('g2', 3), ('g1', 2)))
+        self.assertEqual(dao.workflow_by_user(30)['rows'], (('用户2', 3), ('用户1', 2)))
+        self.assertEqual(sum(row[1] for row in dao.workflow_by_date(30)['rows']), 5)
+        today = self.now.strftime('%Y-%m-%d')
+        self.assertEqual(dao.querylog_count_by_date(30)['rows'], ((today, 3),))
+        self.assertEqual(dao.querylog_effect_row_by_date(30)['rows'], ((today, 30),))
+        self.assertEqual(dao.querylog_effect_row_by_db(30)['rows'], (('db0', 20), ('db1', 10)))
+
+    def test_refresh_rollup_backfill(self):
+        """汇总表只有当天数据时(如慢日志采集先写入)回填源表的历史日期"""
+        WorkflowStatsDaily.objects.create(stat_date=datetime.date.today(), group_id=1, group_name='g1',
+                                          engineer_display='用户1', syntax_type=1, workflow_cnt=1)
+        refresh_rollup()
+        self.assertEqual(sum(row[1] for row in RollupChartDao().workflow_by_date(30)['rows']), 5)
+        self.assertEqual(WorkflowStatsDaily.objects.filter(stat_date=datetime.date.today()).count(), 0)
+
+    def test_rollup_empty_fallback(self):
+        """汇总表为空时按明细统计"""
+        with patch.object(ChartDao, 'workflow_by_group', return_value='detail') as _detail:
+            self.assertEqual(RollupChartDao().workflow_by_group(30), 'detail')
+            refresh_rollup()
+            self.assertEqual(RollupChartDao().workflow_by_group(30)['rows'], (('g2', 3), ('g1', 2)))
+        _detail.assert_called_once_with(30)
+
+    def test_refresh_rollup_incremental(self):
+        """增量汇总只重算最后一天"""
+        refresh_rollup()
+        QueryLog.objects.create(instance_name='some_ins', db_name='db0', sqllog='select 1',
+                                effect_row=5, username='some_user', user_display='用户1')
+        refresh_rollup()
+        self.assertEqual(RollupChartDao().querylog_effect_row_by_user(30)['rows'], (('用户1', 35),))
+
+    def test_add_slow_query_stats(self):
+        """写入慢日志明细时累加到日汇总"""
+        ts = datetime.datetime(2019, 1, 1, 20, 0)
+
+        def history(checksum, ts_min, ts_cnt):
+            return SlowQueryHistory(checksum_id=checksum, hostname_max='some_host:3306', db_max='some_db',
+                                    ts_min=ts_min, ts_max=ts_min, ts_cnt=ts_cnt, query_time_sum=ts_cnt,
+                                    query_time_max=1, rows_examined_sum=ts_cnt * 10)
+
+        add_slow_query_stats([history('c1', ts, 2), history('c1', ts, 3), history('c2', ts, 1)])
+        add_slow_query_stats([history('c1', ts, 4), history('c1', ts - datetime.timedelta(hours=10), 1)])
+        rows = SlowQueryStatsDaily.objects.order_by('checksum', 'stat_date').values_list(
+            'checksum', 'stat_date', 'ts_cnt', 'rows_examined_sum', 'query_time_max')
+        # ts_min为UTC时间，按东八区日期汇总
+        self.assertEqual(list(rows), [('c1', datetime.date(2019, 1, 1), 1, 10, 1),
+                                      ('c1', datetime.date(2019, 1, 2), 9, 90, 1),
+                                      ('c2', datetime.date(2019, 1, 2), 1, 10, 1)])
+
+
+class PaginationTest(TestCase):
+    """列表检索与游标分页测试"""
+
+    def setUp(self):
+        for i in range(5):
+            QueryLog.objects.create(instance_name='some_ins', db_name='some_db', sqllog=f'select {i}', effect_row=1,
+                                    username='some_user', user_display='用户1', alias='some_alias' if i < 2 else '')
+
+    def tearDown(self):
+        QueryLog.objects.all().delete()
+
+    def test_search_filter(self):
+        """非MySQL时使用icontains匹配多个字段"""
+        self.assertEqual(search_filter(QueryLog.objects.all(), ['sqllog', 'alias'], 'some_alias').count(), 2)
+        self.assertEqual(search_filter(QueryLog.objects.all(), ['sqllog', 'alias'], 'select 3').count(), 1)
+        self.assertEqual(search_filter(QueryLog.objects.all(), ['sqllog'], '').count(), 5)
+
+    def test_approximate_count(self):
+        """未达到阈值返回精确总数"""
+        self.assertEqual(approximate_count(QueryLog.objects.all()), 5)
+        self.assertEqual(approximate_count(QueryLog.objects.all(), threshold=3), 3)
+
+    @patch('common.utils.pagination.connection')
+    def test_approximate_count_grouped(self, _connection):
+        """分组汇总的结果集不使用EXPLAIN估算"""
+        _connection.vendor = 'mysql'
+        grouped = QueryLog.objects.values('username').annotate(cnt=Count('id'))
+        self.assertEqual(approximate_count(grouped, threshold=1), 1)
+        _connection.cursor.assert_not_called()
+
+    def test_keyset_page(self):
+        """游标分页与offset分页结果一致"""
+        ids = list(QueryLog.objects.order_by('-id').values_list('id', flat=True))
+        first = list(keyset_page(QueryLog.objects.all(), 'id', 0, 2).values_list('id', flat=True))
+        self.assertEqual(first, ids[:2])
+        second = list(keyset_page(QueryLog.objects.all(), 'id', 2, 2, cursor=first[-1]).values_list('id', flat=True))
+        self.assertEqual(second, ids[2:4])
+        self.assertEqual(list(keyset_page(QueryLog.objects.all(), 'id', 2, 2).values_list('id', flat=True)), ids[2:4])
+
+    def test_keyset_page_by(self):
+        """按不唯一的汇总值排序时使用第二个字段区分"""
+        rows = QueryLog.objects.values('effect_row', 'id')
+        ids = list(QueryLog.objects.order_by('-effect_row', 'id').values_list('id', flat=True))
+        pages, cursor = [], None
+        for offset in range(0, 6, 2):
+            page = list(keyset_page_by(rows, 'effect_row', 'id', offset, 2, cursor))
+            cursor = keyset_cursor(page, 'effect_row', 'id')
+            pages += [row['id'] for row in page]
+        self.assertEqual(pages, ids)
+        self.assertIsNone(keyset_cursor([], 'effect_row', 'id'))
+
+
+
+class JsonSerializerTest(TestCase):
+    """按列转换的结果集序列化测试"""
+
+    def setUp(self):
+        now = datetime.datetime(2020, 1, 2, 3, 4, 5, 678)
+        self.rows = [
+            (1, now, datetime.date(2020, 1, 2), Decimal('1.5'), datetime.timedelta(seconds=90), 2 ** 60, 'a'),
+            (2, now.replace(year=999), datetime.date(999, 1, 2), None, None, 3, Decimal('2.5')),
+            (None, now.replace(tzinfo=datetime.timezone.utc), None, Decimal('0'), datetime.timedelta(0), None, 'c'),
+        ]
+
+    def test_encode_rows(self):
+        """转换结果与ExtendJSONEncoder、ExtendJSONEncoderFTime一致"""
+        for ftime, encoder in ((False, ExtendJSONEncoder), (True, ExtendJSONEncoderFTime)):
+            expected = json.loads(simplejson.dumps(self.rows, cls=encoder, bigint_as_string=True))
+            self.assertEqual(json.loads(dumps(encode_rows(self.rows, ftime=ftime), ftime=ftime)), expected)
+
+    def test_encode_rows_without_default(self):
+        """同类型的列不经过JSONEncoder.default"""
+        with patch.object(ExtendJSONEncoderFTime, 'default') as _default:
+            dumps({'rows': encode_rows(self.rows[:1], ftime=True)}, ftime=True)
+        _default.assert_not_called()
+
+    def test_binary(self):
+        """合法的utf-8按文本返回，否则返回十六进制"""
+        rows = [(b'\xe4\xb8\xad', bytearray(b'\xff\x00'))]
+        self.assertEqual(json.loads(dumps(encode_rows(rows))), [['中', '0xff00']])
+
+    def test_not_table_rows(self):
+        self.assertEqual(encode_rows(['value']), ['value'])
+        self.assertEqual(encode_rows([]), [])
+
+
+
+class ColumnarResponseTest(TestCase):
+    """按Accept返回按列格式的查询结果"""
+
+    def setUp(self):
+        self.rows = [(i, 'status%d' % (i % 3), datetime.date(2020, 1, 1)) for i in range(1000)]
+        self.factory = RequestFactory()
+
+    def result(self, status=0):
+        return {'status': status, 'msg': 'ok', 'data': {'full_sql': 'select 1', 'rows': list(self.rows),
+                                                       'column_list': ['id', 'status', 'day']}}
+
+    def test_dictionary_encode(self):
+        self.assertEqual(dictionary_encode(['a', None, 'a', 'b']),
+                         {'dictionary': ['a', 'b'], 'indices': [0, None, 0, 1]})
+        self.assertIsNone(dictionary_encode(['a', 'b', 'c']))
+        self.assertIsNone(dictionary_encode([1, 1, 1]))
+
+    def test_columnar_json(self):
+        """按列返回，重复文本使用字典编码，传输量小于按行返回"""
+        request = self.factory.post('/query/', HTTP_ACCEPT=COLUMNAR_JSON)
+        response = query_response(request, self.result())
+        self.assertEqual(response['Content-Type'], COLUMNAR_JSON)
+        self.assertEqual(response['Vary'], 'Accept')
+        data = json.loads(response.content)['data']
+        self.assertNotIn('rows', data)
+        self.assertEqual(data['columns'][0], list(range(1000)))
+        self.assertEqual(data['columns'][1]['dictionary'], ['status0', 'status1', 'status2'])
+        self.assertEqual(data['columns'][2]['dictionary'], ['2020-01-01'])
+        json_response = query_response(self.factory.post('/query/'), self.result())
+        self.assertEqual(json_response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(json_response.content)['data']['rows'][1], [1, 'status1', '2020-01-01'])
+        self.assertLess(len(response.content), len(json_response.content) / 2)
+
+    def test_error_json(self):
+        """出错时始终返回json"""
+        request = self.factory.post('/query/', HTTP_ACCEPT=COLUMNAR_JSON)
+        response = query_response(request, self.result(status=1))
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+
+
+class MetricsTest(TestCase):
+    """阶段耗时与Prometheus指标测试"""
+
+    def setUp(self):
+        self.superuser = User.objects.create(username='super_metrics', is_superuser=True)
+
+    def tearDown(self):
+        self.superuser.delete()
+        QUERY_STAGE_SECONDS.clear()
+        SysConfig().set('metrics_token', '')
+
+    def test_span_recorder(self):
+        """同名阶段累加，Server-Timing按记录顺序输出"""
+        spans = SpanRecorder()
+        for _ in range(2):
+            with spans.span('query'):
+                pass
+        with spans.span('encode'):
+            pass
+        timings = spans.timings()
+        self.assertEqual(list(timings), ['query', 'encode', 'total'])
+        self.assertGreaterEqual(timings['total'], timings['query'])
+        self.assertRegex(spans.server_timing(), r'^query;dur=[\d.]+, encode;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'test', ('instance', 'stage'), buckets=(0.1, 1))
+        histogram.observe(('ins"1', 'query'), 0.5)
+        histogram.observe(('ins"1', 'query'), 2)
+        lines = histogram.collect()
+        self.assertIn('test_seconds_bucket{instance="ins\\"1",stage="query",le="0.1"} 0', lines)
+        self.assertIn('test_seconds_bucket{instance="ins\\"1",stage="query",le="1"} 1', lines)
+        self.assertIn('test_seconds_bucket{instance="ins\\"1",stage="query",le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_count{instance="ins\\"1",stage="query"} 2', lines)
+
+    def test_metrics_view(self):
+        """超级管理员或携带metrics_token访问"""
+        spans = SpanRecorder()
+        with spans.span('query'):
+            pass
+        observe_query_spans('some_ins', spans)
+        c = Client()
+        self.assertEqual(c.get('/metrics/').status_code, 403)
+        SysConfig().set('metrics_token', 'some_token')
+        self.assertEqual(c.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        r = c.get('/metrics/', HTTP_AUTHORIZATION='Bearer some_token')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('archery_query_stage_seconds_count{instance="some_ins",stage="query"} 1', r.content.decode())
+        c.force_login(self.superuser)
+        self.assertEqual(c.get('/metrics/').status_code, 200)
 
 
 class AuthTest(TestCase):
@@ -1,7 +1,10 @@
 # -*- coding: UTF-8 -*-
 
-from datetime import timedelta
+from datetime import timedelta, date
 from django.db import connection
+from django.db.models import Sum, Max, Case, When, Value, CharField
+
+from sql.models import WorkflowStatsDaily, QueryLogStatsDaily, SlowQueryStatsDaily
 
 
 class ChartDao(object):
@@ -148,3 +151,114 @@ from mysql_slow_query_review_history
 where checksum = '{checksum}'
 group by date(date_add(ts_min, interval 8 HOUR));"""
         return self.__query(sql)
+
+
+class RollupChartDao(ChartDao):
+    """
+    读取报表汇总表的ChartDao，与ChartDao返回格式一致，查询耗时与历史数据量无关
+    汇总表为空时(安装或升级后汇总任务尚未执行)使用ChartDao按明细统计
+    """
+
+    def __init__(self):
+        self.__ready = {}
+
+    def __rolled_up(self, model):
+        if model not in self.__ready:
+            self.__ready[model] = model.objects.exists()
+        return self.__ready[model]
+
+    @staticmethod
+    def __result(column_list, rows):
+        return {
+            'column_list': column_list,
+            'rows': tuple(tuple(row) for row in rows)
+        }
+
+    @staticmethod
+    def __since(cycle):
+        return date.today() - timedelta(days=cycle)
+
+    # 语法类型
+    def syntax_type(self):
+        if not self.__rolled_up(WorkflowStatsDaily):
+            return super().syntax_type()
+        rows = WorkflowStatsDaily.objects.annotate(
+            syntax=Case(When(syntax_type=1, then=Value('DDL')),
+                        When(syntax_type=2, then=Value('DML')),
+                        default=Value('其他'),
+                        output_field=CharField())
+        ).values('syntax').annotate(cnt=Sum('workflow_cnt')).order_by('syntax').values_list('syntax', 'cnt')
+        return self.__result(['syntax_type', 'count(*)'], rows)
+
+    # 工单数量统计
+    def workflow_by_date(self, cycle):
+        if not self.__rolled_up(WorkflowStatsDaily):
+            return super().workflow_by_date(cycle)
+        rows = WorkflowStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'stat_date').annotate(cnt=Sum('workflow_cnt')).order_by('stat_date').values_list('stat_date', 'cnt')
+        return self.__result(['stat_date', 'count(*)'], [(d.strftime('%Y-%m-%d'), cnt) for d, cnt in rows])
+
+    # 工单按组统计
+    def workflow_by_group(self, cycle):
+        if not self.__rolled_up(WorkflowStatsDaily):
+            return super().workflow_by_group(cycle)
+        rows = WorkflowStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'group_id').annotate(name=Max('group_name'), cnt=Sum('workflow_cnt')).order_by(
+            '-cnt').values_list('name', 'cnt')
+        return self.__result(['group_name', 'count(*)'], rows)
+
+    def workflow_by_user(self, cycle):
+        """工单按人统计"""
+        if not self.__rolled_up(WorkflowStatsDaily):
+            return super().workflow_by_user(cycle)
+        rows = WorkflowStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'engineer_display').annotate(cnt=Sum('workflow_cnt')).order_by('-cnt').values_list(
+            'engineer_display', 'cnt')
+        return self.__result(['engineer_display', 'count(*)'], rows)
+
+    # SQL查询统计(每日检索行数)
+    def querylog_effect_row_by_date(self, cycle):
+        if not self.__rolled_up(QueryLogStatsDaily):
+            return super().querylog_effect_row_by_date(cycle)
+        rows = QueryLogStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'stat_date').annotate(effect_row=Sum('effect_row_sum')).order_by('-effect_row').values_list(
+            'stat_date', 'effect_row')
+        return self.__result(['stat_date', 'sum(effect_row)'], [(d.strftime('%Y-%m-%d'), n) for d, n in rows])
+
+    # SQL查询统计(每日检索次数)
+    def querylog_count_by_date(self, cycle):
+        if not self.__rolled_up(QueryLogStatsDaily):
+            return super().querylog_count_by_date(cycle)
+        rows = QueryLogStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'stat_date').annotate(cnt=Sum('query_cnt')).order_by('-cnt').values_list('stat_date', 'cnt')
+        return self.__result(['stat_date', 'count(*)'], [(d.strftime('%Y-%m-%d'), n) for d, n in rows])
+
+    # SQL查询统计(用户检索行数)
+    def querylog_effect_row_by_user(self, cycle):
+        if not self.__rolled_up(QueryLogStatsDaily):
+            return super().querylog_effect_row_by_user(cycle)
+        rows = QueryLogStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'user_display').annotate(effect_row=Sum('effect_row_sum')).order_by('-effect_row').values_list(
+            'user_display', 'effect_row')[:10]
+        return self.__result(['user_display', 'sum(effect_row)'], rows)
+
+    # SQL查询统计(DB检索行数)
+    def querylog_effect_row_by_db(self, cycle):
+        if not self.__rolled_up(QueryLogStatsDaily):
+            return super().querylog_effect_row_by_db(cycle)
+        rows = QueryLogStatsDaily.objects.filter(stat_date__gte=self.__since(cycle)).values(
+            'db_name').annotate(effect_row=Sum('effect_row_sum')).order_by('-effect_row').values_list(
+            'db_name', 'effect_row')[:10]
+        return self.__result(['db_name', 'sum(effect_row)'], rows)
+
+    # 慢日志历史趋势图(按次数)
+    def slow_query_review_history_by_cnt(self, checksum):
+        rows = SlowQueryStatsDaily.objects.filter(checksum=checksum).values('stat_date').annotate(
+            cnt=Sum('ts_cnt')).order_by('stat_date').values_list('cnt', 'stat_date')
+        return self.__result(['sum(ts_cnt)', 'stat_date'], rows)
+
+    # 慢日志历史趋势图(按时长)
+    def slow_query_review_history_by_pct_95_time(self, checksum):
+        rows = SlowQueryStatsDaily.objects.filter(checksum=checksum).values('stat_date').annotate(
+            pct_95=Max('query_time_pct_95')).order_by('stat_date').values_list('pct_95', 'stat_date')
+        return self.__result(['query_time_pct_95', 'stat_date'], [(round(p, 6), d) for p, d in rows])
@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 -*-
+"""
+报表汇总表维护，由django-q定时任务增量调用，dashboard及慢日志趋势图直接读取汇总表
+"""
+import datetime
+import logging
+
+from django.db import transaction
+from django.db.models import Count, Sum, Max, Min
+
+from sql.models import SqlWorkflow, QueryLog, SlowQueryHistory, WorkflowStatsDaily, QueryLogStatsDaily, \
+    SlowQueryStatsDaily
+
+logger = logging.getLogger('default')
+
+# pt-query-digest写入的ts_min为UTC时间，按东八区日期汇总
+SLOW_QUERY_TS_OFFSET = datetime.timedelta(hours=8)
+
+
+def _day_range(stat_date, offset=datetime.timedelta(0)):
+    """返回统计日期对应的[begin, end)时间范围，使用范围条件以便利用时间字段索引"""
+    begin = datetime.datetime.combine(stat_date, datetime.time.min) - offset
+    return begin, begin + datetime.timedelta(days=1)
+
+
+def rollup_workflow(stat_date):
+    """汇总指定日期的SQL上线工单"""
+    begin, end = _day_range(stat_date)
+    rows = SqlWorkflow.objects.filter(create_time__gte=begin, create_time__lt=end).values(
+        'group_id', 'group_name', 'engineer_display', 'syntax_type').annotate(workflow_cnt=Count('id'))
+    with transaction.atomic():
+        WorkflowStatsDaily.objects.filter(stat_date=stat_date).delete()
+        WorkflowStatsDaily.objects.bulk_create([WorkflowStatsDaily(stat_date=stat_date, **row) for row in rows])
+
+
+def rollup_query_log(stat_date):
+    """汇总指定日期的查询日志"""
+    begin, end = _day_range(stat_date)
+    rows = QueryLog.objects.filter(create_time__gte=begin, create_time__lt=end).values(
+        'user_display', 'db_name').annotate(query_cnt=Count('id'), effect_row_sum=Sum('effect_row'))
+    with transaction.atomic():
+        QueryLogStatsDaily.objects.filter(stat_date=stat_date).delete()
+        QueryLogStatsDaily.objects.bulk_create([QueryLogStatsDaily(stat_date=stat_date, **row) for row in rows])
+
+
+def rollup_slow_query(stat_date):
+    """汇总指定日期的慢日志明细"""
+    begin, end = _day_range(stat_date, SLOW_QUERY_TS_OFFSET)
+    rows = SlowQueryHistory.objects.filter(ts_min__gte=begin, ts_min__lt=end).values(
+        'checksum', 'hostname_max', 'db_max').annotate(
+        last_ts=Max('ts_max'),
+        ts_cnt=Sum('ts_cnt'),
+        query_time_sum=Sum('query_time_sum'),
+        query_time_max=Max('query_time_max'),
+        query_time_pct_95=Max('query_time_pct_95'),
+        lock_time_sum=Sum('lock_time_sum'),
+        rows_examined_sum=Sum('rows_examined_sum'),
+        rows_sent_sum=Sum('rows_sent_sum'))
+    stats = [SlowQueryStatsDaily(stat_date=stat_date,
+                                 checksum=row['checksum'],
+                                 hostname_max=row['hostname_max'],
+                                 db_max=row['db_max'],
+                                 ts_max=row['last_ts'],
+                                 ts_cnt=row['ts_cnt'] or 0,
+                                 query_time_sum=row['query_time_sum'] or 0,
+                                 query_time_max=row['query_time_max'] or 0,
+                                 query_time_pct_95=row['query_time_pct_95'] or 0,
+                                 lock_time_sum=row['lock_time_sum'] or 0,
+                                 rows_examined_sum=row['rows_examined_sum'] or 0,
+                                 rows_sent_sum=row['rows_sent_sum'] or 0) for row in rows]
+    with transaction.atomic():
+        SlowQueryStatsDaily.objects.filter(stat_date=stat_date).delete()
+        SlowQueryStatsDaily.objects.bulk_create(stats)
+
+
+def add_slow_query_stats(histories):
+    """
+    写入慢日志明细时同步累加日汇总，定时汇总仍会按明细重算，用于覆盖其他方式写入的明细
+    :param histories: 新写入的SlowQueryHistory列表
+    :return:
+    """
+    stats = {}
+    for history in histories:
+        stat_date = (history.ts_min + SLOW_QUERY_TS_OFFSET).date()
+        key = (history.checksum_id, history.hostname_max, history.db_max, stat_date)
+        stat = stats.setdefault(key, SlowQueryStatsDaily(checksum=history.checksum_id,
+                                                         hostname_max=history.hostname_max,
+                                                         db_max=history.db_max,
+                                                         stat_date=stat_date))
+        _merge_slow_query_stat(stat, history)
+    if not stats:
+        return
+    with transaction.atomic():
+        exists = SlowQueryStatsDaily.objects.select_for_update().filter(
+            checksum__in={key[0] for key in stats},
+            hostname_max__in={key[1] for key in stats},
+            stat_date__in={key[3] for key in stats})
+        merged = []
+        for stat in exists:
+            key = (stat.checksum, stat.hostname_max, stat.db_max, stat.stat_date)
+            if key in stats:
+                _merge_slow_query_stat(stat, stats.pop(key))
+                merged.append(stat)
+        SlowQueryStatsDaily.objects.filter(id__in=[stat.id for stat in merged]).delete()
+        for stat in merged:
+            stat.id = None
+        SlowQueryStatsDaily.objects.bulk_create(merged + list(stats.values()))
+
+
+def _merge_slow_query_stat(stat, other):
+    """将明细或汇总累加到汇总行"""
+    stat.ts_max = max(filter(None, [stat.ts_max, other.ts_max]), default=None)
+    for field in ('ts_cnt', 'query_time_sum', 'lock_time_sum', 'rows_examined_sum', 'rows_sent_sum'):
+        setattr(stat, field, (getattr(stat, field) or 0) + (getattr(other, field) or 0))
+    for field in ('query_time_max', 'query_time_pct_95'):
+        setattr(stat, field, max(getattr(stat, field) or 0, getattr(other, field) or 0))
+
+
+def _start_date(stats_model, source_first, overlap=0):
+    """
+    获取增量汇总的起始日期，汇总表最早的日期晚于源表时(如慢日志采集先写入了当天汇总)从源表最早的日期回填
+    :param stats_model: 汇总表
+    :param source_first: 源表最早的时间，源表为空时为None
+    :param overlap: 额外重算的天数，用于覆盖延迟写入的数据
+    :return:
+    """
+    dates = stats_model.objects.aggregate(first=Min('stat_date'), last=Max('stat_date'))
+    if source_first and (dates['first'] is None or dates['first'] > source_first.date()):
+        return source_first.date()
+    if dates['last']:
+        return dates['last'] - datetime.timedelta(days=overlap)
+    return None
+
+
+def refresh_rollup():
+    """增量刷新所有报表汇总表，从汇总表最后一天开始重算到今天，汇总表缺少历史数据时回填"""
+    today = datetime.date.today()
+    first_workflow = SqlWorkflow.objects.aggregate(first=Min('create_time'))['first']
+    first_query_log = QueryLog.objects.aggregate(first=Min('create_time'))['first']
+    try:
+        with transaction.atomic():
+            first_slow_query = SlowQueryHistory.objects.aggregate(first=Min('ts_min'))['first']
+        first_slow_query = first_slow_query + SLOW_QUERY_TS_OFFSET if first_slow_query else None
+    except Exception as e:
+        # 未部署慢日志采集表时跳过
+        logger.warning(f'慢日志明细表读取失败，跳过慢日志汇总，错误信息：{e}')
+        first_slow_query = None
+    jobs = [(rollup_workflow, _start_date(WorkflowStatsDaily, first_workflow)),
+            (rollup_query_log, _start_date(QueryLogStatsDaily, first_query_log)),
+            (rollup_slow_query, _start_date(SlowQueryStatsDaily, first_slow_query, overlap=1))]
+    for func, start_date in jobs:
+        if start_date is None:
+            continue
+        stat_date = start_date
+        while stat_date <= today:
+            func(stat_date)
+            stat_date += datetime.timedelta(days=1)
+        logger.debug(f'报表汇总{func.__name__}完成，汇总日期：{start_date}~{today}')
@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+"""
+查询结果按Accept返回按列格式，减少宽结果集的传输量和前端解析时间
+application/vnd.archery.columnar+json: 按列的json，重复较多的文本列使用字典编码
+application/vnd.apache.arrow.stream: Arrow IPC流，需安装pyarrow，其他字段写入schema元数据
+"""
+from django.http import HttpResponse
+
+from common.utils.json_serializer import dumps, encode_columns, encode_rows, is_table_rows
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+JSON = 'application/json'
+COLUMNAR_JSON = 'application/vnd.archery.columnar+json'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+# 不同值的数量不超过行数的一半时使用字典编码
+DICTIONARY_RATIO = 0.5
+
+
+def negotiate(request):
+    """按Accept选择返回格式，未安装pyarrow时不返回Arrow"""
+    accept = request.META.get('HTTP_ACCEPT', '')
+    if ARROW_STREAM in accept and pyarrow:
+        return ARROW_STREAM
+    if COLUMNAR_JSON in accept:
+        return COLUMNAR_JSON
+    return JSON
+
+
+def dictionary_encode(column):
+    """
+    文本列字典编码
+    :return: {'dictionary': 不重复的值, 'indices': 每行值在dictionary中的下标，空值为None}，不适合编码时返回None
+    """
+    dictionary = {}
+    for value in column:
+        if value is None:
+            continue
+        if value.__class__ is not str:
+            return None
+        dictionary.setdefault(value, len(dictionary))
+    if not dictionary or len(dictionary) > len(column) * DICTIONARY_RATIO:
+        return None
+    return {'dictionary': list(dictionary), 'indices': [None if value is None else dictionary[value]
+                                                        for value in column]}
+
+
+def columnar_json(data):
+    """rows替换为按列的columns"""
+    columns = encode_columns(data.pop('rows'), len(data['column_list']), ftime=True)
+    data['columns'] = [dictionary_encode(column) or list(column) for column in columns]
+    return data
+
+
+def _arrow_array(column):
+    try:
+        array = pyarrow.array(list(column))
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        # 类型不一致的列按文本返回
+        array = pyarrow.array([None if value is None else str(value) for value in column], pyarrow.string())
+    if pyarrow.types.is_string(array.type) and dictionary_encode(column):
+        array = array.dictionary_encode()
+    return array
+
+
+def arrow_stream(data):
+    """结果集转为Arrow IPC流，除rows外的字段以json写入schema元数据archery"""
+    rows = data.pop('rows')
+    column_list = data['column_list']
+    arrays = [_arrow_array(column) for column in encode_columns(rows, len(column_list), ftime=True)]
+    schema = pyarrow.schema([pyarrow.field(name, array.type) for name, array in zip(column_list, arrays)],
+                            metadata={'archery': dumps(data, ftime=True)})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+    return sink.getvalue().to_pybytes()
+
+
+def query_response(request, result):
+    """
+    返回查询结果，出错或无结果集时始终返回json
+    :param result: {'status': 0, 'msg': 'ok', 'data': ResultSet.__dict__}
+    """
+    data = result.get('data') or {}
+    columnar = result.get('status') == 0 and data.get('column_list') and (
+            not data.get('rows') or is_table_rows(data['rows']))
+    content_type = negotiate(request) if columnar else JSON
+    if content_type == ARROW_STREAM:
+        response = HttpResponse(arrow_stream(data), content_type=ARROW_STREAM)
+    else:
+        if content_type == COLUMNAR_JSON:
+            columnar_json(data)
+        elif data.get('rows'):
+            data['rows'] = encode_rows(data['rows'], ftime=True)
+        response = HttpResponse(dumps(result, ftime=True), content_type=content_type)
+    response['Vary'] = 'Accept'
+    return response
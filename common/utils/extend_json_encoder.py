@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 import simplejson as json
 
+from collections.abc import Sequence
 from decimal import Decimal
 from datetime import datetime, date, timedelta
 from functools import singledispatch
@@ -31,6 +32,12 @@ def _(o):
     return float(o)
 
 
+@convert.register(Sequence)
+def _(o):
+    """按列存储的结果集等非list/tuple序列"""
+    return list(o)
+
+
 class ExtendJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         try:
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+查询结果json序列化，每列按首个非空值的类型确定一次转换函数，逐行转换后整体编码，
+避免每个datetime、Decimal值都经过JSONEncoder.default
+安装orjson时使用orjson编码，否则使用simplejson
+"""
+from collections.abc import Sequence
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+
+import simplejson as json
+
+from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime, convert
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# 超出js安全整数范围的整数转为字符串，与bigint_as_string一致
+MAX_SAFE_INTEGER = 2 ** 53
+
+
+def _bigint(o):
+    return o if -MAX_SAFE_INTEGER < o < MAX_SAFE_INTEGER else str(o)
+
+
+def _datetime(o):
+    """与strftime('%Y-%m-%d %H:%M:%S')一致，isoformat更快"""
+    if o.tzinfo is None and o.year >= 1000:
+        return o.isoformat(' ', 'seconds')
+    return o.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _date(o):
+    return o.isoformat() if o.year >= 1000 else o.strftime('%Y-%m-%d')
+
+
+def _binary(o):
+    """二进制值，合法的utf-8按文本返回，否则返回十六进制"""
+    o = bytes(o)
+    try:
+        return o.decode('utf-8')
+    except UnicodeDecodeError:
+        return '0x' + o.hex()
+
+
+CONVERTERS = {
+    datetime: _datetime,
+    date: _date,
+    timedelta: lambda o: o.total_seconds(),
+    Decimal: float,
+    int: _bigint,
+    bytes: _binary,
+    bytearray: _binary,
+    memoryview: _binary,
+}
+# ExtendJSONEncoderFTime的时间格式
+FTIME_CONVERTERS = {**CONVERTERS, datetime: lambda o: o.isoformat(' ')}
+
+
+def column_converters(rows, width, ftime=False):
+    """
+    按列首个非空值的类型获取转换函数
+    :return: [(类型, 转换函数)]，无需转换的列为(None, None)
+    """
+    converters = FTIME_CONVERTERS if ftime else CONVERTERS
+    result = [(None, None)] * width
+    pending = set(range(width))
+    for row in rows:
+        for i in list(pending):
+            value = row[i]
+            if value is not None:
+                pending.discard(i)
+                if value.__class__ in converters:
+                    result[i] = (value.__class__, converters[value.__class__])
+        if not pending:
+            break
+    return result
+
+
+def is_table_rows(rows):
+    """rows是否为二维结果集"""
+    return bool(rows) and not isinstance(rows[0], (str, bytes)) and isinstance(rows[0], Sequence)
+
+
+def _convert_columns(columns, converters):
+    """按列转换，整列类型一致时直接map"""
+    for i, (column_type, function) in enumerate(converters):
+        if function is None:
+            continue
+        column = columns[i]
+        if all(value.__class__ is column_type for value in column):
+            columns[i] = list(map(function, column))
+        else:
+            columns[i] = [function(value) if value.__class__ is column_type else value for value in column]
+    return columns
+
+
+def encode_columns(rows, width, ftime=False):
+    """
+    转换结果集并按列返回，ColumnarRows直接使用列存储
+    :return: 列列表，每列为list或array
+    """
+    if not is_table_rows(rows):
+        return [[] for _ in range(width)]
+    columns = list(getattr(rows, 'columns', None) or zip(*rows))
+    return _convert_columns(columns, column_converters(rows, width, ftime))
+
+
+def encode_rows(rows, ftime=False):
+    """
+    转换结果集中需要转换的值，类型与列类型不一致的值保留，由编码器处理
+    :return: 无需转换时返回原rows
+    """
+    if not is_table_rows(rows):
+        return rows
+    converters = column_converters(rows, len(rows[0]), ftime)
+    if not any(function for _, function in converters):
+        return rows
+    columns = list(getattr(rows, 'columns', None) or zip(*rows))
+    return list(zip(*_convert_columns(columns, converters)))
+
+
+def _default(ftime):
+    """orjson的default，二进制值与结果集中的转换一致"""
+
+    def default(o):
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            return _binary(o)
+        if ftime and isinstance(o, datetime):
+            return o.isoformat(' ')
+        return convert(o)
+
+    return default
+
+
+def dumps(obj, ftime=False):
+    """
+    序列化为json字符串，时间格式与ExtendJSONEncoder、ExtendJSONEncoderFTime一致
+    :param ftime: 是否使用ExtendJSONEncoderFTime的时间格式
+    """
+    if orjson:
+        return orjson.dumps(obj, default=_default(ftime),
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, cls=ExtendJSONEncoderFTime if ftime else ExtendJSONEncoder, bigint_as_string=True)
@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+"""
+Prometheus监控指标，进程内汇总，按文本格式输出
+多进程部署时每个进程单独输出，由Prometheus按实例抓取
+"""
+import threading
+
+from sql.utils.sql_conn import pool_status
+
+# 耗时分桶上限，单位秒
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+POOL_STATES = ('in_use', 'idle', 'max_size')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Histogram(object):
+    """按标签分组的直方图"""
+
+    def __init__(self, name, documentation, labelnames, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # {标签值: [各分桶计数, 总和, 总数]}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in series:
+            for bucket, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le=bucket)} {bucket_count}')
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+QUERY_STAGE_SECONDS = Histogram('archery_query_stage_seconds', '在线查询各阶段耗时', ('instance', 'stage'))
+
+
+def observe_query_spans(instance_name, recorder):
+    """记录一次查询的各阶段耗时"""
+    for stage, cost in recorder.timings().items():
+        QUERY_STAGE_SECONDS.observe((instance_name, stage), cost / 1000)
+
+
+def _pool_lines():
+    name = 'archery_engine_pool_connections'
+    lines = [f'# HELP {name} 引擎连接池连接数', f'# TYPE {name} gauge']
+    labelnames = ('db_type', 'host', 'port', 'user')
+    for status in pool_status():
+        labels = tuple(status[label] for label in labelnames)
+        for state in POOL_STATES:
+            lines.append(f'{name}{_labels(labelnames, labels, state=state)} {status[state]}')
+    return lines
+
+
+def exposition():
+    """Prometheus文本格式"""
+    return '\n'.join(QUERY_STAGE_SECONDS.collect() + _pool_lines()) + '\n'
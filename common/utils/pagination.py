@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+"""
+列表页检索与分页，全文索引搜索、游标分页以及大结果集估算总数
+"""
+import logging
+
+import simplejson as json
+from django.db import connection
+from django.db.models import Q
+
+from common.config import SysConfig
+
+logger = logging.getLogger('default')
+
+# 超过该行数的结果集返回估算总数
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
+
+def search_filter(queryset, fields, search):
+    """
+    模糊搜索，开启fulltext_search配置并且为MySQL时使用ngram全文索引，否则使用icontains
+    全文索引需包含fields中全部字段，并且字段顺序一致，参考src/init_sql中的升级脚本
+    :param queryset:
+    :param fields: 搜索的字段列表
+    :param search: 搜索内容
+    :return:
+    """
+    if not search:
+        return queryset
+    # ngram默认分词长度为2，单字搜索使用icontains
+    if connection.vendor == 'mysql' and SysConfig().get('fulltext_search') and len(search.strip()) >= 2:
+        qn = connection.ops.quote_name
+        table = qn(queryset.model._meta.db_table)
+        columns = ','.join(f'{table}.{qn(queryset.model._meta.get_field(f).column)}' for f in fields)
+        # 使用短语搜索，与icontains的子串匹配语义保持一致
+        phrase = '"{}"'.format(search.strip().replace('"', ' '))
+        return queryset.extra(where=[f'MATCH({columns}) AGAINST (%s IN BOOLEAN MODE)'], params=[phrase])
+    condition = Q()
+    for field in fields:
+        condition |= Q(**{f'{field}__icontains': search})
+    return queryset.filter(condition)
+
+
+def approximate_count(queryset, threshold=APPROXIMATE_COUNT_THRESHOLD):
+    """
+    获取结果集总数，先在LIMIT子查询内精确计数，达到阈值后MySQL使用EXPLAIN估算，避免大表全量count
+    分组汇总的结果集EXPLAIN的rows为扫描行数而非分组数，达到阈值后返回阈值
+    :param queryset:
+    :param threshold:
+    :return:
+    """
+    count = queryset[:threshold].count()
+    if count < threshold or connection.vendor != 'mysql' or queryset.query.group_by is not None:
+        return count
+    try:
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [col[0] for col in cursor.description]
+            estimate = cursor.fetchone()[columns.index('rows')]
+        return max(count, int(estimate or 0))
+    except Exception as e:
+        logger.warning(f'估算结果集总数失败，错误信息：{e}')
+        return count
+
+
+def keyset_page(queryset, key, offset, limit, cursor=None):
+    """
+    按key倒序分页，传入cursor(上一页最后一行的key)时使用key<cursor定位，避免OFFSET扫描前面所有的行
+    :param queryset:
+    :param key: 排序字段，需唯一且有索引，一般为主键
+    :param offset:
+    :param limit:
+    :param cursor:
+    :return:
+    """
+    queryset = queryset.order_by(f'-{key}')
+    if cursor:
+        return queryset.filter(**{f'{key}__lt': cursor})[:limit]
+    return queryset[offset:offset + limit]
+
+
+def keyset_page_by(queryset, key, tiebreaker, offset, limit, cursor=None):
+    """
+    按key倒序、tiebreaker正序分页，用于key不唯一的场景，如按汇总值排序
+    :param queryset:
+    :param key: 排序字段
+    :param tiebreaker: key相同时的排序字段，需唯一
+    :param offset:
+    :param limit:
+    :param cursor: 上一页最后一行的[key, tiebreaker]，json格式，参考keyset_cursor
+    :return:
+    """
+    queryset = queryset.order_by(f'-{key}', tiebreaker)
+    if cursor:
+        value, tie = json.loads(cursor)
+        return queryset.filter(Q(**{f'{key}__lt': value}) | Q(**{key: value, f'{tiebreaker}__gt': tie}))[:limit]
+    return queryset[offset:offset + limit]
+
+
+def keyset_cursor(rows, key, tiebreaker):
+    """生成keyset_page_by下一页的cursor"""
+    return json.dumps([rows[-1][key], rows[-1][tiebreaker]]) if rows else None
+
+
+def keyset_page_union(querysets, key, fields, offset, limit, cursor=None):
+    """
+    多个结果集(如在线表与归档表)合并后按key倒序分页，cursor条件下推到各个结果集
+    :param querysets: 字段一致的多个结果集
+    :param key: 排序字段，需包含在fields中
+    :param fields: 返回的字段列表
+    :param offset:
+    :param limit:
+    :param cursor:
+    :return:
+    """
+    if cursor:
+        querysets = [qs.filter(**{f'{key}__lt': cursor}) for qs in querysets]
+    querysets = [qs.order_by().values(*fields) for qs in querysets]
+    combined = querysets[0].union(*querysets[1:], all=True).order_by(f'-{key}')
+    if cursor:
+        return combined[:limit]
+    return combined[offset:offset + limit]
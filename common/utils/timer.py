@@ -5,14 +5,15 @@
 @file: timer.py
 @time: 2019/05/15
 """
-import datetime
+import time
+from contextlib import contextmanager
 
 __author__ = 'hhyo'
 
 
 class FuncTimer(object):
     """
-    获取执行时间的上下文管理器
+    获取执行时间的上下文管理器，cost单位为秒
     """
 
     def __init__(self):
@@ -21,9 +22,38 @@ class FuncTimer(object):
         self.cost = 0
 
     def __enter__(self):
-        self.start = datetime.datetime.now()
+        self.start = time.perf_counter()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.end = datetime.datetime.now()
-        self.cost = (self.end - self.start).total_seconds()
+        self.end = time.perf_counter()
+        self.cost = round(self.end - self.start, 6)
+
+
+class SpanRecorder(object):
+    """
+    按阶段记录耗时，同名阶段累加，用于Server-Timing响应头、查询日志和监控指标
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter_ns()
+        # {阶段: 纳秒}，按首次记录的顺序
+        self.spans = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0) + time.perf_counter_ns() - start
+
+    def timings(self):
+        """各阶段及总耗时，单位毫秒"""
+        timings = {name: round(cost / 1e6, 3) for name, cost in self.spans.items()}
+        timings['total'] = round((time.perf_counter_ns() - self.start) / 1e6, 3)
+        return timings
+
+    def server_timing(self):
+        """Server-Timing响应头"""
+        return ', '.join(f'{name};dur={cost}' for name, cost in self.timings().items())
@@ -4,6 +4,7 @@ from django.http import HttpResponse
 
 from common.utils.const import WorkflowDict
 from common.utils.extend_json_encoder import ExtendJSONEncoder
+from common.utils.pagination import search_filter, approximate_count, keyset_page
 from sql.models import WorkflowAudit, WorkflowLog
 from sql.utils.resource_group import user_groups
 
@@ -15,8 +16,8 @@ def lists(request):
 
     limit = int(request.POST.get('limit'))
     offset = int(request.POST.get('offset'))
+    cursor = request.POST.get('cursor')
     workflow_type = int(request.POST.get('workflow_type'))
-    limit = offset + limit
     search = request.POST.get('search', '')
 
     # 先获取用户所在资源组列表
@@ -30,7 +31,6 @@ def lists(request):
 
     # 只返回所在资源组当前待自己审核的数据
     workflow_audit = WorkflowAudit.objects.filter(
-        workflow_title__icontains=search,
         current_status=WorkflowDict.workflow_status['audit_wait'],
         group_id__in=group_ids,
         current_audit__in=auth_group_ids
@@ -38,9 +38,11 @@ def lists(request):
     # 过滤工单类型
     if workflow_type != 0:
         workflow_audit = workflow_audit.filter(workflow_type=workflow_type)
+    # 过滤搜索项
+    workflow_audit = search_filter(workflow_audit, ['workflow_title'], search)
 
-    audit_list_count = workflow_audit.count()
-    audit_list = workflow_audit.order_by('-audit_id')[offset:limit].values(
+    audit_list_count = approximate_count(workflow_audit)
+    audit_list = keyset_page(workflow_audit, 'audit_id', offset, limit, cursor).values(
         'audit_id', 'workflow_type',
         'workflow_title', 'create_user_display',
         'create_time', 'current_status',
@@ -51,7 +53,7 @@ def lists(request):
     # QuerySet 序列化
     rows = [row for row in audit_list]
 
-    result = {"total": audit_list_count, "rows": rows}
+    result = {"total": audit_list_count, "rows": rows, "cursor": rows[-1]['audit_id'] if rows else None}
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
                         content_type='application/json')
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class SqlConfig(AppConfig):
+    name = 'sql'
+
+    def ready(self):
+        # 注册信号处理
+        import sql.signals  # noqa
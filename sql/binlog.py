@@ -13,8 +13,8 @@ from django_q.tasks import async_task
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine
 
-from sql.plugins.binglog2sql import Binlog2Sql
 from sql.notify import notify_for_binlog2sql
+from sql.utils.binlog_parser import BinlogParser
 from .models import Instance
 
 logger = logging.getLogger('default')
@@ -78,96 +78,49 @@ def del_binlog(request):
 @permission_required('sql.menu_binlog2sql', raise_exception=True)
 def binlog2sql(request):
     """
-    通过解析binlog获取SQL
+    通过解析binlog获取SQL，返回下一页的游标，携带游标请求时从上次解析的位置继续
     :param request:
     :return:
     """
     instance_name = request.POST.get('instance_name')
     save_sql = True if request.POST.get('save_sql') == 'true' else False
     instance = Instance.objects.get(instance_name=instance_name)
-    no_pk = True if request.POST.get('no_pk') == 'true' else False
-    flashback = True if request.POST.get('flashback') == 'true' else False
-    back_interval = 0 if request.POST.get('back_interval') == '' else int(request.POST.get('back_interval'))
-    num = 30 if request.POST.get('num') == '' else int(request.POST.get('num'))
-    start_file = request.POST.get('start_file')
-    start_pos = request.POST.get('start_pos') if request.POST.get('start_pos') == '' else int(
-        request.POST.get('start_pos'))
-    end_file = request.POST.get('end_file')
-    end_pos = request.POST.get('end_pos') if request.POST.get('end_pos') == '' else int(request.POST.get('end_pos'))
-    stop_time = request.POST.get('stop_time')
-    start_time = request.POST.get('start_time')
-    only_schemas = request.POST.getlist('only_schemas')
-    only_tables = request.POST.getlist('only_tables[]')
-    only_dml = True if request.POST.get('only_dml') == 'true' else False
-    sql_type = ['INSERT', 'UPDATE', 'DELETE'] if request.POST.getlist('sql_type[]') == [] else request.POST.getlist(
-        'sql_type[]')
-
-    # flashback=True获取DML回滚语句
-    result = {'status': 0, 'msg': 'ok', 'data': ''}
-
-    # 提交给binlog2sql进行解析
-    binlog2sql = Binlog2Sql()
-    # 准备参数
-    args = {"conn_options": fr"-h{instance.host} -u{instance.user} -p'{instance.password}' -P{instance.port} ",
-            "stop_never": False,
-            "no-primary-key": no_pk,
-            "flashback": flashback,
-            "back-interval": back_interval,
-            "start-file": start_file,
-            "start-position": start_pos,
-            "stop-file": end_file,
-            "stop-position": end_pos,
-            "start-datetime": start_time,
-            "stop-datetime": stop_time,
-            "databases": ' '.join(only_schemas),
-            "tables": ' '.join(only_tables),
-            "only-dml": only_dml,
-            "sql-type": ' '.join(sql_type),
-            "instance": instance
+    num = 30 if request.POST.get('num', '') == '' else int(request.POST.get('num'))
+    cursor = request.POST.get('cursor') or None
+    start_pos = request.POST.get('start_pos', '')
+    end_pos = request.POST.get('end_pos', '')
+    args = {"instance": instance,
+            "start_file": request.POST.get('start_file'),
+            "start_pos": int(start_pos) if start_pos else None,
+            "end_file": request.POST.get('end_file'),
+            "end_pos": int(end_pos) if end_pos else None,
+            "start_time": request.POST.get('start_time'),
+            "stop_time": request.POST.get('stop_time'),
+            "only_schemas": request.POST.getlist('only_schemas[]') or request.POST.getlist('only_schemas'),
+            "only_tables": request.POST.getlist('only_tables[]'),
+            "only_dml": True if request.POST.get('only_dml') == 'true' else False,
+            "sql_type": request.POST.getlist('sql_type[]') or ['INSERT', 'UPDATE', 'DELETE'],
+            "no_pk": True if request.POST.get('no_pk') == 'true' else False,
+            # flashback=True获取DML回滚语句
+            "flashback": True if request.POST.get('flashback') == 'true' else False,
             }
-
     # 参数检查
-    args_check_result = binlog2sql.check_args(args)
-    if args_check_result['status'] == 1:
-        return HttpResponse(json.dumps(args_check_result), content_type='application/json')
-    # 参数转换
-    cmd_args = binlog2sql.generate_args2cmd(args, shell=True)
-    # 执行命令
+    if not args['start_file']:
+        result = {'status': 1, 'msg': '起始binlog文件不能为空！', 'data': {}}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    result = {'status': 0, 'msg': 'ok', 'data': '', 'cursor': None}
     try:
-        p = binlog2sql.execute_cmd(cmd_args, shell=True)
-        # 读取前num行后结束
-        rows = []
-        n = 1
-        for line in iter(p.stdout.readline, ''):
-            if n <= num:
-                n = n + 1
-                row_info = {}
-                try:
-                    row_info['sql'] = line.split('; #')[0] + ";"
-                    row_info['binlog_info'] = line.split('; #')[1].rstrip('\"')
-                except IndexError:
-                    row_info['sql'] = line
-                    row_info['binlog_info'] = None
-                rows.append(row_info)
-            else:
-                break
-        if rows.__len__() == 0:
-            # 判断是否有异常
-            stderr = p.stderr.read()
-            if stderr:
-                result['status'] = 1
-                result['msg'] = stderr
-                return HttpResponse(json.dumps(result), content_type='application/json')
-        # 终止子进程
-        p.kill()
+        rows, next_cursor = BinlogParser(**args).parse(num, cursor=cursor)
         result['data'] = rows
+        result['cursor'] = next_cursor
     except Exception as e:
         logger.error(traceback.format_exc())
         result['status'] = 1
         result['msg'] = str(e)
 
-    # 异步保存到文件，去除conn_options避免展示密码信息
-    if save_sql:
+    # 异步保存到文件，翻页时不重复保存
+    if save_sql and not cursor:
         async_task(binlog2sql_file, args=args, user=request.user, hook=notify_for_binlog2sql)
 
     # 返回查询结果
@@ -182,7 +135,6 @@ def binlog2sql_file(args, user):
     :param user: 操作用户对象，用户消息推送
     :return:
     """
-    binlog2sql = Binlog2Sql()
     instance = args.get('instance')
     timestamp = int(time.time())
     path = os.path.join(settings.BASE_DIR, 'downloads/binlog2sql/')
@@ -192,11 +144,6 @@ def binlog2sql_file(args, user):
     else:
         filename = os.path.join(path, f"{instance.host}_{instance.port}_{timestamp}.sql")
 
-    # 参数转换
-    cmd_args = binlog2sql.generate_args2cmd(args, shell=True)
-    # 执行命令保存到文件
-    with open(filename, 'w') as f:
-        p = binlog2sql.execute_cmd(cmd_args, shell=True)
-        for c in iter(p.stdout.readline, ''):
-            f.write(c)
+    # 按binlog文件并行解析后合并保存
+    BinlogParser(**args).parse_to_file(filename)
     return user, filename
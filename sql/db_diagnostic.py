@@ -1,3 +1,5 @@
+import datetime
+
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
 
@@ -5,6 +7,7 @@ from django.http import HttpResponse
 
 from sql.engines import get_engine
 from common.utils.extend_json_encoder import ExtendJSONEncoder
+from sql.utils.diagnostic_sampler import get_sample, filter_processlist, lock_waits_sql
 from sql.utils.resource_group import user_instances
 from .models import AliyunRdsConfig, Instance
 
@@ -12,6 +15,18 @@ from .aliyun_rds import process_status as aliyun_process_status, create_kill_ses
     kill_session as aliyun_kill_session, sapce_status as aliyun_sapce_status
 
 
+def _sample_result(instance, sample_time, name):
+    """获取指定时间之前最近一次采样中的数据"""
+    try:
+        sample_time = datetime.datetime.strptime(sample_time, '%Y-%m-%d %H:%M:%S')
+        sample = get_sample(instance.id, sample_time)
+    except Exception as e:
+        return {'status': 1, 'msg': f'获取历史采样失败：{e}'}
+    if not sample:
+        return {'status': 1, 'msg': '该时间之前无采样数据，请确认已开启问题诊断采样'}
+    return {'status': 0, 'msg': 'ok', 'sample_time': sample['sample_time'], 'rows': sample[name]}
+
+
 # 问题诊断--进程列表
 @permission_required('sql.process_view', raise_exception=True)
 def process(request):
@@ -24,6 +39,15 @@ def process(request):
         result = {'status': 1, 'msg': '你所在组未关联该实例', 'data': []}
         return HttpResponse(json.dumps(result), content_type='application/json')
 
+    # 查询历史采样
+    sample_time = request.POST.get('sample_time')
+    if sample_time:
+        result = _sample_result(instance, sample_time, 'processlist')
+        if result['status'] == 0:
+            result['rows'] = filter_processlist(result['rows'], command_type)
+        return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                            content_type='application/json')
+
     base_sql = "select id, user, host, db, command, time, state, ifnull(info,'') as info from information_schema.processlist"
     # 判断是RDS还是其他实例
     if AliyunRdsConfig.objects.filter(instance=instance, is_enable=True).exists():
@@ -94,14 +118,19 @@ def kill_session(request):
     if AliyunRdsConfig.objects.filter(instance=instance, is_enable=True).exists():
         result = aliyun_kill_session(request)
     else:
-        thread_ids = thread_ids.replace('[', '').replace(']', '')
+        try:
+            thread_ids = [int(i) for i in json.loads(thread_ids)]
+        except (TypeError, ValueError):
+            result = {'status': 1, 'msg': '线程ID格式错误', 'data': []}
+            return HttpResponse(json.dumps(result), content_type='application/json')
+        # 直接并发终止，已结束的线程返回Unknown thread id
         engine = get_engine(instance=instance)
-        sql = "select concat('kill ', id, ';') from information_schema.processlist where id in ({});".format(thread_ids)
-        all_kill_sql = engine.query('information_schema', sql)
-        kill_sql = ''
-        for row in all_kill_sql.rows:
-            kill_sql = kill_sql + row[0]
-        engine.execute('information_schema', kill_sql)
+        kill_result = engine.kill_connections(thread_ids)
+        result['data'] = [{'thread_id': k, 'error': v} for k, v in kill_result.items()]
+        errors = [f'{k}：{v}' for k, v in kill_result.items() if v]
+        if errors:
+            result['status'] = 1
+            result['msg'] = '部分会话终止失败\n' + '\n'.join(errors)
 
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
@@ -162,66 +191,15 @@ def trxandlocks(request):
         result = {'status': 1, 'msg': '你所在组未关联该实例', 'data': []}
         return HttpResponse(json.dumps(result), content_type='application/json')
 
-    query_engine = get_engine(instance=instance)
-    server_version = query_engine.server_version
-    if server_version < (8, 0, 1):
-        sql = '''
-            SELECT
-              rtrx.`trx_state`                                                        AS "等待的状态",
-              rtrx.`trx_started`                                                      AS "等待事务开始时间",
-              rtrx.`trx_wait_started`                                                 AS "等待事务等待开始时间",
-              lw.`requesting_trx_id`                                                  AS "等待事务ID",
-              rtrx.trx_mysql_thread_id                                                AS "等待事务线程ID",
-              rtrx.`trx_query`                                                        AS "等待事务的sql",
-              CONCAT(rl.`lock_mode`, '-', rl.`lock_table`, '(', rl.`lock_index`, ')') AS "等待的表信息",
-              rl.`lock_id`                                                            AS "等待的锁id",
-              lw.`blocking_trx_id`                                                    AS "运行的事务id",
-              trx.trx_mysql_thread_id                                                 AS "运行的事务线程id",
-              CONCAT(l.`lock_mode`, '-', l.`lock_table`, '(', l.`lock_index`, ')')    AS "运行的表信息",
-              l.lock_id                                                               AS "运行的锁id",
-              trx.`trx_state`                                                         AS "运行事务的状态",
-              trx.`trx_started`                                                       AS "运行事务的时间",
-              trx.`trx_wait_started`                                                  AS "运行事务的等待开始时间",
-              trx.`trx_query`                                                         AS "运行事务的sql"
-            FROM information_schema.`INNODB_LOCKS` rl
-              , information_schema.`INNODB_LOCKS` l
-              , information_schema.`INNODB_LOCK_WAITS` lw
-              , information_schema.`INNODB_TRX` rtrx
-              , information_schema.`INNODB_TRX` trx
-            WHERE rl.`lock_id` = lw.`requested_lock_id`
-                  AND l.`lock_id` = lw.`blocking_lock_id`
-                  AND lw.requesting_trx_id = rtrx.trx_id
-                  AND lw.blocking_trx_id = trx.trx_id;'''
-
-    else:
-        sql = '''
-            SELECT
-              rtrx.`trx_state`                                                           AS "等待的状态",
-              rtrx.`trx_started`                                                         AS "等待事务开始时间",
-              rtrx.`trx_wait_started`                                                    AS "等待事务等待开始时间",
-              lw.`REQUESTING_ENGINE_TRANSACTION_ID`                                      AS "等待事务ID",
-              rtrx.trx_mysql_thread_id                                                   AS "等待事务线程ID",
-              rtrx.`trx_query`                                                           AS "等待事务的sql",
-              CONCAT(rl.`lock_mode`, '-', rl.`OBJECT_SCHEMA`, '(', rl.`INDEX_NAME`, ')') AS "等待的表信息",
-              rl.`ENGINE_LOCK_ID`                                                        AS "等待的锁id",
-              lw.`BLOCKING_ENGINE_TRANSACTION_ID`                                        AS "运行的事务id",
-              trx.trx_mysql_thread_id                                                    AS "运行的事务线程id",
-              CONCAT(l.`lock_mode`, '-', l.`OBJECT_SCHEMA`, '(', l.`INDEX_NAME`, ')')    AS "运行的表信息",
-              l.ENGINE_LOCK_ID                                                           AS "运行的锁id",
-              trx.`trx_state`                                                            AS "运行事务的状态",
-              trx.`trx_started`                                                          AS "运行事务的时间",
-              trx.`trx_wait_started`                                                     AS "运行事务的等待开始时间",
-              trx.`trx_query`                                                            AS "运行事务的sql"
-            FROM performance_schema.`data_locks` rl
-              , performance_schema.`data_locks` l
-              , performance_schema.`data_lock_waits` lw
-              , information_schema.`INNODB_TRX` rtrx
-              , information_schema.`INNODB_TRX` trx
-            WHERE rl.`ENGINE_LOCK_ID` = lw.`REQUESTING_ENGINE_LOCK_ID`
-                  AND l.`ENGINE_LOCK_ID` = lw.`BLOCKING_ENGINE_LOCK_ID`
-                  AND lw.REQUESTING_ENGINE_TRANSACTION_ID = rtrx.trx_id
-                  AND lw.BLOCKING_ENGINE_TRANSACTION_ID = trx.trx_id;'''
+    # 查询历史采样
+    sample_time = request.POST.get('sample_time')
+    if sample_time:
+        result = _sample_result(instance, sample_time, 'lock_waits')
+        return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                            content_type='application/json')
 
+    query_engine = get_engine(instance=instance)
+    sql = lock_waits_sql(query_engine.server_version)
     query_result = query_engine.query('information_schema', sql)
     if not query_result.error:
         trxandlocks = query_result.to_dict()
@@ -49,6 +49,12 @@ class EngineBase:
     def kill_connection(self, thread_id):
         """终止数据库连接"""
 
+    def cancel(self):
+        """取消当前连接正在执行的语句，由其他线程调用，驱动不支持时不处理"""
+        conn = self.conn
+        if conn is not None and hasattr(conn, 'cancel'):
+            conn.cancel()
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet，rows=list"""
         return ResultSet()
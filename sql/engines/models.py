@@ -1,10 +1,14 @@
 # -*- coding: UTF-8 -*-
 """engine 结果集定义"""
 import json
+from array import array
+from collections.abc import Sequence
 
 
 class ReviewResult:
-    """审核的单条结果"""
+    """审核的单条结果，上线单每条语句一个，使用__slots__减少内存占用"""
+    __slots__ = ('id', 'stage', 'errlevel', 'stagestatus', 'errormessage', 'sql', 'affected_rows', 'sequence',
+                 'backup_dbname', 'execute_time', 'sqlsha1', 'backup_time', 'db_name', 'actual_affected_rows')
 
     def __init__(self, inception_result=None, **kwargs):
         """
@@ -44,6 +48,14 @@ class ReviewResult:
             self.db_name = kwargs.get("db_name", "")
             self.actual_affected_rows = kwargs.get("actual_affected_rows", "")
 
+    @property
+    def __dict__(self):
+        """兼容按__dict__读取字段"""
+        return self.to_dict()
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
 
 class ReviewSet:
     """review和执行后的结果集, rows中是review result, 有设定好的字段"""
@@ -71,17 +83,95 @@ class ReviewSet:
             if isinstance(r, dict):
                 tmp_list += [r]
             else:
-                tmp_list += [r.__dict__]
+                tmp_list += [r.to_dict()]
 
         return json.dumps(tmp_list)
 
     def to_dict(self):
         tmp_list = []
         for r in self.rows:
-            tmp_list += [r.__dict__]
+            tmp_list += [r.to_dict()]
         return tmp_list
 
 
+class RowView(Sequence):
+    """ColumnarRows中的一行，按列读取，不复制数据"""
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [column[self._index] for column in self._columns[i]]
+        return self._columns[i][self._index]
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __eq__(self, other):
+        return isinstance(other, Sequence) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class ColumnarRows(Sequence):
+    """
+    按列存储的查询结果，整数、浮点数列使用array存储，其他列使用list
+    按行读取时返回RowView，可直接替换ResultSet.rows
+    """
+    __slots__ = ('columns', '_length')
+    # 列的首个值决定存储类型，后续值类型不一致时转换为list，避免array隐式转换数据类型(如bool、int转为float)
+    TYPECODES = {int: 'q', float: 'd'}
+    ARRAY_TYPES = {typecode: value_type for value_type, typecode in TYPECODES.items()}
+
+    def __init__(self, width, rows=None):
+        self.columns = [None] * width
+        self._length = 0
+        if rows:
+            self.extend(rows)
+
+    def append(self, row):
+        for i, value in enumerate(row):
+            column = self.columns[i]
+            if column is None:
+                typecode = self.TYPECODES.get(type(value))
+                column = self.columns[i] = array(typecode) if typecode else []
+            if isinstance(column, array) and type(value) is not self.ARRAY_TYPES[column.typecode]:
+                column = self.columns[i] = list(column)
+            try:
+                column.append(value)
+            except OverflowError:
+                column = self.columns[i] = list(column)
+                column.append(value)
+        self._length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [RowView(self.columns, index) for index in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('row index out of range')
+        return RowView(self.columns, i)
+
+    def __len__(self):
+        return self._length
+
+    def __eq__(self, other):
+        return isinstance(other, Sequence) and len(self) == len(other) and all(
+            row == other_row for row, other_row in zip(self, other))
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class ResultSet:
     """查询的结果集, rows 内只有值, column_list 中的是key"""
 
@@ -97,8 +187,8 @@ class ResultSet:
         self.warning = None
         self.error = None
         self.is_critical = False
-        # rows 为普通列表
-        self.rows = rows or []
+        # rows 为普通列表或ColumnarRows
+        self.rows = rows if rows is not None else []
         self.column_list = column_list if column_list else []
         self.status = status
         self.affected_rows = affected_rows
@@ -117,3 +207,9 @@ class ResultSet:
 
     def to_sep_dict(self):
         return {"column_list": self.column_list, "rows": self.rows}
+
+    def to_columnar(self):
+        """结果集转换为按列存储"""
+        if not isinstance(self.rows, ColumnarRows):
+            self.rows = ColumnarRows(len(self.column_list), self.rows)
+        return self
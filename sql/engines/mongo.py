@@ -2,8 +2,8 @@
 import re
 import pymongo
 import logging
+import threading
 import traceback
-import json
 
 from . import EngineBase
 from .models import ResultSet
@@ -13,12 +13,41 @@ __author__ = 'jackie'
 
 logger = logging.getLogger('default')
 
+# MongoClient自带连接池且线程安全，按实例缓存，进程内复用
+_clients = {}
+_clients_lock = threading.Lock()
+# 游标每批次获取的文档数上限
+BATCH_SIZE = 1000
+# 写入结果集合的聚合阶段
+WRITE_STAGES = ('$out', '$merge')
+
+
+def parse_command(sql):
+    """
+    解析查询命令
+    :param sql: {collection}.find(filter[, projection]) 或 {collection}.aggregate(pipeline)
+    :return: (collection, method, args)
+    """
+    match = re.match(r'^\s*(.+?)\.(find|aggregate)\((.*)\)\s*;?\s*$', sql, re.S | re.I)
+    if not match:
+        raise ValueError('语句格式错误')
+    collection, method, args = match.groups()
+    args = json_util.loads(f'[{args}]') if args.strip() else []
+    return collection, method.lower(), args
+
 
 class MongoEngine(EngineBase):
     def get_connection(self, db_name=None):
-        conn = pymongo.MongoClient(self.host, self.port, connect=True, connectTimeoutMS=10000)
-        if self.user and self.password:
-            conn.admin.authenticate(self.user, self.password)
+        key = (self.host, int(self.port), self.user, self.password)
+        conn = _clients.get(key)
+        if conn is None:
+            with _clients_lock:
+                conn = _clients.get(key)
+                if conn is None:
+                    auth = {'username': self.user, 'password': self.password, 'authSource': 'admin'} \
+                        if self.user and self.password else {}
+                    conn = pymongo.MongoClient(self.host, self.port, connect=True, connectTimeoutMS=10000, **auth)
+                    _clients[key] = conn
         return conn
 
     @property
@@ -38,15 +67,16 @@ class MongoEngine(EngineBase):
     def query_check(self, db_name=None, sql=''):
         """提交查询前的检查"""
         result = {'msg': '', 'bad_query': True, 'filtered_sql': sql, 'has_star': False}
-        safe_cmd = ['find']
-        sql = sql.split('.')[1]
-        for cmd in safe_cmd:
-            if re.match(fr'^{cmd}\(.*', sql.strip(), re.I):
-                result['bad_query'] = False
-                break
-        if result['bad_query']:
-            result['msg'] = """禁止执行该命令！正确格式为：{collection_name}.find() or {collection_name}.find(expression)""", \
-                            """如 : 'test.find({"id":{"$gt":1.0}})'"""
+        try:
+            _, method, args = parse_command(sql)
+            # 聚合管道中不允许写入集合
+            if method == 'aggregate' and any(stage in WRITE_STAGES for arg in args if isinstance(arg, list)
+                                             for step in arg if isinstance(step, dict) for stage in step):
+                raise ValueError('禁止使用$out、$merge')
+            result['bad_query'] = False
+        except Exception as e:
+            result['msg'] = f"""禁止执行该命令！{e}，正确格式为：{{collection_name}}.find(expression[, projection]) """ \
+                            f"""or {{collection_name}}.aggregate(pipeline)，如 : 'test.find({{"id":{{"$gt":1.0}}}})'"""
         return result
 
     def get_all_tables(self, db_name):
@@ -60,20 +90,23 @@ class MongoEngine(EngineBase):
         result_set = ResultSet(full_sql=sql)
         try:
             conn = self.get_connection()
-            db = conn[db_name]
-            collect = db[sql.split('.')[0]]
-            match = re.compile(r'[(](.*)[)]', re.S)
-            sql = re.findall(match, sql)[0]
-            if sql != '':
-                sql = json.loads(sql)
-                result = collect.find(sql).limit(limit_num)
+            collection, method, args = parse_command(sql)
+            collect = conn[db_name][collection]
+            batch_size = min(limit_num, BATCH_SIZE) if limit_num > 0 else BATCH_SIZE
+            if method == 'aggregate':
+                pipeline = list(args[0]) if args else []
+                # 条数限制下推到管道末尾
+                if limit_num > 0:
+                    pipeline.append({'$limit': limit_num})
+                cursor = collect.aggregate(pipeline, batchSize=batch_size)
             else:
-                result = collect.find(sql).limit(limit_num)
-            rows = json.loads(json_util.dumps(result))
+                # 过滤条件和投影下推到服务端
+                cursor = collect.find(*args[:2]).limit(limit_num).batch_size(batch_size)
             result_set.column_list = ['Result']
-            if isinstance(rows, list):
-                result_set.rows = tuple([json.dumps(x, ensure_ascii=False)] for x in rows)
-                result_set.affected_rows = len(rows)
+            # 逐批读取游标，每个文档只序列化一次
+            with cursor:
+                result_set.rows = tuple([json_util.dumps(doc, ensure_ascii=False)] for doc in cursor)
+            result_set.affected_rows = len(result_set.rows)
         except Exception as e:
             logger.warning(f"Mongo命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
             result_set.error = str(e)
@@ -1,9 +1,13 @@
 # -*- coding: UTF-8 -*-
+import functools
 import logging
 import traceback
 import re
 import sqlparse
 
+from common.config import SysConfig
+from sql.utils.async_tasks import execute_tenants
+from sql.utils.sql_conn import ConnectionPool, get_pool, POOL_MAX_SIZE
 from . import EngineBase
 import pyodbc
 from .models import ResultSet, ReviewSet, ReviewResult
@@ -12,6 +16,12 @@ from sql.utils.data_masking import brute_mask
 logger = logging.getLogger('default')
 
 
+def _reset_session(conn):
+    """回滚未提交事务，当前库恢复为master"""
+    conn.rollback()
+    conn.cursor().execute('use [master];')
+
+
 class MssqlEngine(EngineBase):
     def get_connection(self, db_name=None):
         connstr = """DRIVER=ODBC Driver 17 for SQL Server;SERVER={0},{1};UID={2};PWD={3};
@@ -19,7 +29,11 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
                                                                  self.instance.charset or 'UTF8')
         if self.conn:
             return self.conn
-        self.conn = pyodbc.connect(connstr)
+        key = ('mssql', self.host, self.port, self.user, self.password, connstr)
+        self.pool = get_pool(key, lambda: ConnectionPool(
+            connect=functools.partial(pyodbc.connect, connstr), reset=_reset_session,
+            max_size=int(SysConfig().get('engine_pool_size') or POOL_MAX_SIZE)))
+        self.conn = self.pool.acquire()
         return self.conn
 
     def get_all_databases(self):
@@ -180,10 +194,12 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
         return check_result
 
     def execute_workflow(self, workflow):
+        """多个库并行执行上线单，返回{db_name: 执行结果}"""
         if workflow.is_backup:
             # TODO mssql 备份未实现
             pass
-        return self.execute(db_name=workflow.db_name, sql=workflow.sqlworkflowcontent.sql_content)
+        db_names = workflow.db_names.split(',') if workflow.db_names else []
+        return execute_tenants(self, db_names, workflow.sqlworkflowcontent.sql_content)
 
     def execute(self, db_name=None, sql='', close_conn=True):
         """执行sql语句 返回 Review set"""
@@ -248,6 +264,7 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
         return execute_result
 
     def close(self):
+        """连接归还到连接池"""
         if self.conn:
-            self.conn.close()
+            self.pool.release(self.conn)
             self.conn = None
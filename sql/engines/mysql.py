@@ -2,6 +2,7 @@
 import asyncio
 import re
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import MySQLdb
 import sqlparse
@@ -18,6 +19,9 @@ from . import EngineBase
 from .inception import InceptionEngine
 from .models import ResultSet, ReviewResult, ReviewSet
 
+# 批量终止连接时的并发数
+KILL_WORKERS = 8
+
 
 class MysqlEngine(EngineBase):
     def __init__(self, instance=None):
@@ -64,6 +68,40 @@ class MysqlEngine(EngineBase):
         """终止数据库连接"""
         self.query(sql=f'kill {thread_id}')
 
+    def cancel(self):
+        """通过新的连接终止正在执行查询的会话"""
+        if self.thread_id:
+            MysqlEngine(instance=self.instance).kill_connection(self.thread_id)
+
+    def kill_connections(self, thread_ids):
+        """
+        并发终止多个数据库连接，每个线程从连接池获取连接执行kill
+        :param thread_ids: 线程ID列表
+        :return: {thread_id: 错误信息}，终止成功时为None
+        """
+        thread_ids = [int(i) for i in thread_ids]
+        if not thread_ids:
+            return {}
+        pool = self.get_connection()
+
+        def kill(thread_id):
+            try:
+                conn = pool.connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute(f'kill {thread_id}')
+                    cursor.close()
+                finally:
+                    conn.close()
+            except MySQLdb.Error as e:
+                return str(e)
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(KILL_WORKERS, len(thread_ids))) as executor:
+                return dict(zip(thread_ids, executor.map(kill, thread_ids)))
+        finally:
+            self.close()
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet"""
         sql = "show databases"
@@ -117,6 +155,7 @@ class MysqlEngine(EngineBase):
             pool = self.get_connection(db_name=db_name)
             conn = pool.connection()
             cursor = conn.cursor()
+            self.thread_id = cursor.connection.thread_id()
             # cursor = conn.cursor(cursorclass)
             effect_row = cursor.execute(sql)
             if int(limit_num) > 0:
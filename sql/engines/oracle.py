@@ -1,12 +1,15 @@
 # -*- coding: UTF-8 -*-
 # https://stackoverflow.com/questions/7942520/relationship-between-catalog-schema-user-and-database-instance
+import functools
 import logging
 import traceback
 import re
 import sqlparse
 
 from common.config import SysConfig
-from common.utils.timer import FuncTimer
+from sql.utils.async_tasks import execute_tenants
+from sql.utils.batch_execute import BatchExecutor
+from sql.utils.sql_conn import ConnectionPool, Lease, get_pool, POOL_MAX_SIZE, POOL_MAX_IDLE_TIME, POOL_WAIT_TIMEOUT
 from sql.utils.sql_utils import get_syntax_type
 from . import EngineBase
 import cx_Oracle
@@ -15,6 +18,78 @@ from sql.utils.data_masking import brute_mask
 
 logger = logging.getLogger('default')
 
+# 每次网络往返获取的行数上限
+ARRAY_SIZE = 1000
+# LOB字段默认最多返回的字符数，可通过系统配置oracle_lob_max_size修改
+LOB_MAX_SIZE = 1024 * 1024
+# INSERT ALL中全部INTO子句的字段总数需小于1000(ORA-24335)
+INSERT_ALL_MAX_VALUES = 999
+
+
+# 实例的服务器版本，首次获取连接时记录，filter_sql改写语句时不访问数据库
+_server_versions = {}
+
+
+def _output_type_handler(cursor, name, default_type, size, precision, scale):
+    """CLOB仅读取上限内的字符，超出部分不从服务端传输"""
+    if default_type in (cx_Oracle.CLOB, cx_Oracle.NCLOB):
+        max_size = int(SysConfig().get('oracle_lob_max_size') or LOB_MAX_SIZE)
+        return cursor.var(default_type, arraysize=cursor.arraysize,
+                          outconverter=lambda lob: lob.read(1, max_size))
+
+
+def _reset_session(conn, user):
+    """回滚未提交事务，CURRENT_SCHEMA恢复为登录用户"""
+    conn.rollback()
+    conn.cursor().execute(f"ALTER SESSION SET CURRENT_SCHEMA = {user}")
+
+
+def _coalesce_insert(table, columns, values):
+    """单行INSERT合并为INSERT ALL，序列在INSERT ALL中只取值一次，包含nextval时不合并"""
+    if any('nextval' in value.lower() for value in values):
+        return None
+    into = ' '.join(f'INTO {table}{columns} VALUES {value}' for value in values)
+    return f'INSERT ALL {into} SELECT 1 FROM DUAL'
+
+
+class OracleSessionPool(ConnectionPool):
+    """基于cx_Oracle.SessionPool，会话的创建、等待和空闲回收由驱动完成，归还时重置会话状态"""
+
+    def __init__(self, user, password, dsn, reset=None, max_size=POOL_MAX_SIZE):
+        super(OracleSessionPool, self).__init__(connect=None, reset=reset, max_size=max_size)
+        self.session_pool = cx_Oracle.SessionPool(
+            user, password, dsn, min=0, max=max_size, increment=1, threaded=True,
+            getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT, waitTimeout=POOL_WAIT_TIMEOUT * 1000,
+            timeout=POOL_MAX_IDLE_TIME, encoding="UTF-8", nencoding="UTF-8")
+
+    def acquire(self):
+        conn = self.session_pool.acquire()
+        with self._cond:
+            self.metrics['acquired'] += 1
+        return Lease(conn, self._leaked)
+
+    def release(self, lease):
+        if not lease.detach():
+            return
+        conn = lease.raw
+        if self._reset(conn):
+            self.session_pool.release(conn)
+        else:
+            with self._cond:
+                self.metrics['discarded'] += 1
+            self.session_pool.drop(conn)
+
+    def _leaked(self, conn):
+        """未归还的会话丢弃，不再放回会话池"""
+        logger.warning('Oracle会话未归还会话池，已丢弃该会话')
+        with self._cond:
+            self.metrics['leaked'] += 1
+        self.session_pool.drop(conn)
+
+    def status(self):
+        busy, opened = self.session_pool.busy, self.session_pool.opened
+        return dict(self.metrics, in_use=busy, idle=opened - busy, max_size=self.max_size)
+
 
 class OracleEngine(EngineBase):
 
@@ -28,14 +103,23 @@ class OracleEngine(EngineBase):
             return self.conn
         if self.sid:
             dsn = cx_Oracle.makedsn(self.host, self.port, self.sid)
-            self.conn = cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
         elif self.service_name:
             dsn = cx_Oracle.makedsn(self.host, self.port, service_name=self.service_name)
-            self.conn = cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
         else:
             raise ValueError('sid 和 dsn 均未填写, 请联系管理页补充该实例配置.')
+        key = ('oracle', self.host, self.port, self.user, self.password, dsn)
+        self.pool = get_pool(key, lambda: OracleSessionPool(
+            self.user, self.password, dsn, reset=functools.partial(_reset_session, user=self.user),
+            max_size=int(SysConfig().get('engine_pool_size') or POOL_MAX_SIZE)))
+        self.conn = self.pool.acquire()
+        if self._version_key not in _server_versions:
+            _server_versions[self._version_key] = tuple([n for n in self.conn.version.split('.')[:3]])
         return self.conn
 
+    @property
+    def _version_key(self):
+        return self.host, self.port, self.sid, self.service_name
+
     @property
     def name(self):
         return 'Oracle'
@@ -46,9 +130,13 @@ class OracleEngine(EngineBase):
 
     @property
     def server_version(self):
-        conn = self.get_connection()
-        version = conn.version
-        return tuple([n for n in version.split('.')[:3]])
+        """已记录版本时不再获取连接，为获取版本打开的连接随即归还"""
+        if self._version_key not in _server_versions:
+            opened = self.conn is None
+            self.get_connection()
+            if opened:
+                self.close()
+        return _server_versions[self._version_key]
 
     def get_all_databases(self):
         """获取数据库列表， 返回resultSet 供上层调用， 底层实际上是获取oracle的schema列表"""
@@ -147,15 +235,17 @@ class OracleEngine(EngineBase):
         return result
 
     def filter_sql(self, sql='', limit_num=0):
-        sql_lower = sql.lower()
-        # 对查询sql增加limit限制
-        if re.match(r"^select", sql_lower):
-            if sql_lower.find(' rownum ') == -1:
-                if sql_lower.find('where') == -1:
-                    return f"{sql.rstrip(';')} WHERE ROWNUM <= {limit_num}"
-                else:
-                    return f"{sql.rstrip(';')} AND ROWNUM <= {limit_num}"
-        return sql.strip()
+        sql = sql.strip()
+        # 对查询sql增加limit限制，已有限制时不处理
+        if re.match(r"^select", sql, re.I) and int(limit_num) > 0 \
+                and not re.search(r'\brownum\b|\bfetch\s+(first|next)\b', sql, re.I):
+            sql = sql.rstrip(';')
+            # 12c开始支持FETCH FIRST，之前的版本或未记录版本时嵌套子查询，保证排序、分组、集合运算后再限制
+            version = _server_versions.get(self._version_key)
+            if version and int(version[0]) >= 12:
+                return f"{sql} FETCH FIRST {limit_num} ROWS ONLY"
+            return f"SELECT * FROM ({sql}) WHERE ROWNUM <= {limit_num}"
+        return sql
 
     def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
         """返回 ResultSet """
@@ -163,19 +253,18 @@ class OracleEngine(EngineBase):
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
+            limit_num = int(limit_num)
+            # 按限制行数设置每次获取的行数，获取到limit_num行后不再读取
+            cursor.arraysize = min(limit_num, ARRAY_SIZE) if limit_num > 0 else ARRAY_SIZE
+            cursor.outputtypehandler = _output_type_handler
             if db_name:
                 cursor.execute(f"ALTER SESSION SET CURRENT_SCHEMA = {db_name}")
             cursor.execute(sql)
             fields = cursor.description
-            if any(x[1] == cx_Oracle.CLOB for x in fields):
-                rows = [tuple([(c.read() if type(c) == cx_Oracle.LOB else c) for c in r]) for r in cursor]
-                if int(limit_num) > 0:
-                    rows =  rows[0:int(limit_num)]
+            if limit_num > 0:
+                rows = cursor.fetchmany(limit_num)
             else:
-                if int(limit_num) > 0:
-                    rows = cursor.fetchmany(int(limit_num))
-                else:
-                    rows = cursor.fetchall()
+                rows = cursor.fetchall()
 
             result_set.column_list = [i[0] for i in fields] if fields else []
             result_set.rows = [tuple(x) for x in rows]
@@ -245,34 +334,27 @@ class OracleEngine(EngineBase):
             line += 1
         return check_result
 
-    def execute_workflow(self, workflow, close_conn=True):
-        """执行上线单，返回Review set"""
-        sql = workflow.sqlworkflowcontent.sql_content
+    def execute_workflow(self, workflow):
+        """多个库并行执行上线单，返回{db_name: 执行结果}"""
+        db_names = workflow.db_names.split(',') if workflow.db_names else []
+        return execute_tenants(self, db_names, workflow.sqlworkflowcontent.sql_content)
+
+    def execute(self, db_name=None, sql='', close_conn=True):
+        """执行语句，返回Review set"""
         execute_result = ReviewSet(full_sql=sql)
         # 删除注释语句，切分语句，将切换CURRENT_SCHEMA语句增加到切分结果中
         sql = sqlparse.format(sql, strip_comments=True)
-        split_sql = [f"ALTER SESSION SET CURRENT_SCHEMA = {workflow.db_name};"] + sqlparse.split(sql)
+        split_sql = [f"ALTER SESSION SET CURRENT_SCHEMA = {db_name};"] + sqlparse.split(sql)
         line = 1
         statement = None
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            # 逐条执行切分语句，追加到执行结果中
-            for statement in split_sql:
-                statement = statement.rstrip(';')
-                with FuncTimer() as t:
-                    cursor.execute(statement)
-                    conn.commit()
-                execute_result.rows.append(ReviewResult(
-                    id=line,
-                    errlevel=0,
-                    stagestatus='Execute Successfully',
-                    errormessage='None',
-                    sql=statement,
-                    affected_rows=cursor.rowcount,
-                    execute_time=t.cost,
-                ))
-                line += 1
+            # 连续的DML语句按execute_batch_size分批提交，单行INSERT合并执行
+            batch_size = int(SysConfig().get('execute_batch_size') or 1)
+            executor = BatchExecutor(conn, batch_size=batch_size, coalesce=_coalesce_insert,
+                                     max_coalesce_values=INSERT_ALL_MAX_VALUES)
+            execute_result.rows, execute_result.error = executor.execute(
+                [statement.rstrip(';') for statement in split_sql])
         except Exception as e:
             logger.warning(f"Oracle命令执行报错，语句：{statement or sql}， 错误信息：{traceback.format_exc()}")
             execute_result.error = str(e)
@@ -305,6 +387,7 @@ class OracleEngine(EngineBase):
         return execute_result
 
     def close(self):
+        """连接归还到连接池"""
         if self.conn:
-            self.conn.close()
+            self.pool.release(self.conn)
             self.conn = None
@@ -5,14 +5,18 @@
 @file: pgsql.py
 @time: 2019/03/29
 """
+import functools
 import re
+import uuid
 import psycopg2
 import logging
 import traceback
 import sqlparse
 
 from common.config import SysConfig
-from common.utils.timer import FuncTimer
+from sql.utils.async_tasks import execute_tenants
+from sql.utils.batch_execute import BatchExecutor
+from sql.utils.sql_conn import ConnectionPool, get_pool, POOL_MAX_SIZE
 from sql.utils.sql_utils import get_syntax_type
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
@@ -21,13 +25,39 @@ __author__ = 'hhyo、yyukai'
 
 logger = logging.getLogger('default')
 
+# 服务端游标每次网络往返获取的行数上限
+ITER_SIZE = 2000
+# 可在服务端游标中执行的查询语句
+CURSOR_STATEMENT = re.compile(r'^(select|with|values)\b', re.I)
+# 语句末尾已有的行数限制：limit n [offset m]、offset m limit n、fetch first n rows only
+LIMIT_CLAUSE = re.compile(r'(\blimit\s+\d+(\s+offset\s+\d+(\s+rows?)?)?'
+                          r'|\boffset\s+\d+(\s+rows?)?\s+limit\s+\d+'
+                          r'|\bfetch\s+(first|next)\s+\d+\s+rows?\s+only)$', re.I)
+LIMIT_ALL = re.compile(r'\blimit\s+all(?=(\s+offset\s+\d+(\s+rows?)?)?$)', re.I)
+
+
+def _reset_session(conn):
+    """回滚未提交事务，search_path等会话参数恢复默认值"""
+    conn.rollback()
+    conn.cursor().execute('RESET ALL;')
+    conn.commit()
+
+
+def _coalesce_insert(table, columns, values):
+    """单行INSERT合并为多行INSERT"""
+    return f"INSERT INTO {table}{columns} VALUES {', '.join(values)}"
+
 
 class PgSQLEngine(EngineBase):
     def get_connection(self, db_name=None):
         if self.conn:
             return self.conn
-        self.conn = psycopg2.connect(host=self.host, port=self.port, user=self.user,
-                                     password=self.password, dbname=db_name)
+        key = ('pgsql', self.host, self.port, self.user, self.password, db_name)
+        self.pool = get_pool(key, lambda: ConnectionPool(
+            connect=functools.partial(psycopg2.connect, host=self.host, port=self.port, user=self.user,
+                                      password=self.password, dbname=db_name),
+            reset=_reset_session, max_size=int(SysConfig().get('engine_pool_size') or POOL_MAX_SIZE)))
+        self.conn = self.pool.acquire()
         return self.conn
 
     @property
@@ -142,20 +172,28 @@ class PgSQLEngine(EngineBase):
         result_set = ResultSet(full_sql=sql)
         try:
             conn = self.get_connection(db_name=db_name)
-            cursor = conn.cursor()
-            if schema_name:
-                cursor.execute(f"SET search_path TO {schema_name};")
-            cursor.execute(sql)
-            effect_row = cursor.rowcount
-            if int(limit_num) > 0:
-                rows = cursor.fetchmany(size=int(limit_num))
+            limit_num = int(limit_num)
+            statement = sql.strip().rstrip(';').strip()
+            # search_path与查询语句合并为一次请求
+            set_search_path = f"SET search_path TO {schema_name};" if schema_name else ''
+            if CURSOR_STATEMENT.match(statement):
+                # 声明服务端游标，仅传输获取的行，传输量与limit_num相关而与表大小无关
+                cursor_name = f'archery_{uuid.uuid4().hex}'
+                conn.cursor().execute(f"{set_search_path}DECLARE {cursor_name} NO SCROLL CURSOR FOR {statement}")
+                cursor = conn.cursor(cursor_name)
+                cursor.itersize = min(limit_num, ITER_SIZE) if limit_num > 0 else ITER_SIZE
+            else:
+                cursor = conn.cursor()
+                cursor.execute(f"{set_search_path}{sql}")
+            if limit_num > 0:
+                rows = cursor.fetchmany(size=limit_num)
             else:
                 rows = cursor.fetchall()
             fields = cursor.description
 
             result_set.column_list = [i[0] for i in fields] if fields else []
             result_set.rows = rows
-            result_set.affected_rows = effect_row
+            result_set.affected_rows = len(rows)
         except Exception as e:
             logger.warning(f"PgSQL命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
             result_set.error = str(e)
@@ -170,13 +208,14 @@ class PgSQLEngine(EngineBase):
         return self._query(db_name=db_name, sql=sql, limit_num=limit_num, schema_name=schema_name, close_conn=close_conn)
 
     def filter_sql(self, sql='', limit_num=0):
-        # 对查询sql增加limit限制，# TODO limit改写待优化
-        sql_lower = sql.lower().rstrip(';').strip()
-        if re.match(r"^select", sql_lower):
-            if re.search(r"limit\s+(\d+)$", sql_lower) is None:
-                if re.search(r"limit\s+\d+\s*,\s*(\d+)$", sql_lower) is None:
-                    return f"{sql.rstrip(';')} limit {limit_num};"
-        return f"{sql.rstrip(';')};"
+        # 对查询sql增加limit限制，已有limit、offset、fetch first时保留，limit all改写为limit n
+        sql = sql.rstrip(';').strip()
+        if re.match(r"^select", sql, re.I) and not LIMIT_CLAUSE.search(sql):
+            if LIMIT_ALL.search(sql):
+                sql = LIMIT_ALL.sub(f'limit {limit_num}', sql)
+            else:
+                sql = f'{sql} limit {limit_num}'
+        return f'{sql};'
 
     def query_masking(self, db_name=None, sql='', resultset=None):
         """不做脱敏"""
@@ -228,35 +267,27 @@ class PgSQLEngine(EngineBase):
             line += 1
         return check_result
 
-    def execute_workflow(self, workflow, close_conn=True):
-        """执行上线单，返回Review set"""
-        sql = workflow.sqlworkflowcontent.sql_content
+    def execute_workflow(self, workflow):
+        """多个库并行执行上线单，返回{db_name: 执行结果}"""
+        db_names = workflow.db_names.split(',') if workflow.db_names else []
+        return execute_tenants(self, db_names, workflow.sqlworkflowcontent.sql_content)
+
+    def execute(self, db_name=None, sql='', close_conn=True):
+        """执行语句，db_name为库名或库名.schema名，返回Review set"""
         execute_result = ReviewSet(full_sql=sql)
-        # 删除注释语句，切分语句，将切换CURRENT_SCHEMA语句增加到切分结果中
+        # 删除注释语句，切分语句，指定schema时将切换search_path语句增加到切分结果中
         sql = sqlparse.format(sql, strip_comments=True)
-        split_sql = sqlparse.split(sql)
+        db_name, _, schema_name = (db_name or '').partition('.')
+        split_sql = ([f"SET search_path TO {schema_name};"] if schema_name else []) + sqlparse.split(sql)
         line = 1
         statement = None
-        db_name = workflow.db_name
         try:
             conn = self.get_connection(db_name=db_name)
-            cursor = conn.cursor()
-            # 逐条执行切分语句，追加到执行结果中
-            for statement in split_sql:
-                statement = statement.rstrip(';')
-                with FuncTimer() as t:
-                    cursor.execute(statement)
-                    conn.commit()
-                execute_result.rows.append(ReviewResult(
-                    id=line,
-                    errlevel=0,
-                    stagestatus='Execute Successfully',
-                    errormessage='None',
-                    sql=statement,
-                    affected_rows=cursor.rowcount,
-                    execute_time=t.cost,
-                ))
-                line += 1
+            # 连续的DML语句按execute_batch_size分批提交，单行INSERT合并执行
+            batch_size = int(SysConfig().get('execute_batch_size') or 1)
+            executor = BatchExecutor(conn, batch_size=batch_size, coalesce=_coalesce_insert)
+            execute_result.rows, execute_result.error = executor.execute(
+                [statement.rstrip(';') for statement in split_sql])
         except Exception as e:
             logger.warning(f"PGSQL命令执行报错，语句：{statement or sql}， 错误信息：{traceback.format_exc()}")
             execute_result.error = str(e)
@@ -288,8 +319,8 @@ class PgSQLEngine(EngineBase):
                 self.close()
         return execute_result
 
-
     def close(self):
+        """连接归还到连接池"""
         if self.conn:
-            self.conn.close()
+            self.pool.release(self.conn)
             self.conn = None
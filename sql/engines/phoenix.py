@@ -1,10 +1,14 @@
 # -*- coding: UTF-8 -*-
+import functools
 import logging
 import traceback
 import re
 import sqlparse
 
 import phoenixdb
+from common.config import SysConfig
+from sql.utils.async_tasks import execute_tenants
+from sql.utils.sql_conn import ConnectionPool, get_pool, POOL_MAX_SIZE
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
 
@@ -17,7 +21,12 @@ class PhoenixEngine(EngineBase):
             return self.conn
 
         database_url = f'http://{self.host}:{self.port}/'
-        self.conn = phoenixdb.connect(database_url, autocommit=True)
+        key = ('phoenix', self.host, self.port, self.user, self.password)
+        # 自动提交，无会话状态需要重置
+        self.pool = get_pool(key, lambda: ConnectionPool(
+            connect=functools.partial(phoenixdb.connect, database_url, autocommit=True),
+            max_size=int(SysConfig().get('engine_pool_size') or POOL_MAX_SIZE)))
+        self.conn = self.pool.acquire()
         return self.conn
 
     def get_all_databases(self):
@@ -131,8 +140,9 @@ class PhoenixEngine(EngineBase):
         return check_result
 
     def execute_workflow(self, workflow):
-        """PhoenixDB无需备份"""
-        return self.execute(db_name=workflow.db_name, sql=workflow.sqlworkflowcontent.sql_content)
+        """PhoenixDB无需备份，多个库并行执行上线单，返回{db_name: 执行结果}"""
+        db_names = workflow.db_names.split(',') if workflow.db_names else []
+        return execute_tenants(self, db_names, workflow.sqlworkflowcontent.sql_content)
 
     def execute(self, db_name=None, sql='', close_conn=True):
         """原生执行语句"""
@@ -187,6 +197,7 @@ class PhoenixEngine(EngineBase):
         return execute_result
 
     def close(self):
+        """连接归还到连接池"""
         if self.conn:
-            self.conn.close()
+            self.pool.release(self.conn)
             self.conn = None
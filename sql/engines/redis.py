@@ -9,9 +9,12 @@
 import re
 import redis
 import logging
+import threading
 import traceback
 
+from common.config import SysConfig
 from common.utils.timer import FuncTimer
+from sql.utils.async_tasks import execute_tenants
 from . import EngineBase
 from .models import ResultSet, ReviewSet, ReviewResult
 
@@ -19,12 +22,38 @@ __author__ = 'hhyo'
 
 logger = logging.getLogger('default')
 
+# 连接池按实例和库缓存，进程内复用
+_pools = {}
+_pools_lock = threading.Lock()
+# scan每次迭代的count
+SCAN_COUNT = 1000
+
+
+def _connection_pool(host, port, db, password):
+    key = (host, int(port), int(db), password)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = redis.ConnectionPool(host=host, port=port, db=db, password=password,
+                                            encoding_errors='ignore', decode_responses=True)
+                _pools[key] = pool
+    return pool
+
+
+def _parse_scan(sql):
+    """解析scan命令，返回(cursor, match, count)"""
+    args = sql.split()
+    cursor = int(args[1]) if len(args) > 1 else 0
+    options = {k.lower(): v for k, v in zip(args[2::2], args[3::2])}
+    return cursor, options.get('match'), int(options.get('count', SCAN_COUNT))
+
 
 class RedisEngine(EngineBase):
     def get_connection(self, db_name=None):
         db_name = db_name or 0
-        return redis.Redis(host=self.host, port=self.port, db=db_name, password=self.password,
-                           encoding_errors='ignore', decode_responses=True)
+        return redis.Redis(connection_pool=_connection_pool(self.host, self.port, db_name, self.password))
 
     @property
     def name(self):
@@ -66,27 +95,50 @@ class RedisEngine(EngineBase):
         result_set = ResultSet(full_sql=sql)
         try:
             conn = self.get_connection(db_name=db_name)
-            rows = conn.execute_command(sql)
             result_set.column_list = ['Result']
-            if isinstance(rows, list):
-                if re.match(fr'^scan', sql.strip(), re.I):
-                    keys = [[row] for row in rows[1]]
-                    keys.insert(0, rows[0])
-                    result_set.rows = tuple(keys)
-                    result_set.affected_rows = len(rows[1])
-                else:
+            if re.match(fr'^scan', sql.strip(), re.I):
+                cursor, keys = self._scan(conn, sql, limit_num)
+                # 首行为下次scan的游标，为0时已遍历完成
+                result_set.rows = tuple([[cursor]] + [[key] for key in keys])
+                result_set.affected_rows = len(keys)
+            else:
+                rows = conn.execute_command(sql)
+                if isinstance(rows, list):
                     result_set.rows = tuple([row] for row in rows)
                     result_set.affected_rows = len(rows)
-            else:
-                result_set.rows = tuple([[rows]])
-                result_set.affected_rows = 1 if rows else 0
-            if limit_num > 0:
-                result_set.rows = result_set.rows[0:limit_num]
+                else:
+                    result_set.rows = tuple([[rows]])
+                    result_set.affected_rows = 1 if rows else 0
+                if limit_num > 0:
+                    result_set.rows = result_set.rows[0:limit_num]
         except Exception as e:
             logger.warning(f"Redis命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
             result_set.error = str(e)
         return result_set
 
+    @staticmethod
+    def _scan(conn, sql, limit_num=0):
+        """
+        从scan命令指定的游标开始迭代，直到获取limit_num个key或遍历完成，limit_num为0时只迭代一次
+        每次迭代的count不超过剩余条数，放不下的一页不返回，游标停在最后一个完整返回的页，翻页时不遗漏
+        首页已超过limit_num时截断，返回该页之后的游标
+        :return: (下次scan的游标, key列表)
+        """
+        cursor, match, count = _parse_scan(sql)
+        keys = []
+        while True:
+            page_count = min(count, limit_num - len(keys)) if limit_num > 0 else count
+            next_cursor, page = conn.scan(cursor=cursor, match=match, count=page_count)
+            if limit_num > 0 and len(keys) + len(page) > limit_num:
+                if not keys:
+                    keys, cursor = page[:limit_num], next_cursor
+                break
+            keys.extend(page)
+            cursor = next_cursor
+            if int(cursor) == 0 or limit_num <= 0 or len(keys) >= limit_num:
+                break
+        return cursor, keys
+
     def filter_sql(self, sql='', limit_num=0):
         return sql.strip()
 
@@ -112,51 +164,83 @@ class RedisEngine(EngineBase):
         return check_result
 
     def execute_workflow(self, workflow):
-        """执行上线单，返回Review set"""
-        sql = workflow.sqlworkflowcontent.sql_content
+        """多个库并行执行上线单，返回{db_name: 执行结果}"""
+        db_names = workflow.db_names.split(',') if workflow.db_names else []
+        return execute_tenants(self, db_names, workflow.sqlworkflowcontent.sql_content)
+
+    def execute(self, db_name=None, sql='', close_conn=True):
+        """
+        按execute_batch_size分批通过pipeline发送命令，返回Review set
+        默认每批1条，报错后立即停止；批次大于1时报错命令所在批次的后续命令已发送执行
+        """
         split_sql = [cmd.strip() for cmd in sql.split('\n') if cmd.strip()]
         execute_result = ReviewSet(full_sql=sql)
+        batch_size = int(SysConfig().get('execute_batch_size') or 1)
         line = 1
-        cmd = None
         try:
-            conn = self.get_connection(db_name=workflow.db_name)
-            for cmd in split_sql:
+            conn = self.get_connection(db_name=db_name)
+            for start in range(0, len(split_sql), batch_size):
+                batch = split_sql[start:start + batch_size]
+                pipe = conn.pipeline(transaction=False)
+                for cmd in batch:
+                    pipe.execute_command(cmd)
                 with FuncTimer() as t:
-                    conn.execute_command(cmd)
+                    results = pipe.execute(raise_on_error=False)
+                # pipeline内无单条命令耗时，按批次平均
+                execute_time = round(t.cost / len(batch), 6)
+                for cmd, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        logger.warning(f"Redis命令执行报错，语句：{cmd}， 错误信息：{result}")
+                        execute_result.error = execute_result.error or str(result)
+                        execute_result.rows.append(ReviewResult(
+                            id=line,
+                            errlevel=2,
+                            stagestatus='Execute Failed',
+                            errormessage=f'异常信息：{result}',
+                            sql=cmd,
+                            affected_rows=0,
+                            execute_time=execute_time,
+                        ))
+                    else:
+                        execute_result.rows.append(ReviewResult(
+                            id=line,
+                            errlevel=0,
+                            stagestatus='Execute Successfully',
+                            errormessage='None',
+                            sql=cmd,
+                            affected_rows=0,
+                            execute_time=execute_time,
+                        ))
+                    line += 1
+                # 同一批次的命令已全部发送，报错后不再执行后续批次
+                if execute_result.error:
+                    break
+        except Exception as e:
+            logger.warning(f"Redis命令执行报错，批次起始语句：{split_sql[line - 1] if split_sql else sql}，"
+                           f"错误信息：{traceback.format_exc()}")
+            # 连接异常时当前批次均视为失败
+            execute_result.error = str(e)
+            for cmd in split_sql[line - 1:line - 1 + batch_size]:
                 execute_result.rows.append(ReviewResult(
                     id=line,
-                    errlevel=0,
-                    stagestatus='Execute Successfully',
-                    errormessage='None',
+                    errlevel=2,
+                    stagestatus='Execute Failed',
+                    errormessage=f'异常信息：{e}',
                     sql=cmd,
                     affected_rows=0,
-                    execute_time=t.cost,
+                    execute_time=0,
                 ))
                 line += 1
-        except Exception as e:
-            logger.warning(f"Redis命令执行报错，语句：{cmd or sql}， 错误信息：{traceback.format_exc()}")
-            # 追加当前报错语句信息到执行结果中
-            execute_result.error = str(e)
+        # 报错批次后面的语句标记为审核通过、未执行，追加到执行结果中
+        for statement in split_sql[line - 1:]:
             execute_result.rows.append(ReviewResult(
                 id=line,
-                errlevel=2,
-                stagestatus='Execute Failed',
-                errormessage=f'异常信息：{e}',
-                sql=cmd,
+                errlevel=0,
+                stagestatus='Audit completed',
+                errormessage=f'前序语句失败, 未执行',
+                sql=statement,
                 affected_rows=0,
                 execute_time=0,
             ))
             line += 1
-            # 报错语句后面的语句标记为审核通过、未执行，追加到执行结果中
-            for statement in split_sql[line - 1:]:
-                execute_result.rows.append(ReviewResult(
-                    id=line,
-                    errlevel=0,
-                    stagestatus='Audit completed',
-                    errormessage=f'前序语句失败, 未执行',
-                    sql=statement,
-                    affected_rows=0,
-                    execute_time=0,
-                ))
-                line += 1
         return execute_result
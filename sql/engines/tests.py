@@ -1,22 +1,26 @@
 import json
 from datetime import timedelta, datetime
-from unittest.mock import patch, Mock, ANY
+from unittest.mock import patch, Mock, MagicMock, ANY
 
+import MySQLdb
+import cx_Oracle
+from redis.exceptions import ResponseError
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 
 from common.config import SysConfig
 from sql.engines import EngineBase
 from sql.engines.goinception import GoInceptionEngine
-from sql.engines.models import ResultSet, ReviewSet, ReviewResult
+from sql.engines.models import ResultSet, ReviewSet, ReviewResult, ColumnarRows
 from sql.engines.mssql import MssqlEngine
 from sql.engines.mysql import MysqlEngine
 from sql.engines.redis import RedisEngine
 from sql.engines.pgsql import PgSQLEngine
-from sql.engines.oracle import OracleEngine
+from sql.engines.oracle import OracleEngine, _server_versions
 from sql.engines.mongo import MongoEngine
 from sql.engines.inception import InceptionEngine, _repair_json_str
 from sql.models import Instance, SqlWorkflow, SqlWorkflowContent
+from sql.utils.sql_conn import close_pools
 
 User = get_user_model()
 
@@ -47,7 +51,7 @@ class TestEngineBase(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=cls.ins1,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         cls.wfc1 = SqlWorkflowContent.objects.create(
@@ -89,7 +93,7 @@ class TestMssql(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=cls.ins1,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=cls.wf, sql_content='insert into some_tb values (1)')
@@ -100,6 +104,9 @@ class TestMssql(TestCase):
         cls.wf.delete()
         SqlWorkflowContent.objects.all().delete()
 
+    def tearDown(self):
+        close_pools()
+
     @patch('sql.engines.mssql.pyodbc.connect')
     def testGetConnection(self, connect):
         new_engine = MssqlEngine(instance=self.ins1)
@@ -117,7 +124,10 @@ class TestMssql(TestCase):
         query_result = new_engine.query(sql='some_str', limit_num=100)
         cur.return_value.execute.assert_called()
         cur.return_value.fetchmany.assert_called_once_with(100)
-        connect.return_value.close.assert_called_once()
+        # 连接归还到连接池，回滚并切换回master，不关闭连接
+        connect.return_value.rollback.assert_called_once()
+        cur.return_value.execute.assert_called_with('use [master];')
+        connect.return_value.close.assert_not_called()
         self.assertIsInstance(query_result, ResultSet)
 
     @patch.object(MssqlEngine, 'query')
@@ -233,7 +243,7 @@ class TestMysql(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins1,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=self.wf)
@@ -524,6 +534,21 @@ class TestMysql(TestCase):
         new_engine.kill_connection(100)
         _query.assert_called_once_with(sql="kill 100")
 
+    @patch.object(MysqlEngine, 'get_connection')
+    def test_kill_connections(self, _conn):
+        """并发终止，返回每个线程的结果"""
+        def execute(sql):
+            if sql != 'kill 100':
+                raise MySQLdb.OperationalError(1094, 'Unknown thread id: 101')
+
+        cursor = _conn.return_value.connection.return_value.cursor.return_value
+        cursor.execute.side_effect = execute
+        new_engine = MysqlEngine(instance=self.ins1)
+        r = new_engine.kill_connections(['100', 101])
+        self.assertIsNone(r[100])
+        self.assertIn('Unknown thread id', r[101])
+        self.assertEqual(_conn.return_value.connection.return_value.close.call_count, 2)
+
     @patch.object(MysqlEngine, 'query')
     def test_seconds_behind_master(self, _query):
         new_engine = MysqlEngine(instance=self.ins1)
@@ -624,8 +649,41 @@ class TestRedis(TestCase):
         self.assertIsInstance(check_result, ReviewSet)
         self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
 
-    @patch('redis.Redis.execute_command', return_value='text')
-    def test_execute_workflow_success(self, _execute_command):
+    @patch('redis.Redis.scan', side_effect=[(10, ['k1', 'k2']), (20, ['k3']), (0, ['k4'])])
+    def test_query_scan(self, _scan):
+        """scan按游标迭代到满足条数，首行返回下次的游标"""
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='scan 0 match k* count 2', limit_num=3)
+        self.assertTupleEqual(query_result.rows, ([20], ['k1'], ['k2'], ['k3']))
+        # count不超过剩余条数
+        _scan.assert_called_with(cursor=10, match='k*', count=1)
+
+    @patch('redis.Redis.scan', side_effect=[(10, ['k1', 'k2']), (20, ['k3', 'k4'])])
+    def test_query_scan_partial_page(self, _scan):
+        """放不下的一页不返回，游标停在最后一个完整返回的页"""
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='scan 0 count 100000', limit_num=3)
+        self.assertTupleEqual(query_result.rows, ([10], ['k1'], ['k2']))
+        _scan.assert_any_call(cursor=0, match=None, count=3)
+
+    @patch('redis.Redis.scan', return_value=(10, ['k{}'.format(i) for i in range(5)]))
+    def test_query_scan_limit(self, _scan):
+        """首页超过limit_num时截断"""
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='scan 0 count 100000', limit_num=2)
+        self.assertTupleEqual(query_result.rows, ([10], ['k0'], ['k1']))
+        _scan.assert_called_once_with(cursor=0, match=None, count=2)
+
+    @patch('redis.Redis.scan', side_effect=[(10, ['k1', 'k2']), (0, ['k3'])])
+    def test_query_scan_no_limit(self, _scan):
+        """limit_num为0时只迭代一次"""
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='scan 0', limit_num=0)
+        self.assertTupleEqual(query_result.rows, ([10], ['k1'], ['k2']))
+        _scan.assert_called_once()
+
+    @patch('redis.client.Pipeline.execute', return_value=['OK'])
+    def test_execute_workflow_success(self, _execute):
         sql = 'set 1 1'
         row = ReviewResult(id=1,
                            errlevel=0,
@@ -645,14 +703,40 @@ class TestRedis(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
         new_engine = RedisEngine(instance=self.ins)
         execute_result = new_engine.execute_workflow(workflow=wf)
-        self.assertIsInstance(execute_result, ReviewSet)
-        self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        self.assertEqual(list(execute_result), ['some_db'])
+        self.assertEqual(execute_result['some_db'][0].keys(), row.__dict__.keys())
+
+    @patch('redis.client.Pipeline.execute')
+    def test_execute_workflow_failed(self, _execute):
+        """默认逐条执行，报错语句返回失败，后续语句不执行"""
+        sql = 'hset 1 a b\nset 1 1\nset 2 2'
+        _execute.side_effect = [[ResponseError('WRONGTYPE')], ['OK'], ['OK']]
+        execute_result = RedisEngine(instance=self.ins).execute(db_name='0', sql=sql)
+        self.assertEqual(execute_result.error, 'WRONGTYPE')
+        self.assertEqual(_execute.call_count, 1)
+        self.assertEqual([r.stagestatus for r in execute_result.rows],
+                         ['Execute Failed', 'Audit completed', 'Audit completed'])
+
+    @patch('redis.client.Pipeline.execute')
+    def test_execute_workflow_failed_batch(self, _execute):
+        """按批次发送时，报错语句所在批次已执行，后续批次不执行"""
+        sql = 'set 1 1\nhset 1 a b\nset 2 2'
+        _execute.side_effect = [['OK', ResponseError('WRONGTYPE')], ['OK']]
+        sys_config = SysConfig()
+        sys_config.set('execute_batch_size', '2')
+        try:
+            execute_result = RedisEngine(instance=self.ins).execute(db_name='0', sql=sql)
+        finally:
+            sys_config.purge()
+        self.assertEqual(execute_result.error, 'WRONGTYPE')
+        self.assertEqual([r.stagestatus for r in execute_result.rows],
+                         ['Execute Successfully', 'Execute Failed', 'Audit completed'])
 
 
 class TestPgSQL(TestCase):
@@ -668,6 +752,9 @@ class TestPgSQL(TestCase):
         cls.ins.delete()
         cls.sys_config.purge()
 
+    def tearDown(self):
+        close_pools()
+
     @patch('psycopg2.connect')
     def test_engine_base_info(self, _conn):
         new_engine = PgSQLEngine(instance=self.ins)
@@ -690,6 +777,32 @@ class TestPgSQL(TestCase):
         self.assertIsInstance(query_result, ResultSet)
         self.assertListEqual(query_result.rows, [(1,)])
 
+    @patch('psycopg2.connect')
+    def test_query_server_cursor(self, _conn):
+        """查询语句使用服务端游标，search_path与游标声明合并执行，按限制行数获取"""
+        cursor = _conn.return_value.cursor.return_value
+        cursor.fetchmany.return_value = [(1,)]
+        new_engine = PgSQLEngine(instance=self.ins)
+        query_result = new_engine.query(db_name="some_dbname", sql='select 1;', limit_num=100,
+                                        schema_name="some_schema", close_conn=False)
+        self.assertListEqual(query_result.rows, [(1,)])
+        declare = cursor.execute.call_args_list[0][0][0]
+        self.assertRegex(declare, r'^SET search_path TO some_schema;DECLARE archery_\w+ NO SCROLL CURSOR FOR select 1$')
+        _conn.return_value.cursor.assert_called_with(declare.split()[4])
+        self.assertEqual(cursor.itersize, 100)
+        cursor.fetchmany.assert_called_once_with(size=100)
+        cursor.fetchall.assert_not_called()
+
+    @patch('psycopg2.connect')
+    def test_query_not_select(self, _conn):
+        """非查询语句使用客户端游标"""
+        cursor = _conn.return_value.cursor.return_value
+        cursor.fetchall.return_value = [('on',)]
+        new_engine = PgSQLEngine(instance=self.ins)
+        query_result = new_engine.query(db_name="some_dbname", sql='show autovacuum;', close_conn=False)
+        self.assertListEqual(query_result.rows, [('on',)])
+        cursor.execute.assert_called_once_with('show autovacuum;')
+
     @patch('psycopg2.connect.cursor.execute')
     @patch('psycopg2.connect.cursor')
     @patch('psycopg2.connect')
@@ -766,6 +879,34 @@ class TestPgSQL(TestCase):
         check_result = new_engine.filter_sql(sql=sql, limit_num=1)
         self.assertEqual(check_result, "select * from xx limit 10;")
 
+    def test_filter_sql_with_limit_offset(self):
+        new_engine = PgSQLEngine(instance=self.ins)
+        for sql in ["select * from xx limit 10 offset 5", "select * from xx offset 5 limit 10",
+                    "select * from xx fetch first 10 rows only"]:
+            self.assertEqual(new_engine.filter_sql(sql=sql, limit_num=100), f"{sql};")
+        check_result = new_engine.filter_sql(sql="select * from xx offset 5;", limit_num=100)
+        self.assertEqual(check_result, "select * from xx offset 5 limit 100;")
+
+    @patch('psycopg2.connect')
+    def test_execute_batch(self, _conn):
+        """连续的单行INSERT合并执行，按批次提交"""
+        self.sys_config.set('execute_batch_size', '100')
+        cursor = _conn.return_value.cursor.return_value
+        cursor.rowcount = 2
+        sql = "insert into t values (1, 'a');\ninsert into t values (2, 'b');"
+        new_engine = PgSQLEngine(instance=self.ins)
+        execute_result = new_engine.execute(db_name='archery', sql=sql, close_conn=False)
+        self.assertIsNone(execute_result.error)
+        self.assertEqual([row.sql for row in execute_result.rows],
+                         ["insert into t values (1, 'a')", "insert into t values (2, 'b')"])
+        cursor.execute.assert_called_once_with("INSERT INTO t VALUES (1, 'a'), (2, 'b')")
+        _conn.return_value.commit.assert_called_once()
+
+    def test_filter_sql_with_limit_all(self):
+        new_engine = PgSQLEngine(instance=self.ins)
+        check_result = new_engine.filter_sql(sql="select * from xx limit all offset 5", limit_num=100)
+        self.assertEqual(check_result, "select * from xx limit 100 offset 5;")
+
     def test_query_masking(self):
         query_result = ResultSet()
         new_engine = PgSQLEngine(instance=self.ins)
@@ -834,14 +975,39 @@ class TestPgSQL(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
         new_engine = PgSQLEngine(instance=self.ins)
         execute_result = new_engine.execute_workflow(workflow=wf)
-        self.assertIsInstance(execute_result, ReviewSet)
-        self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        self.assertEqual(list(execute_result), ['some_db'])
+        self.assertEqual(execute_result['some_db'][0].keys(), row.__dict__.keys())
+
+    @patch('psycopg2.connect')
+    def test_execute_workflow_tenants(self, _conn):
+        """多个库分别执行，指定schema时先切换search_path"""
+        sql = 'update user set id=1'
+        wf = SqlWorkflow.objects.create(
+            workflow_name='some_name',
+            group_id=1,
+            group_name='g1',
+            engineer_display='',
+            audit_auth_groups='some_group',
+            create_time=datetime.now() - timedelta(days=1),
+            status='workflow_finish',
+            is_backup=True,
+            instance=self.ins,
+            db_names='db1,db2.s1',
+            syntax_type=1
+        )
+        SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
+        execute_result = PgSQLEngine(instance=self.ins).execute_workflow(workflow=wf)
+        self.assertEqual(sorted(execute_result), ['db1', 'db2.s1'])
+        self.assertEqual([row['sql'] for row in execute_result['db1']], [sql])
+        self.assertEqual([row['sql'] for row in execute_result['db2.s1']], ['SET search_path TO s1', sql])
+        self.assertEqual({row['db_name'] for row in execute_result['db2.s1']}, {'db2.s1'})
+        self.assertEqual(sorted(c[1]['dbname'] for c in _conn.call_args_list), ['db1', 'db2'])
 
     @patch('psycopg2.connect.cursor.execute')
     @patch('psycopg2.connect.cursor')
@@ -865,15 +1031,14 @@ class TestPgSQL(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
-        with self.assertRaises(AttributeError):
-            new_engine = PgSQLEngine(instance=self.ins)
-            execute_result = new_engine.execute_workflow(workflow=wf)
-            self.assertIsInstance(execute_result, ReviewSet)
-            self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        new_engine = PgSQLEngine(instance=self.ins)
+        execute_result = new_engine.execute_workflow(workflow=wf)
+        self.assertEqual(execute_result['some_db'][0]['stagestatus'], 'Execute Failed')
+        self.assertEqual(execute_result['some_db'][0].keys(), row.__dict__.keys())
 
 
 class TestModel(TestCase):
@@ -899,6 +1064,52 @@ class TestModel(TestCase):
         brand_new_review_set = ReviewSet()
         self.assertEqual(brand_new_review_set.rows, [])
 
+    def test_review_result_slots(self):
+        """ReviewResult无实例字典，__dict__和to_dict返回全部字段"""
+        row = ReviewResult(id=1, sql='select 1', full_sql='select 1')
+        with self.assertRaises(AttributeError):
+            row.full_sql = 'select 1'
+        self.assertEqual(row.__dict__, row.to_dict())
+        self.assertEqual(list(row.to_dict()), list(ReviewResult.__slots__))
+        self.assertEqual(ReviewSet(rows=[row]).to_dict(), [row.to_dict()])
+
+    def test_columnar_rows(self):
+        """按列存储，数值列使用array，类型不一致时转换为list"""
+        rows = [(1, 'a', 1.5), (2, None, 2.5), (3, 'c', 'x')]
+        result_set = ResultSet(rows=list(rows), column_list=['id', 'name', 'v']).to_columnar()
+        columns = result_set.rows.columns
+        self.assertEqual([type(column).__name__ for column in columns], ['array', 'list', 'list'])
+        self.assertEqual(result_set.rows, rows)
+        self.assertEqual(result_set.rows[-1][1:], ['c', 'x'])
+        self.assertEqual(result_set.rows[1:], rows[1:])
+        self.assertEqual(result_set.to_dict()[0], {'id': 1, 'name': 'a', 'v': 1.5})
+        with self.assertRaises(IndexError):
+            result_set.rows[3]
+
+    def test_columnar_rows_mixed_type(self):
+        """数值列出现其他类型的值时转换为list，保留原始值和类型"""
+        rows = [(1.5, 1, 2 ** 63), (3, True, 1), (True, 2, 2)]
+        columnar_rows = ColumnarRows(3, rows)
+        self.assertEqual([type(column).__name__ for column in columnar_rows.columns], ['list', 'list', 'list'])
+        self.assertEqual([[type(value) for value in row] for row in columnar_rows],
+                         [[type(value) for value in row] for row in rows])
+        self.assertEqual(columnar_rows, rows)
+
+    def test_columnar_rows_memory(self):
+        """10万行结果集按列存储的内存占用"""
+        import tracemalloc
+
+        def traced(build):
+            tracemalloc.start()
+            rows = build()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return rows, size
+
+        _, row_size = traced(lambda: [(i, 'name', i * 1.5) for i in range(100000)])
+        _, columnar_size = traced(lambda: ColumnarRows(3, ((i, 'name', i * 1.5) for i in range(100000))))
+        self.assertLess(columnar_size, row_size / 3)
+
 
 class TestInception(TestCase):
     def setUp(self):
@@ -916,7 +1127,7 @@ class TestInception(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=self.wf)
@@ -1113,7 +1324,7 @@ class TestGoInception(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=self.wf)
@@ -1257,7 +1468,7 @@ class TestOracle(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=self.wf)
@@ -1268,27 +1479,31 @@ class TestOracle(TestCase):
         self.sys_config.purge()
         SqlWorkflow.objects.all().delete()
         SqlWorkflowContent.objects.all().delete()
+        close_pools()
+        _server_versions.clear()
 
     @patch('cx_Oracle.makedsn')
-    @patch('cx_Oracle.connect')
-    def test_get_connection(self, _connect, _makedsn):
+    @patch('cx_Oracle.SessionPool')
+    def test_get_connection(self, _pool, _makedsn):
         # 填写 sid 测试
+        _makedsn.return_value = 'sid_dsn'
         new_engine = OracleEngine(self.ins)
         new_engine.get_connection()
-        _connect.assert_called_once()
+        _pool.return_value.acquire.assert_called_once()
         _makedsn.assert_called_once()
         # 填写 service_name 测试
-        _connect.reset_mock()
+        _pool.reset_mock()
         _makedsn.reset_mock()
+        _makedsn.return_value = 'service_dsn'
         self.ins.service_name = 'some_service'
         self.ins.sid = ''
         self.ins.save()
         new_engine = OracleEngine(self.ins)
         new_engine.get_connection()
-        _connect.assert_called_once()
+        _pool.return_value.acquire.assert_called_once()
         _makedsn.assert_called_once()
         # 都不填写, 检测 ValueError
-        _connect.reset_mock()
+        _pool.reset_mock()
         _makedsn.reset_mock()
         self.ins.service_name = ''
         self.ins.sid = ''
@@ -1297,34 +1512,52 @@ class TestOracle(TestCase):
         with self.assertRaises(ValueError):
             new_engine.get_connection()
 
-    @patch('cx_Oracle.connect')
-    def test_engine_base_info(self, _conn):
+    @patch('cx_Oracle.SessionPool')
+    def test_engine_base_info(self, _pool):
         new_engine = OracleEngine(instance=self.ins)
         self.assertEqual(new_engine.name, 'Oracle')
         self.assertEqual(new_engine.info, 'Oracle engine')
-        _conn.return_value.version = '12.1.0.2.0'
+        _pool.return_value.acquire.return_value.version = '12.1.0.2.0'
         self.assertTupleEqual(new_engine.server_version, ('12', '1', '0'))
-
-    @patch('cx_Oracle.connect.cursor.execute')
-    @patch('cx_Oracle.connect.cursor')
-    @patch('cx_Oracle.connect')
-    def test_query(self, _conn, _cursor, _execute):
-        _conn.return_value.cursor.return_value.fetchmany.return_value = [(1,)]
+        # 获取版本的连接随即归还，之后使用记录的版本
+        _pool.return_value.release.assert_called_once()
+        self.assertTupleEqual(OracleEngine(instance=self.ins).server_version, ('12', '1', '0'))
+        _pool.return_value.acquire.assert_called_once()
+
+    @patch('cx_Oracle.SessionPool')
+    def test_query(self, _pool):
+        _pool.return_value.acquire.return_value.cursor.return_value.fetchmany.return_value = [(1,)]
         new_engine = OracleEngine(instance=self.ins)
         query_result = new_engine.query(db_name='archery', sql='select 1', limit_num=100)
         self.assertIsInstance(query_result, ResultSet)
         self.assertListEqual(query_result.rows, [(1,)])
 
-    @patch('cx_Oracle.connect.cursor.execute')
-    @patch('cx_Oracle.connect.cursor')
-    @patch('cx_Oracle.connect')
-    def test_query_not_limit(self, _conn, _cursor, _execute):
-        _conn.return_value.cursor.return_value.fetchall.return_value = [(1,)]
+    @patch('cx_Oracle.SessionPool')
+    def test_query_not_limit(self, _pool):
+        _pool.return_value.acquire.return_value.cursor.return_value.fetchall.return_value = [(1,)]
         new_engine = OracleEngine(instance=self.ins)
         query_result = new_engine.query(db_name=0, sql='select 1', limit_num=0)
         self.assertIsInstance(query_result, ResultSet)
         self.assertListEqual(query_result.rows, [(1,)])
 
+    @patch('cx_Oracle.SessionPool')
+    def test_query_lob(self, _pool):
+        """按限制行数获取，CLOB只读取上限内的字符"""
+        cursor = _pool.return_value.acquire.return_value.cursor.return_value
+        cursor.fetchmany.return_value = [(1, 'abc')]
+        self.sys_config.set('oracle_lob_max_size', '2')
+        new_engine = OracleEngine(instance=self.ins)
+        query_result = new_engine.query(sql='select id, content from t', limit_num=10)
+        self.assertListEqual(query_result.rows, [(1, 'abc')])
+        self.assertEqual(cursor.arraysize, 10)
+        cursor.fetchmany.assert_called_once_with(10)
+        cursor.fetchall.assert_not_called()
+        cursor.outputtypehandler(cursor, 'content', cx_Oracle.CLOB, 0, 0, 0)
+        outconverter = cursor.var.call_args[1]['outconverter']
+        lob = MagicMock()
+        outconverter(lob)
+        lob.read.assert_called_once_with(1, 2)
+
     @patch('sql.engines.oracle.OracleEngine.query',
            return_value=ResultSet(rows=[('AUD_SYS',), ('archery',), ('ANONYMOUS',)]))
     def test_get_all_databases(self, _query):
@@ -1404,29 +1637,37 @@ class TestOracle(TestCase):
                              {'msg': '禁止使用 + 关键词\n', 'bad_query': True, 'filtered_sql': sql.strip(';'),
                               'has_star': False})
 
-    def test_filter_sql_with_delimiter(self):
+    @patch('sql.engines.oracle.OracleEngine.get_connection')
+    def test_filter_sql_with_delimiter(self, _conn):
         sql = "select * from xx;"
         new_engine = OracleEngine(instance=self.ins)
-        check_result = new_engine.filter_sql(sql=sql, limit_num=100)
-        self.assertEqual(check_result, "select * from xx WHERE ROWNUM <= 100")
-
-    def test_filter_sql_with_delimiter_and_where(self):
-        sql = "select * from xx where id>1;"
+        with patch.dict('sql.engines.oracle._server_versions', {new_engine._version_key: ('12', '1', '0')}):
+            check_result = new_engine.filter_sql(sql=sql, limit_num=100)
+        self.assertEqual(check_result, "select * from xx FETCH FIRST 100 ROWS ONLY")
+        _conn.assert_not_called()
+
+    @patch('sql.engines.oracle.OracleEngine.get_connection')
+    def test_filter_sql_with_delimiter_and_where(self, _conn):
+        """低版本或未记录版本时嵌套子查询，排序后再限制行数，不获取连接"""
+        sql = "select * from xx where id>1 order by id;"
         new_engine = OracleEngine(instance=self.ins)
         check_result = new_engine.filter_sql(sql=sql, limit_num=100)
-        self.assertEqual(check_result, "select * from xx where id>1 AND ROWNUM <= 100")
+        self.assertEqual(check_result, "SELECT * FROM (select * from xx where id>1 order by id) WHERE ROWNUM <= 100")
+        with patch.dict('sql.engines.oracle._server_versions', {new_engine._version_key: ('11', '2', '0')}):
+            self.assertEqual(new_engine.filter_sql(sql=sql, limit_num=100), check_result)
+        _conn.assert_not_called()
 
     def test_filter_sql_without_delimiter(self):
-        sql = "select * from xx;"
+        sql = "select * from xx where rownum <= 10"
         new_engine = OracleEngine(instance=self.ins)
         check_result = new_engine.filter_sql(sql=sql, limit_num=100)
-        self.assertEqual(check_result, "select * from xx WHERE ROWNUM <= 100")
+        self.assertEqual(check_result, "select * from xx where rownum <= 10")
 
     def test_filter_sql_with_limit(self):
-        sql = "select * from xx limit 10;"
+        sql = "select * from xx fetch first 10 rows only;"
         new_engine = OracleEngine(instance=self.ins)
         check_result = new_engine.filter_sql(sql=sql, limit_num=1)
-        self.assertEqual(check_result, "select * from xx limit 10 WHERE ROWNUM <= 1")
+        self.assertEqual(check_result, "select * from xx fetch first 10 rows only;")
 
     def test_query_masking(self):
         query_result = ResultSet()
@@ -1473,10 +1714,8 @@ class TestOracle(TestCase):
         self.assertIsInstance(check_result, ReviewSet)
         self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
 
-    @patch('cx_Oracle.connect.cursor.execute')
-    @patch('cx_Oracle.connect.cursor')
-    @patch('cx_Oracle.connect')
-    def test_execute_workflow_success(self, _conn, _cursor, _execute):
+    @patch('cx_Oracle.SessionPool')
+    def test_execute_workflow_success(self, _pool):
         sql = 'update user set id=1'
         row = ReviewResult(id=1,
                            errlevel=0,
@@ -1496,19 +1735,17 @@ class TestOracle(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
         new_engine = OracleEngine(instance=self.ins)
         execute_result = new_engine.execute_workflow(workflow=wf)
-        self.assertIsInstance(execute_result, ReviewSet)
-        self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        self.assertEqual(list(execute_result), ['some_db'])
+        self.assertEqual(execute_result['some_db'][0].keys(), row.__dict__.keys())
 
-    @patch('cx_Oracle.connect.cursor.execute')
-    @patch('cx_Oracle.connect.cursor')
-    @patch('cx_Oracle.connect', return_value=RuntimeError)
-    def test_execute_workflow_exception(self, _conn, _cursor, _execute):
+    @patch('cx_Oracle.SessionPool', return_value=RuntimeError)
+    def test_execute_workflow_exception(self, _pool):
         sql = 'update user set id=1'
         row = ReviewResult(id=1,
                            errlevel=2,
@@ -1527,15 +1764,14 @@ class TestOracle(TestCase):
             status='workflow_finish',
             is_backup=True,
             instance=self.ins,
-            db_name='some_db',
+            db_names='some_db',
             syntax_type=1
         )
         SqlWorkflowContent.objects.create(workflow=wf, sql_content=sql)
-        with self.assertRaises(AttributeError):
-            new_engine = OracleEngine(instance=self.ins)
-            execute_result = new_engine.execute_workflow(workflow=wf)
-            self.assertIsInstance(execute_result, ReviewSet)
-            self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        new_engine = OracleEngine(instance=self.ins)
+        execute_result = new_engine.execute_workflow(workflow=wf)
+        self.assertEqual(execute_result['some_db'][0]['stagestatus'], 'Execute Failed')
+        self.assertEqual(execute_result['some_db'][0].keys(), row.__dict__.keys())
 
 
 class MongoTest(TestCase):
@@ -1547,9 +1783,11 @@ class MongoTest(TestCase):
     def tearDown(self) -> None:
         self.ins.delete()
 
+    @patch.dict('sql.engines.mongo._clients', clear=True)
     @patch('sql.engines.mongo.pymongo')
     def test_get_connection(self, mock_pymongo):
         _ = self.engine.get_connection()
+        _ = MongoEngine(instance=self.ins).get_connection()
         mock_pymongo.MongoClient.assert_called_once()
 
     @patch('sql.engines.mongo.MongoEngine.get_connection')
@@ -1563,6 +1801,38 @@ class MongoTest(TestCase):
         check_result = self.engine.query_check(sql=test_sql)
         self.assertEqual(False, check_result.get('bad_query'))
 
+    def test_query_check_aggregate(self):
+        check_result = self.engine.query_check(sql='test.aggregate([{"$group": {"_id": "$id"}}])')
+        self.assertEqual(False, check_result.get('bad_query'))
+        check_result = self.engine.query_check(sql='test.aggregate([{"$match": {}}, {"$out": "t2"}])')
+        self.assertEqual(True, check_result.get('bad_query'))
+        check_result = self.engine.query_check(sql='test.drop()')
+        self.assertEqual(True, check_result.get('bad_query'))
+
+    @patch('sql.engines.mongo.MongoEngine.get_connection')
+    def test_query_find(self, mock_get_connection):
+        """过滤条件、投影和条数下推，结果逐个序列化"""
+        collect = mock_get_connection.return_value['some_db']['test']
+        cursor = collect.find.return_value.limit.return_value.batch_size.return_value
+        cursor.__enter__.return_value = cursor
+        cursor.__iter__.return_value = iter([{'id': 2, 'name': '中文'}])
+        result = self.engine.query('some_db', 'test.find({"id":{"$gt":1.0}}, {"name": 1})', limit_num=10)
+        collect.find.assert_called_once_with({'id': {'$gt': 1.0}}, {'name': 1})
+        collect.find.return_value.limit.assert_called_once_with(10)
+        self.assertEqual(result.rows, (['{"id": 2, "name": "中文"}'],))
+
+    @patch('sql.engines.mongo.MongoEngine.get_connection')
+    def test_query_aggregate(self, mock_get_connection):
+        collect = mock_get_connection.return_value['some_db']['test']
+        cursor = collect.aggregate.return_value
+        cursor.__enter__.return_value = cursor
+        cursor.__iter__.return_value = iter([{'_id': 1, 'count': 3}])
+        result = self.engine.query('some_db', 'test.aggregate([{"$group": {"_id": "$id", "count": {"$sum": 1}}}])',
+                                   limit_num=100)
+        collect.aggregate.assert_called_once_with(
+            [{'$group': {'_id': '$id', 'count': {'$sum': 1}}}, {'$limit': 100}], batchSize=100)
+        self.assertEqual(result.affected_rows, 1)
+
     @patch('sql.engines.mongo.MongoEngine.get_connection')
     def test_get_all_databases(self, mock_get_connection):
         db_list = self.engine.get_all_databases()
@@ -3,6 +3,7 @@ import asyncio
 import os
 import re
 import time
+import traceback
 
 import simplejson as json
 from django.conf import settings
@@ -10,12 +11,11 @@ from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse
 from django.views.decorators.cache import cache_page
 
-from common.config import SysConfig
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from common.utils.get_logger import get_logger
 from sql.engines import get_engine
-from sql.plugins.schemasync import SchemaSync
 from sql.utils.async_tasks import async_tasks
+from sql.utils.schema_diff import schema_diff
 from .models import Instance, ParamTemplate, ParamHistory
 
 logger = get_logger()
@@ -184,7 +184,7 @@ def schemasync(request):
     sync_comments = True if request.POST.get('sync_comments') == 'true' else False
     result = {'status': 0, 'msg': 'ok', 'data': {'diff_stdout': '', 'patch_stdout': '', 'revert_stdout': ''}}
 
-    # 循环对比全部数据库
+    # 对比两个实例中全部同名数据库
     if db_name == 'all' or target_db_name == 'all':
         db_name = '*'
         target_db_name = '*'
@@ -193,67 +193,30 @@ def schemasync(request):
     instance_info = Instance.objects.get(instance_name=instance_name)
     target_instance_info = Instance.objects.get(instance_name=target_instance_name)
 
-    # 检查SchemaSync程序路径
-    path = SysConfig().get('schemasync')
-    if path is None:
+    # 对比并生成变更、回滚语句
+    try:
+        diff_result = schema_diff(instance_info, db_name, target_instance_info, target_db_name,
+                                  sync_auto_inc=sync_auto_inc, sync_comments=sync_comments)
+    except Exception as e:
+        logger.error(f'表结构对比失败，错误信息：{traceback.format_exc()}')
         result['status'] = 1
-        result['msg'] = '请配置SchemaSync路径！'
+        result['msg'] = str(e)
         return HttpResponse(json.dumps(result), content_type='application/json')
+    diff_stdout = '\n'.join(diff_result['diff'])
+    patch_sql = '\n\n'.join(diff_result['patch'])
+    revert_sql = '\n\n'.join(diff_result['revert'])
 
-    # 提交给SchemaSync获取对比结果
-    schema_sync = SchemaSync()
-    # 准备参数
+    # 保存到文件
     tag = int(time.time())
+    date = time.strftime("%Y%m%d", time.localtime())
     output_directory = os.path.join(settings.BASE_DIR, 'downloads/schemasync/')
     os.makedirs(output_directory, exist_ok=True)
-    args = {
-        "sync-auto-inc": sync_auto_inc,
-        "sync-comments": sync_comments,
-        "tag": tag,
-        "output-directory": output_directory,
-        "source": r"mysql://{user}:'{pwd}'@{host}:{port}/{database}".format(user=instance_info.user,
-                                                                            pwd=instance_info.password,
-                                                                            host=instance_info.host,
-                                                                            port=instance_info.port,
-                                                                            database=db_name),
-        "target": r"mysql://{user}:'{pwd}'@{host}:{port}/{database}".format(user=target_instance_info.user,
-                                                                            pwd=target_instance_info.password,
-                                                                            host=target_instance_info.host,
-                                                                            port=target_instance_info.port,
-                                                                            database=target_db_name)
-    }
-    # 参数检查
-    args_check_result = schema_sync.check_args(args)
-    if args_check_result['status'] == 1:
-        return HttpResponse(json.dumps(args_check_result), content_type='application/json')
-    # 参数转换
-    cmd_args = schema_sync.generate_args2cmd(args, shell=True)
-    # 执行命令
-    try:
-        stdout, stderr = schema_sync.execute_cmd(cmd_args, shell=True).communicate()
-        diff_stdout = f'{stdout}{stderr}'
-    except RuntimeError as e:
-        diff_stdout = str(e)
-
-    # 非全部数据库对比可以读取对比结果并在前端展示
-    if db_name != '*':
-        date = time.strftime("%Y%m%d", time.localtime())
-        patch_sql_file = '%s%s_%s.%s.patch.sql' % (output_directory, target_db_name, tag, date)
-        revert_sql_file = '%s%s_%s.%s.revert.sql' % (output_directory, target_db_name, tag, date)
-        try:
-            with open(patch_sql_file, 'r') as f:
-                patch_sql = f.read()
-        except FileNotFoundError as e:
-            patch_sql = str(e)
-        try:
-            with open(revert_sql_file, 'r') as f:
-                revert_sql = f.read()
-        except FileNotFoundError as e:
-            revert_sql = str(e)
-        result['data'] = {'diff_stdout': diff_stdout, 'patch_stdout': patch_sql, 'revert_stdout': revert_sql}
-    else:
-        result['data'] = {'diff_stdout': diff_stdout, 'patch_stdout': '', 'revert_stdout': ''}
-
+    file_db_name = 'all' if target_db_name == '*' else target_db_name
+    with open(f'{output_directory}{file_db_name}_{tag}.{date}.patch.sql', 'w') as f:
+        f.write(patch_sql)
+    with open(f'{output_directory}{file_db_name}_{tag}.{date}.revert.sql', 'w') as f:
+        f.write(revert_sql)
+    result['data'] = {'diff_stdout': diff_stdout, 'patch_stdout': patch_sql, 'revert_stdout': revert_sql}
     return HttpResponse(json.dumps(result), content_type='application/json')
 
 
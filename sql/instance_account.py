@@ -11,6 +11,69 @@ from sql.engines import get_engine
 from sql.utils.resource_group import user_instances
 from .models import Instance, InstanceAccount
 
+# 全局、库、表、列权限，对应SHOW GRANTS中的各个授权级别
+SQL_GET_GRANTS = """SELECT GRANTEE, '*', '*', '', PRIVILEGE_TYPE, IS_GRANTABLE FROM information_schema.USER_PRIVILEGES
+UNION ALL
+SELECT GRANTEE, TABLE_SCHEMA, '*', '', PRIVILEGE_TYPE, IS_GRANTABLE FROM information_schema.SCHEMA_PRIVILEGES
+UNION ALL
+SELECT GRANTEE, TABLE_SCHEMA, TABLE_NAME, '', PRIVILEGE_TYPE, IS_GRANTABLE FROM information_schema.TABLE_PRIVILEGES
+UNION ALL
+SELECT GRANTEE, TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, PRIVILEGE_TYPE, IS_GRANTABLE
+FROM information_schema.COLUMN_PRIVILEGES;"""
+# 存储过程、代理、角色授权不在上述权限视图中，存在这些授权的用户仍使用SHOW GRANTS获取
+SQL_GET_ROUTINE_PROXY_GRANTEES = """SELECT User, Host FROM mysql.procs_priv
+UNION SELECT User, Host FROM mysql.proxies_priv;"""
+# 角色授权表仅MySQL 8.0存在
+SQL_GET_ROLE_GRANTEES = "SELECT TO_USER, TO_HOST FROM mysql.role_edges;"
+
+
+def user_grants(rows):
+    """
+    将权限表的明细行合并为授权语句，与SHOW GRANTS的格式一致，不包含存储过程和角色授权
+    :param rows: SQL_GET_GRANTS的查询结果
+    :return: {grantee: [授权语句]}
+    """
+    objects = {}
+    for grantee, schema, table, column, privilege, grantable in rows:
+        obj = objects.setdefault((grantee, schema, table), {'privileges': {}, 'grantable': False})
+        # 同一权限的表级和列级授权分别显示，如SELECT, SELECT (`c1`)，与SHOW GRANTS一致
+        columns = obj['privileges'].setdefault((privilege, bool(column)), [])
+        if column:
+            columns.append(f'`{column}`')
+        obj['grantable'] = obj['grantable'] or grantable == 'YES'
+    grants = {}
+    for (grantee, schema, table), obj in objects.items():
+        privileges = obj['privileges']
+        # 存在其他权限时USAGE不显示
+        if len(privileges) > 1:
+            privileges.pop(('USAGE', False), None)
+        privileges = ', '.join(f"{p} ({', '.join(columns)})" if column_level else p
+                               for (p, column_level), columns in privileges.items())
+        on = '*.*' if schema == '*' else f"`{schema}`.{'*' if table == '*' else f'`{table}`'}"
+        grant = f'GRANT {privileges} ON {on} TO {grantee}'
+        grants.setdefault(grantee, []).append(grant + (' WITH GRANT OPTION' if obj['grantable'] else ''))
+    return grants
+
+
+def instance_grants(query_engine):
+    """
+    获取实例全部用户的授权语句，存在存储过程、代理、角色授权的用户使用SHOW GRANTS的结果
+    :param query_engine: MySQL引擎，需由调用方关闭连接
+    :return: ({grantee: [授权语句]}, 错误信息)
+    """
+    grants_result = query_engine.query('information_schema', SQL_GET_GRANTS, close_conn=False)
+    if grants_result.error:
+        return {}, grants_result.error
+    grants = user_grants(grants_result.rows)
+    grantees = set(query_engine.query('mysql', SQL_GET_ROUTINE_PROXY_GRANTEES, close_conn=False).rows)
+    # MySQL 8.0以下不存在角色授权表，查询报错时忽略
+    grantees.update(query_engine.query('mysql', SQL_GET_ROLE_GRANTEES, close_conn=False).rows)
+    for user, host in grantees:
+        show_grants = query_engine.query('mysql', f'show grants for `{user}`@`{host}`;', close_conn=False)
+        if not show_grants.error:
+            grants[f"'{user}'@'{host}'"] = [row[0] for row in show_grants.rows]
+    return grants, None
+
 
 @permission_required('sql.menu_instance_account', raise_exception=True)
 def users(request):
@@ -33,19 +96,21 @@ def users(request):
     # 获取所有用户
     sql_get_user = "select concat('`', user, '`', '@', '`', host,'`') as query,user,host from mysql.user;"
     query_engine = get_engine(instance=instance)
-    query_result = query_engine.query('mysql', sql_get_user)
-    if not query_result.error:
-        db_users = query_result.rows
-        # 获取用户权限信息
+    query_result = query_engine.query('mysql', sql_get_user, close_conn=False)
+    grants, error = {}, query_result.error
+    if not error:
+        # 一次获取全部用户权限信息
+        grants, error = instance_grants(query_engine)
+    if error:
+        result = {'status': 1, 'msg': error}
+    else:
         rows = []
-        for db_user in db_users:
-            user_host = db_user[0]
-            user_priv = query_engine.query('mysql', 'show grants for {};'.format(user_host), close_conn=False).rows
+        for user_host, user, host in query_result.rows:
             row = {
                 'user_host': user_host,
-                'user': db_user[1],
-                'host': db_user[2],
-                'privileges': user_priv,
+                'user': user,
+                'host': host,
+                'privileges': grants.get(f"'{user}'@'{host}'", []),
                 'saved': False
             }
             # 合并数据
@@ -57,8 +122,6 @@ def users(request):
             rows = [row for row in rows if row['saved']]
 
         result = {'status': 0, 'msg': 'ok', 'rows': rows}
-    else:
-        result = {'status': 1, 'msg': query_result.error}
 
     # 关闭连接
     query_engine.close()
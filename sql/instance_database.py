@@ -46,20 +46,19 @@ WHERE SCHEMA_NAME NOT IN ('information_schema', 'performance_schema', 'mysql', '
     query_result = query_engine.query('information_schema', sql_get_db, close_conn=False)
     if not query_result.error:
         dbs = query_result.rows
-        # 获取数据库关联用户信息
+        # 一次获取全部数据库关联用户信息
+        sql_get_bind_users = """SELECT DISTINCT TABLE_SCHEMA, GRANTEE FROM information_schema.SCHEMA_PRIVILEGES;"""
+        bind_users = dict()
+        for db_name, grantee in query_engine.query('information_schema', sql_get_bind_users, close_conn=False).rows:
+            bind_users.setdefault(db_name, []).append(grantee)
         rows = []
         for db in dbs:
             db_name = db[0]
-            sql_get_bind_users = f"""select group_concat(distinct(GRANTEE)),TABLE_SCHEMA
-from information_schema.SCHEMA_PRIVILEGES
-where TABLE_SCHEMA='{db_name}'
-group by TABLE_SCHEMA;"""
-            bind_users = query_engine.query('information_schema', sql_get_bind_users, close_conn=False).rows
             row = {
                 'db_name': db_name,
                 'charset': db[1],
                 'collation': db[2],
-                'grantees': bind_users[0][0].split(',') if bind_users else [],
+                'grantees': bind_users.get(db_name, []),
                 'saved': False
             }
             # 合并数据
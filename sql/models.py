@@ -1,4 +1,6 @@
 # -*- coding: UTF-8 -*-
+import datetime
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from mirage import fields
@@ -188,7 +190,7 @@ class SqlWorkflow(models.Model):
     audit_auth_groups = models.CharField('审批权限组列表', max_length=255)
     run_date_start = models.DateTimeField('可执行起始时间', null=True, blank=True)
     run_date_end = models.DateTimeField('可执行结束时间', null=True, blank=True)
-    create_time = models.DateTimeField('创建时间', auto_now_add=True)
+    create_time = models.DateTimeField('创建时间', auto_now_add=True, db_index=True)
     finish_time = models.DateTimeField('结束时间', null=True, blank=True)
     is_manual = models.IntegerField('是否原生执行', choices=((0, '否'), (1, '是')), default=0)
 
@@ -198,6 +200,7 @@ class SqlWorkflow(models.Model):
     class Meta:
         managed = True
         db_table = 'sql_workflow'
+        index_together = [('status', 'id'), ('group_id', 'id'), ('engineer', 'id')]
         verbose_name = u'SQL工单'
         verbose_name_plural = u'SQL工单'
 
@@ -222,6 +225,23 @@ class SqlWorkflowContent(models.Model):
         verbose_name_plural = u'SQL工单内容'
 
 
+class SqlWorkflowContentArchive(models.Model):
+    """
+    已归档的SQL工单内容，由归档任务从sql_workflow_content按主键批量迁移，工单详情页读取不到时从此表获取
+    """
+    id = models.IntegerField(primary_key=True)
+    workflow_id = models.IntegerField('工单ID', unique=True)
+    sql_content = models.TextField('具体sql内容')
+    review_content = models.TextField('自动审核内容的JSON格式')
+    execute_result = models.TextField('执行结果的JSON格式', blank=True)
+
+    class Meta:
+        managed = True
+        db_table = 'sql_workflow_content_archive'
+        verbose_name = u'SQL工单内容归档'
+        verbose_name_plural = u'SQL工单内容归档'
+
+
 workflow_type_choices = ((1, _('sql_query')), (2, _('sql_review')))
 workflow_status_choices = ((0, '待审核'), (1, '审核通过'), (2, '审核不通过'), (3, '审核取消'))
 
@@ -253,6 +273,7 @@ class WorkflowAudit(models.Model):
         managed = True
         db_table = 'workflow_audit'
         unique_together = ('workflow_id', 'workflow_type')
+        index_together = ('current_status', 'current_audit', 'group_id')
         verbose_name = u'工作流审批列表'
         verbose_name_plural = u'工作流审批列表'
 
@@ -403,16 +424,49 @@ class QueryLog(models.Model):
     masking = models.BooleanField('查询结果是否正常脱敏', choices=((False, '否'), (True, '是'),), default=False)
     favorite = models.BooleanField('是否收藏', choices=((False, '否'), (True, '是'),), default=False)
     alias = models.CharField('语句标识', max_length=64, default='', blank=True)
-    create_time = models.DateTimeField('操作时间', auto_now_add=True)
+    timings = models.CharField('各阶段耗时(毫秒)', max_length=1000, default='', blank=True)
+    # 异步批量写入时保留查询发生的时间，不使用auto_now_add
+    create_time = models.DateTimeField('操作时间', default=datetime.datetime.now, db_index=True)
     sys_time = models.DateTimeField(auto_now=True)
 
     class Meta:
         managed = True
         db_table = 'query_log'
+        index_together = ('username', 'id')
         verbose_name = u'查询日志'
         verbose_name_plural = u'查询日志'
 
 
+class QueryLogArchive(models.Model):
+    """
+    已归档的查询日志，由归档任务从query_log按主键批量迁移，保留原主键
+    表结构与升级脚本中CREATE TABLE ... LIKE query_log一致
+    """
+    id = models.IntegerField(primary_key=True)
+    instance_name = models.CharField('实例名称', max_length=50)
+    db_name = models.CharField('数据库名称', max_length=64)
+    sqllog = models.TextField('执行的查询语句')
+    effect_row = models.BigIntegerField('返回行数')
+    cost_time = models.CharField('执行耗时', max_length=10, default='')
+    username = models.CharField('操作人', max_length=30)
+    user_display = models.CharField('操作人中文名', max_length=50, default='')
+    priv_check = models.BooleanField('查询权限是否正常校验', choices=((False, '跳过'), (True, '正常'),), default=False)
+    hit_rule = models.BooleanField('查询是否命中脱敏规则', choices=((False, '未命中/未知'), (True, '命中')), default=False)
+    masking = models.BooleanField('查询结果是否正常脱敏', choices=((False, '否'), (True, '是'),), default=False)
+    favorite = models.BooleanField('是否收藏', choices=((False, '否'), (True, '是'),), default=False)
+    alias = models.CharField('语句标识', max_length=64, default='', blank=True)
+    timings = models.CharField('各阶段耗时(毫秒)', max_length=1000, default='', blank=True)
+    create_time = models.DateTimeField('操作时间', db_index=True)
+    sys_time = models.DateTimeField()
+
+    class Meta:
+        managed = True
+        db_table = 'query_log_archive'
+        index_together = ('username', 'id')
+        verbose_name = u'查询日志归档'
+        verbose_name_plural = u'查询日志归档'
+
+
 rule_type_choices = ((1, '手机号'), (2, '证件号码'), (3, '银行卡'), (4, '邮箱'), (5, '金额'), (6, '其他'))
 
 
@@ -752,3 +806,63 @@ class SlowQueryHistory(models.Model):
         index_together = ('hostname_max', 'ts_min')
         verbose_name = u'慢日志明细'
         verbose_name_plural = u'慢日志明细'
+
+
+class WorkflowStatsDaily(models.Model):
+    """
+    SQL上线工单按天汇总，由定时任务增量维护，用于dashboard报表
+    """
+    stat_date = models.DateField('统计日期', db_index=True)
+    group_id = models.IntegerField('组ID')
+    group_name = models.CharField('组名称', max_length=100)
+    engineer_display = models.CharField('发起人中文名', max_length=50, default='')
+    syntax_type = models.IntegerField('工单类型 0、未知，1、DDL，2、DML', default=0)
+    workflow_cnt = models.IntegerField('工单数量', default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'stats_workflow_daily'
+        verbose_name = u'SQL工单日汇总'
+        verbose_name_plural = u'SQL工单日汇总'
+
+
+class QueryLogStatsDaily(models.Model):
+    """
+    查询日志按天汇总，由定时任务增量维护，用于dashboard报表
+    """
+    stat_date = models.DateField('统计日期', db_index=True)
+    user_display = models.CharField('操作人中文名', max_length=50, default='')
+    db_name = models.CharField('数据库名称', max_length=64)
+    query_cnt = models.IntegerField('查询次数', default=0)
+    effect_row_sum = models.BigIntegerField('返回行数', default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'stats_query_log_daily'
+        verbose_name = u'查询日志日汇总'
+        verbose_name_plural = u'查询日志日汇总'
+
+
+class SlowQueryStatsDaily(models.Model):
+    """
+    慢日志按SQL指纹、实例、库、天汇总，由定时任务增量维护，用于慢日志趋势图
+    """
+    checksum = models.CharField(max_length=32)
+    hostname_max = models.CharField(max_length=64)
+    db_max = models.CharField(max_length=64, null=True, default=None)
+    stat_date = models.DateField('统计日期')
+    ts_max = models.DateTimeField('最后出现时间', null=True)
+    ts_cnt = models.FloatField('执行次数', default=0)
+    query_time_sum = models.FloatField('执行总时长', default=0)
+    query_time_max = models.FloatField('最大执行时长', default=0)
+    query_time_pct_95 = models.FloatField('95%执行时长', default=0)
+    lock_time_sum = models.FloatField('锁定总时长', default=0)
+    rows_examined_sum = models.FloatField('扫描总行数', default=0)
+    rows_sent_sum = models.FloatField('返回总行数', default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'stats_slow_query_daily'
+        index_together = [('checksum', 'stat_date'), ('hostname_max', 'stat_date')]
+        verbose_name = u'慢日志日汇总'
+        verbose_name_plural = u'慢日志日汇总'
@@ -8,15 +8,20 @@ import traceback
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.db import connection, OperationalError
-from django.db.models import Q
 from django.http import HttpResponse
 from common.config import SysConfig
-from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime
-from common.utils.timer import FuncTimer
+from common.utils.extend_json_encoder import ExtendJSONEncoder
+from common.utils.columnar_response import query_response
+from common.utils.pagination import search_filter, approximate_count, keyset_page, keyset_page_union
+from common.utils.metrics import observe_query_spans
+from common.utils.timer import FuncTimer, SpanRecorder
 from sql.query_privileges import query_priv_check
+from sql.utils.archive import restore_query_log
+from sql.utils.query_log import save_query_log
 from sql.utils.resource_group import user_instances
 from sql.utils.tasks import add_kill_conn_schedule, del_schedule
-from .models import QueryLog, Instance
+from sql.utils import tenant_query
+from .models import QueryLog, QueryLogArchive, Instance
 from sql.engines import get_engine
 
 logger = logging.getLogger('default')
@@ -35,10 +40,13 @@ def query(request):
     limit_num = int(request.POST.get('limit_num', 0))
     schema_name = request.POST.get('schema_name', None)
     user = request.user
+    # 各阶段耗时
+    spans = SpanRecorder()
 
     result = {'status': 0, 'msg': 'ok', 'data': {}}
     try:
-        instance = user_instances(request.user).get(instance_name=instance_name)
+        with spans.span('user_instances'):
+            instance = user_instances(request.user).get(instance_name=instance_name)
     except Instance.DoesNotExist:
         result['status'] = 1
         result['msg'] = '你所在组未关联该实例'
@@ -53,8 +61,9 @@ def query(request):
     try:
         config = SysConfig()
         # 查询前的检查，禁用语句检查，语句切分
-        query_engine = get_engine(instance=instance)
-        query_check_info = query_engine.query_check(db_name=db_name, sql=sql_content)
+        with spans.span('query_check'):
+            query_engine = get_engine(instance=instance)
+            query_check_info = query_engine.query_check(db_name=db_name, sql=sql_content)
         if query_check_info.get('bad_query'):
             # 引擎内部判断为 bad_query
             result['status'] = 1
@@ -68,7 +77,8 @@ def query(request):
         sql_content = query_check_info['filtered_sql']
 
         # 查询权限校验，并且获取limit_num
-        priv_check_info = query_priv_check(user, instance, db_name, sql_content, limit_num)
+        with spans.span('priv_check'):
+            priv_check_info = query_priv_check(user, instance, db_name, sql_content, limit_num)
         if priv_check_info['status'] == 0:
             limit_num = priv_check_info['data']['limit_num']
             priv_check = priv_check_info['data']['priv_check']
@@ -80,28 +90,34 @@ def query(request):
         limit_num = 0 if re.match(r"^explain", sql_content.lower()) else limit_num
 
         # 对查询sql增加limit限制或者改写语句
-        sql_content = query_engine.filter_sql(sql=sql_content, limit_num=limit_num)
+        with spans.span('filter_sql'):
+            sql_content = query_engine.filter_sql(sql=sql_content, limit_num=limit_num)
 
         # 先获取查询连接，用于后面查询复用连接以及终止会话
-        query_engine.get_connection(db_name=db_name)
-        thread_id = query_engine.thread_id
+        with spans.span('get_connection'):
+            query_engine.get_connection(db_name=db_name)
+            thread_id = query_engine.thread_id
         max_execution_time = int(config.get('max_execution_time', 60))
         # 执行查询语句，并增加一个定时终止语句的schedule，timeout=max_execution_time
         if thread_id:
             schedule_name = f'query-{time.time()}'
             run_date = (datetime.datetime.now() + datetime.timedelta(seconds=max_execution_time))
-            add_kill_conn_schedule(schedule_name, run_date, instance.id, thread_id)
+            with spans.span('kill_schedule'):
+                add_kill_conn_schedule(schedule_name, run_date, instance.id, thread_id)
         with FuncTimer() as t:
             # 获取主从延迟信息
-            seconds_behind_master = query_engine.seconds_behind_master
-            if instance.db_type == 'pgsql':  # TODO 此处判断待优化，请在 修改传参方式后去除
-                query_result = query_engine.query(db_name, sql_content, limit_num, schema_name=schema_name)
-            else:
-                query_result = query_engine.query(db_name, sql_content, limit_num)
+            with spans.span('seconds_behind_master'):
+                seconds_behind_master = query_engine.seconds_behind_master
+            with spans.span('query'):
+                if instance.db_type == 'pgsql':  # TODO 此处判断待优化，请在 修改传参方式后去除
+                    query_result = query_engine.query(db_name, sql_content, limit_num, schema_name=schema_name)
+                else:
+                    query_result = query_engine.query(db_name, sql_content, limit_num)
         query_result.query_time = t.cost
         # 返回查询结果后删除schedule
         if thread_id:
-            del_schedule(schedule_name)
+            with spans.span('kill_schedule'):
+                del_schedule(schedule_name)
 
         # 查询异常
         if query_result.error:
@@ -110,7 +126,7 @@ def query(request):
         # 数据脱敏，仅对查询无错误的结果集进行脱敏，并且按照query_check配置是否返回
         elif config.get('data_masking'):
             try:
-                with FuncTimer() as t:
+                with FuncTimer() as t, spans.span('masking'):
                     masking_result = query_engine.query_masking(db_name, sql_content, query_result)
                 masking_result.mask_time = t.cost
                 # 脱敏出错
@@ -158,27 +174,136 @@ def query(request):
                 cost_time=query_result.query_time,
                 priv_check=priv_check,
                 hit_rule=query_result.mask_rule_hit,
-                masking=query_result.is_masked
+                masking=query_result.is_masked,
+                timings=json.dumps(spans.timings())
             )
             # 防止查询超时
-            try:
-                query_log.save()
-            except OperationalError:
-                query_engine.close()
-                query_log.save()
+            with spans.span('query_log'):
+                try:
+                    save_query_log(query_log)
+                except OperationalError:
+                    query_engine.close()
+                    save_query_log(query_log)
     except Exception as e:
         logger.error(f'查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
         result['status'] = 1
         result['msg'] = f'查询异常报错，错误信息：{e}'
+    # 返回查询结果，按Accept返回json或按列的格式
+    with spans.span('encode'):
+        response = query_response(request, result)
+    observe_query_spans(instance.instance_name, spans)
+    response['Server-Timing'] = spans.server_timing()
+    return response
+
+
+@permission_required('sql.query_submit', raise_exception=True)
+def query_tenants(request):
+    """
+    多租户查询，同一语句在db_names的每个库执行，返回带db_name列的合并结果或跨库聚合结果
+    :param request:
+    :return:
+    """
+    instance_name = request.POST.get('instance_name')
+    sql_content = request.POST.get('sql_content')
+    db_names = [db_name.strip() for db_name in request.POST.get('db_names', '').split(',') if db_name.strip()]
+    limit_num = int(request.POST.get('limit_num', 0))
+    aggregate = json.loads(request.POST.get('aggregate') or '{}')
+    user = request.user
+
+    result = {'status': 0, 'msg': 'ok', 'data': {}}
+    try:
+        instance = user_instances(request.user).get(instance_name=instance_name)
+    except Instance.DoesNotExist:
+        result['status'] = 1
+        result['msg'] = '你所在组未关联该实例'
         return HttpResponse(json.dumps(result), content_type='application/json')
-    # 返回查询结果
+
+    # 服务器端参数验证
+    if None in [sql_content, instance_name] or not db_names:
+        result['status'] = 1
+        result['msg'] = '页面提交参数可能为空'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    query_engine = get_engine(instance=instance)
     try:
-        return HttpResponse(json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True),
-                            content_type='application/json')
-    # 虽然能正常返回，但是依然会乱码
-    except UnicodeDecodeError:
-        return HttpResponse(json.dumps(result, default=str, bigint_as_string=True, encoding='latin1'),
-                            content_type='application/json')
+        config = SysConfig()
+        query_check_info = query_engine.query_check(db_name=db_names[0], sql=sql_content)
+        if query_check_info.get('bad_query') or (
+                query_check_info.get('has_star') and config.get('disable_star') is True):
+            result['status'] = 1
+            result['msg'] = query_check_info.get('msg')
+            return HttpResponse(json.dumps(result), content_type='application/json')
+        sql_content = query_check_info['filtered_sql']
+
+        # 逐库校验查询权限，获取各库的limit_num和权限校验结果
+        tenants = {}
+        priv_checks = {}
+        for db_name in db_names:
+            priv_check_info = query_priv_check(user, instance, db_name, sql_content, limit_num)
+            if priv_check_info['status'] != 0:
+                result['status'] = 1
+                result['msg'] = f"{db_name}：{priv_check_info['msg']}"
+                return HttpResponse(json.dumps(result), content_type='application/json')
+            tenants[db_name] = priv_check_info['data']['limit_num']
+            priv_checks[db_name] = priv_check_info['data']['priv_check']
+        # explain的limit_num设置为0
+        if re.match(r"^explain", sql_content.lower()):
+            tenants = dict.fromkeys(tenants, 0)
+        # 语句按最大的limit改写，各库按自身limit读取
+        sql_content = query_engine.filter_sql(sql=sql_content, limit_num=max(tenants.values()))
+
+        def masking(db_name, query_result):
+            """数据脱敏，出错时按照query_check配置禁止返回或放行"""
+            if not config.get('data_masking'):
+                return query_result
+            try:
+                with FuncTimer() as t:
+                    masking_result = query_engine.query_masking(db_name, sql_content, query_result)
+                masking_result.mask_time = t.cost
+                error = masking_result.error
+            except Exception as msg:
+                error = msg
+            if not error:
+                return masking_result
+            if config.get('query_check'):
+                query_result.error = f'数据脱敏异常：{error}'
+            else:
+                logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{error}')
+                query_result.error = None
+            return query_result
+
+        max_rows = int(config.get('tenant_query_max_rows') or tenant_query.TENANT_QUERY_MAX_ROWS)
+        query_result = tenant_query.query_tenants(query_engine, tenants, sql_content, max_rows=max_rows,
+                                                  timeout=int(config.get('max_execution_time', 60)),
+                                                  aggregate=aggregate, on_result=masking)
+        if query_result.error:
+            result['status'] = 1
+            result['msg'] = query_result.error
+        result['data'] = query_result.__dict__
+
+        # 仅记录查询成功的库
+        for db_name, tenant in query_result.tenants.items():
+            if tenant['status'] in ('success', 'truncated'):
+                save_query_log(QueryLog(
+                    username=user.username,
+                    user_display=user.display,
+                    db_name=db_name,
+                    instance_name=instance.instance_name,
+                    sqllog=sql_content,
+                    effect_row=tenant['affected_rows'],
+                    cost_time=query_result.query_time,
+                    priv_check=priv_checks[db_name],
+                    hit_rule=query_result.mask_rule_hit,
+                    masking=query_result.is_masked
+                ))
+    except Exception as e:
+        logger.error(f'多租户查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
+        result['status'] = 1
+        result['msg'] = f'查询异常报错，错误信息：{e}'
+    finally:
+        # 各库使用独立的引擎查询，此处归还检查、改写语句和脱敏时获取的连接
+        query_engine.close()
+    return query_response(request, result)
 
 
 @permission_required('sql.menu_sqlquery', raise_exception=True)
@@ -193,10 +318,11 @@ def querylog(request):
 
     limit = int(request.GET.get('limit'))
     offset = int(request.GET.get('offset'))
-    limit = offset + limit
+    cursor = request.GET.get('cursor')
     star = True if request.GET.get('star') == 'true' else False
     query_log_id = request.GET.get('query_log_id')
     search = request.GET.get('search', '')
+    include_archived = True if request.GET.get('include_archived') == 'true' else False
 
     # 组合筛选项
     filter_dict = dict()
@@ -214,18 +340,23 @@ def querylog(request):
     sql_log = QueryLog.objects.filter(**filter_dict)
 
     # 过滤搜索信息
-    sql_log = sql_log.filter(Q(sqllog__icontains=search) |
-                             Q(user_display__icontains=search) |
-                             Q(alias__icontains=search))
-
-    sql_log_count = sql_log.count()
-    sql_log_list = sql_log.order_by('-id')[offset:limit].values(
-        "id", "instance_name", "db_name", "sqllog",
-        "effect_row", "cost_time", "user_display", "favorite", "alias",
-        "create_time")
+    sql_log = search_filter(sql_log, ['sqllog', 'user_display', 'alias'], search)
+
+    fields = ["id", "instance_name", "db_name", "sqllog",
+              "effect_row", "cost_time", "user_display", "favorite", "alias",
+              "create_time"]
+    # 包含已归档的查询日志
+    if include_archived:
+        archived_log = QueryLogArchive.objects.filter(**filter_dict)
+        archived_log = search_filter(archived_log, ['sqllog', 'user_display', 'alias'], search)
+        sql_log_count = approximate_count(sql_log) + approximate_count(archived_log)
+        sql_log_list = keyset_page_union([sql_log, archived_log], 'id', fields, offset, limit, cursor)
+    else:
+        sql_log_count = approximate_count(sql_log)
+        sql_log_list = keyset_page(sql_log, 'id', offset, limit, cursor).values(*fields)
     # QuerySet 序列化
     rows = [row for row in sql_log_list]
-    result = {"total": sql_log_count, "rows": rows}
+    result = {"total": sql_log_count, "rows": rows, "cursor": rows[-1]['id'] if rows else None}
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
                         content_type='application/json')
@@ -241,6 +372,9 @@ def favorite(request):
     query_log_id = request.POST.get('query_log_id')
     star = True if request.POST.get('star') == 'true' else False
     alias = request.POST.get('alias')
+    # 收藏已归档的语句时先恢复到查询日志表
+    if not QueryLog.objects.filter(id=query_log_id).exists():
+        restore_query_log(query_log_id)
     QueryLog(id=query_log_id, favorite=star, alias=alias).save(update_fields=['favorite', 'alias'])
     # 返回查询结果
     return HttpResponse(json.dumps({'status': 0, 'msg': 'ok'}), content_type='application/json')
@@ -0,0 +1,21 @@
+# -*- coding: UTF-8 -*-
+"""
+模型信号处理，在sql.apps.SqlConfig.ready中注册
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from sql.models import Instance, InstanceTag, InstanceTagRelations, ResourceGroup, ResourceGroup2User, \
+    ResourceGroup2Instance
+from sql.utils.resource_group import invalidate_access_map
+
+
+@receiver([post_save, post_delete], sender=Instance)
+@receiver([post_save, post_delete], sender=InstanceTag)
+@receiver([post_save, post_delete], sender=InstanceTagRelations)
+@receiver([post_save, post_delete], sender=ResourceGroup)
+@receiver([post_save, post_delete], sender=ResourceGroup2User)
+@receiver([post_save, post_delete], sender=ResourceGroup2Instance)
+def access_map_changed(sender, **kwargs):
+    """资源组、实例、标签及关联关系变更时使用户实例访问映射失效"""
+    invalidate_access_map()
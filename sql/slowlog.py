@@ -2,17 +2,19 @@
 import simplejson as json
 import datetime
 from django.contrib.auth.decorators import permission_required
-from django.db.models import F, Sum, Value as V, Max
+from django.db.models import F, Sum, Value as V, Max, Count
 from django.db.models.functions import Concat
 from django.http import HttpResponse
 from django.views.decorators.cache import cache_page
 from pyecharts.charts import Line
 from pyecharts import options as opts
-from common.utils.chart_dao import ChartDao
+from common.utils.chart_dao import RollupChartDao
+from common.utils.pagination import search_filter, approximate_count, keyset_page, keyset_page_by, \
+    keyset_cursor
 
 from sql.utils.resource_group import user_instances
 from common.utils.extend_json_encoder import ExtendJSONEncoder
-from .models import Instance, SlowQuery, SlowQueryHistory, AliyunRdsConfig
+from .models import Instance, SlowQuery, SlowQueryHistory, SlowQueryStatsDaily, AliyunRdsConfig
 
 from .aliyun_rds import slowquery_review as aliyun_rds_slowquery_review, \
     slowquery_review_history as aliyun_rds_slowquery_review_history
@@ -44,53 +46,46 @@ def slowquery_review(request):
         db_name = request.POST.get('db_name')
         limit = int(request.POST.get('limit'))
         offset = int(request.POST.get('offset'))
-        limit = offset + limit
         search = request.POST.get('search')
+        cursor = request.POST.get('cursor')
 
-        # 时间处理
-        end_time = datetime.datetime.strptime(end_time, '%Y-%m-%d') + datetime.timedelta(days=1)
-        # DBName非必传
+        # 从日汇总表统计，DBName非必传
+        filter_dict = {'hostname_max': instance_info.host + ':' + str(instance_info.port),
+                       'stat_date__range': (start_time, end_time)}
         if db_name:
-            # 获取慢查数据
-            slowsql_obj = SlowQuery.objects.filter(
-                slowqueryhistory__hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                slowqueryhistory__db_max=db_name,
-                slowqueryhistory__ts_min__range=(start_time, end_time),
-                fingerprint__icontains=search
-            ).annotate(SQLText=F('fingerprint'), SQLId=F('checksum')).values('SQLText', 'SQLId').annotate(
-                CreateTime=Max('slowqueryhistory__ts_max'),
-                DBName=Max('slowqueryhistory__db_max'),  # 数据库
-                QueryTimeAvg=Sum('slowqueryhistory__query_time_sum') / Sum('slowqueryhistory__ts_cnt'),  # 平均执行时长
-                MySQLTotalExecutionCounts=Sum('slowqueryhistory__ts_cnt'),  # 执行总次数
-                MySQLTotalExecutionTimes=Sum('slowqueryhistory__query_time_sum'),  # 执行总时长
-                ParseTotalRowCounts=Sum('slowqueryhistory__rows_examined_sum'),  # 扫描总行数
-                ReturnTotalRowCounts=Sum('slowqueryhistory__rows_sent_sum'),  # 返回总行数
-            )
-        else:
-            # 获取慢查数据
-            slowsql_obj = SlowQuery.objects.filter(
-                slowqueryhistory__hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                slowqueryhistory__ts_min__range=(start_time, end_time),
-                fingerprint__icontains=search
-            ).annotate(SQLText=F('fingerprint'), SQLId=F('checksum')).values('SQLText', 'SQLId').annotate(
-                CreateTime=Max('slowqueryhistory__ts_max'),
-                DBName=Max('slowqueryhistory__db_max'),  # 数据库
-                QueryTimeAvg=Sum('slowqueryhistory__query_time_sum') / Sum('slowqueryhistory__ts_cnt'),  # 平均执行时长
-                MySQLTotalExecutionCounts=Sum('slowqueryhistory__ts_cnt'),  # 执行总次数
-                MySQLTotalExecutionTimes=Sum('slowqueryhistory__query_time_sum'),  # 执行总时长
-                ParseTotalRowCounts=Sum('slowqueryhistory__rows_examined_sum'),  # 扫描总行数
-                ReturnTotalRowCounts=Sum('slowqueryhistory__rows_sent_sum'),  # 返回总行数
-            )
-        slow_sql_count = slowsql_obj.count()
-        slow_sql_list = slowsql_obj.order_by('-MySQLTotalExecutionCounts')[offset:limit]  # 执行总次数倒序排列
+            filter_dict['db_max'] = db_name
+        stats = SlowQueryStatsDaily.objects.filter(**filter_dict)
+        if search:
+            stats = stats.filter(checksum__in=search_filter(SlowQuery.objects.all(), ['fingerprint'], search).values(
+                'checksum'))
+        slowsql_obj = stats.values('checksum').annotate(
+            SQLId=F('checksum'),
+            CreateTime=Max('ts_max'),
+            DBName=Max('db_max'),  # 数据库
+            MySQLTotalExecutionCounts=Sum('ts_cnt'),  # 执行总次数
+            MySQLTotalExecutionTimes=Sum('query_time_sum'),  # 执行总时长
+            ParseTotalRowCounts=Sum('rows_examined_sum'),  # 扫描总行数
+            ReturnTotalRowCounts=Sum('rows_sent_sum'),  # 返回总行数
+        )
+        # 按SQL指纹分组，总数为不同的指纹数，汇总表行数较少，直接精确计数
+        slow_sql_count = stats.aggregate(total=Count('checksum', distinct=True))['total']
+        # 执行总次数倒序排列
+        slow_sql_list = list(keyset_page_by(slowsql_obj, 'MySQLTotalExecutionCounts', 'checksum', offset, limit,
+                                            cursor))
+        next_cursor = keyset_cursor(slow_sql_list, 'MySQLTotalExecutionCounts', 'checksum')
+        fingerprints = dict(SlowQuery.objects.filter(checksum__in=[row['checksum'] for row in slow_sql_list]
+                                                     ).values_list('checksum', 'fingerprint'))
 
         # QuerySet 序列化
         sql_slow_log = []
         for SlowLog in slow_sql_list:
-            SlowLog['QueryTimeAvg'] = round(SlowLog['QueryTimeAvg'], 6)
+            SlowLog.pop('checksum')
+            SlowLog['SQLText'] = fingerprints.get(SlowLog['SQLId'])
+            SlowLog['QueryTimeAvg'] = round(SlowLog['MySQLTotalExecutionTimes'] / SlowLog['MySQLTotalExecutionCounts'],
+                                            6) if SlowLog['MySQLTotalExecutionCounts'] else 0  # 平均执行时长
             SlowLog['MySQLTotalExecutionTimes'] = round(SlowLog['MySQLTotalExecutionTimes'], 6)
             sql_slow_log.append(SlowLog)
-        result = {"total": slow_sql_count, "rows": sql_slow_log}
+        result = {"total": slow_sql_count, "rows": sql_slow_log, "cursor": next_cursor}
 
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
@@ -121,84 +116,49 @@ def slowquery_review_history(request):
         limit = int(request.POST.get('limit'))
         offset = int(request.POST.get('offset'))
         search = request.POST.get('search')
+        cursor = request.POST.get('cursor')
 
         # 时间处理
         end_time = datetime.datetime.strptime(end_time, '%Y-%m-%d') + datetime.timedelta(days=1)
-        limit = offset + limit
         # SQLId、DBName非必传
+        filter_dict = {'hostname_max': instance_info.host + ':' + str(instance_info.port),
+                       'ts_min__range': (start_time, end_time)}
         if sql_id:
-            # 获取慢查明细数据
-            slow_sql_record_obj = SlowQueryHistory.objects.filter(
-                hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                checksum=sql_id,
-                ts_min__range=(start_time, end_time),
-                sample__icontains=search
-            ).annotate(ExecutionStartTime=F('ts_min'),  # 本次统计(每5分钟一次)该类型sql语句出现的最小时间
-                       DBName=F('db_max'),  # 数据库名
-                       HostAddress=Concat(V('\''), 'user_max', V('\''), V('@'), V('\''), 'client_max', V('\'')),  # 用户名
-                       SQLText=F('sample'),  # SQL语句
-                       TotalExecutionCounts=F('ts_cnt'),  # 本次统计该sql语句出现的次数
-                       QueryTimePct95=F('query_time_pct_95'),  # 本次统计该sql语句95%耗时
-                       QueryTimes=F('query_time_sum'),  # 本次统计该sql语句花费的总时间(秒)
-                       LockTimes=F('lock_time_sum'),  # 本次统计该sql语句锁定总时长(秒)
-                       ParseRowCounts=F('rows_examined_sum'),  # 本次统计该sql语句解析总行数
-                       ReturnRowCounts=F('rows_sent_sum')  # 本次统计该sql语句返回总行数
-                       )
-        else:
-            if db_name:
-                # 获取慢查明细数据
-                slow_sql_record_obj = SlowQueryHistory.objects.filter(
-                    hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                    db_max=db_name,
-                    ts_min__range=(start_time, end_time),
-                    sample__icontains=search
-                ).annotate(ExecutionStartTime=F('ts_min'),  # 本次统计(每5分钟一次)该类型sql语句出现的最小时间
-                           DBName=F('db_max'),  # 数据库名
-                           HostAddress=Concat(V('\''), 'user_max', V('\''), V('@'), V('\''), 'client_max', V('\'')),
-                           # 用户名
-                           SQLText=F('sample'),  # SQL语句
-                           TotalExecutionCounts=F('ts_cnt'),  # 本次统计该sql语句出现的次数
-                           QueryTimePct95=F('query_time_pct_95'),  # 本次统计该sql语句出现的次数
-                           QueryTimes=F('query_time_sum'),  # 本次统计该sql语句花费的总时间(秒)
-                           LockTimes=F('lock_time_sum'),  # 本次统计该sql语句锁定总时长(秒)
-                           ParseRowCounts=F('rows_examined_sum'),  # 本次统计该sql语句解析总行数
-                           ReturnRowCounts=F('rows_sent_sum')  # 本次统计该sql语句返回总行数
-                           )
-            else:
-                # 获取慢查明细数据
-                slow_sql_record_obj = SlowQueryHistory.objects.filter(
-                    hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                    ts_min__range=(start_time, end_time),
-                    sample__icontains=search
-                ).annotate(ExecutionStartTime=F('ts_min'),  # 本次统计(每5分钟一次)该类型sql语句出现的最小时间
-                           DBName=F('db_max'),  # 数据库名
-                           HostAddress=Concat(V('\''), 'user_max', V('\''), V('@'), V('\''), 'client_max', V('\'')),
-                           # 用户名
-                           SQLText=F('sample'),  # SQL语句
-                           TotalExecutionCounts=F('ts_cnt'),  # 本次统计该sql语句出现的次数
-                           QueryTimePct95=F('query_time_pct_95'),  # 本次统计该sql语句95%耗时
-                           QueryTimes=F('query_time_sum'),  # 本次统计该sql语句花费的总时间(秒)
-                           LockTimes=F('lock_time_sum'),  # 本次统计该sql语句锁定总时长(秒)
-                           ParseRowCounts=F('rows_examined_sum'),  # 本次统计该sql语句解析总行数
-                           ReturnRowCounts=F('rows_sent_sum')  # 本次统计该sql语句返回总行数
-                           )
-
-        slow_sql_record_count = slow_sql_record_obj.count()
-        slow_sql_record_list = slow_sql_record_obj[offset:limit].values('ExecutionStartTime', 'DBName', 'HostAddress',
-                                                                        'SQLText',
-                                                                        'TotalExecutionCounts', 'QueryTimePct95',
-                                                                        'QueryTimes', 'LockTimes', 'ParseRowCounts',
-                                                                        'ReturnRowCounts'
-                                                                        )
+            filter_dict['checksum'] = sql_id
+        if db_name:
+            filter_dict['db_max'] = db_name
+        slow_sql_record_obj = SlowQueryHistory.objects.filter(**filter_dict)
+        # 通过SQL指纹检索，可使用指纹的全文索引
+        if search:
+            slow_sql_record_obj = slow_sql_record_obj.filter(
+                checksum__in=search_filter(SlowQuery.objects.all(), ['fingerprint'], search).values('checksum'))
+        slow_sql_record_obj = slow_sql_record_obj.annotate(
+            ExecutionStartTime=F('ts_min'),  # 本次统计(每5分钟一次)该类型sql语句出现的最小时间
+            DBName=F('db_max'),  # 数据库名
+            HostAddress=Concat(V('\''), 'user_max', V('\''), V('@'), V('\''), 'client_max', V('\'')),  # 用户名
+            SQLText=F('sample'),  # SQL语句
+            TotalExecutionCounts=F('ts_cnt'),  # 本次统计该sql语句出现的次数
+            QueryTimePct95=F('query_time_pct_95'),  # 本次统计该sql语句95%耗时
+            QueryTimes=F('query_time_sum'),  # 本次统计该sql语句花费的总时间(秒)
+            LockTimes=F('lock_time_sum'),  # 本次统计该sql语句锁定总时长(秒)
+            ParseRowCounts=F('rows_examined_sum'),  # 本次统计该sql语句解析总行数
+            ReturnRowCounts=F('rows_sent_sum')  # 本次统计该sql语句返回总行数
+        )
+
+        slow_sql_record_count = approximate_count(slow_sql_record_obj)
+        slow_sql_record_list = keyset_page(slow_sql_record_obj, 'id', offset, limit, cursor).values(
+            'id', 'ExecutionStartTime', 'DBName', 'HostAddress', 'SQLText', 'TotalExecutionCounts', 'QueryTimePct95',
+            'QueryTimes', 'LockTimes', 'ParseRowCounts', 'ReturnRowCounts')
 
         # QuerySet 序列化
         sql_slow_record = []
         for SlowRecord in slow_sql_record_list:
-            SlowRecord['QueryTimePct95'] = round(SlowRecord['QueryTimePct95'], 6)
-            SlowRecord['QueryTimes'] = round(SlowRecord['QueryTimes'], 6)
-            SlowRecord['LockTimes'] = round(SlowRecord['LockTimes'], 6)
+            SlowRecord['QueryTimePct95'] = round(SlowRecord['QueryTimePct95'] or 0, 6)
+            SlowRecord['QueryTimes'] = round(SlowRecord['QueryTimes'] or 0, 6)
+            SlowRecord['LockTimes'] = round(SlowRecord['LockTimes'] or 0, 6)
             sql_slow_record.append(SlowRecord)
-        result = {"total": slow_sql_record_count, "rows": sql_slow_record}
+        result = {"total": slow_sql_record_count, "rows": sql_slow_record,
+                  "cursor": sql_slow_record[-1]['id'] if sql_slow_record else None}
 
         # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
@@ -209,8 +169,9 @@ def slowquery_review_history(request):
 def report(request):
     """返回慢SQL历史趋势"""
     checksum = request.GET.get('checksum')
-    cnt_data = ChartDao().slow_query_review_history_by_cnt(checksum)
-    pct_data = ChartDao().slow_query_review_history_by_pct_95_time(checksum)
+    chart_dao = RollupChartDao()
+    cnt_data = chart_dao.slow_query_review_history_by_cnt(checksum)
+    pct_data = chart_dao.slow_query_review_history_by_pct_95_time(checksum)
     cnt_x_data = [row[1] for row in cnt_data['rows']]
     cnt_y_data = [int(row[0]) for row in cnt_data['rows']]
     pct_y_data = [str(row[0]) for row in pct_data['rows']]
@@ -9,7 +9,6 @@ import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.db.models import Q
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
@@ -20,6 +19,8 @@ from common.config import SysConfig
 from common.utils.const import Const, WorkflowDict
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from common.utils.get_logger import get_logger
+from common.utils.json_serializer import dumps
+from common.utils.pagination import search_filter, approximate_count, keyset_page
 from sql.engines import get_engine
 from sql.models import ResourceGroup
 from sql.notify import notify_for_audit
@@ -47,7 +48,7 @@ def sql_workflow_list(request):
     end_date = request.POST.get('end_date')
     limit = int(request.POST.get('limit'))
     offset = int(request.POST.get('offset'))
-    limit = offset + limit
+    cursor = request.POST.get('cursor')
     search = request.POST.get('search')
     user = request.user
 
@@ -83,11 +84,10 @@ def sql_workflow_list(request):
     workflow = SqlWorkflow.objects.filter(**filter_dict)
 
     # 过滤搜索项，模糊检索项包括提交人名称、工单名
-    if search:
-        workflow = workflow.filter(Q(engineer_display__icontains=search) | Q(workflow_name__icontains=search))
+    workflow = search_filter(workflow, ['workflow_name', 'engineer_display'], search)
 
-    count = workflow.count()
-    workflow_list = workflow.order_by('-create_time')[offset:limit].values(
+    count = approximate_count(workflow)
+    workflow_list = keyset_page(workflow, 'id', offset, limit, cursor).values(
         "id", "workflow_name", "engineer_display",
         "status", "is_backup", "create_time",
         "instance__instance_name", "db_names",
@@ -95,7 +95,7 @@ def sql_workflow_list(request):
 
     # QuerySet 序列化
     rows = [row for row in workflow_list]
-    result = {"total": count, "rows": rows}
+    result = {"total": count, "rows": rows, "cursor": rows[-1]['id'] if rows else None}
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
                         content_type='application/json')
@@ -149,7 +149,7 @@ def check(request):
     # 异步执行
     asyncio.run(async_tasks(sql_check, db_names, instance, sql_content))
 
-    return HttpResponse(json.dumps(all_check_res), content_type='application/json')
+    return HttpResponse(dumps(all_check_res), content_type='application/json')
 
 
 def check_backup(instance):
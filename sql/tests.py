@@ -756,6 +756,10 @@ class TestQuery(TestCase):
         self.assertEqual(r_json['data']['rows'], ['value'])
         self.assertEqual(r_json['data']['column_list'], ['some'])
         self.assertEqual(r_json['data']['seconds_behind_master'], 100)
+        # 各阶段耗时
+        self.assertIn('query;dur=', r['Server-Timing'])
+        timings = json.loads(QueryLog.objects.filter(db_name=some_db).latest('id').timings)
+        self.assertIn('priv_check', timings)
 
     @patch('sql.query.user_instances')
     @patch('sql.query.get_engine')
@@ -795,6 +799,46 @@ class TestQuery(TestCase):
                                 'limit_num': some_limit})
         _get_engine.return_value.query.assert_called_once_with(some_db, filtered_sql_with_star, some_limit)
 
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    @patch('sql.query.tenant_query.query_tenants')
+    def test_query_tenants(self, _query_tenants, _priv_check, _get_engine, _user_instances):
+        """多租户查询，逐库校验权限，按最大limit改写语句"""
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select count(*) cnt from some_table'
+        _user_instances.return_value.get.return_value = self.slave1
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _priv_check.side_effect = [{'status': 0, 'data': {'limit_num': 10, 'priv_check': True}},
+                                   {'status': 0, 'data': {'limit_num': 100, 'priv_check': False}}]
+        q_result = ResultSet(full_sql=some_sql, rows=[('db1', 1), ('db2', 2)], column_list=['db_name', 'cnt'])
+        q_result.tenants = {'db1': {'status': 'success', 'affected_rows': 1, 'msg': ''},
+                            'db2': {'status': 'success', 'affected_rows': 1, 'msg': ''}}
+        _query_tenants.return_value = q_result
+        r = c.post('/query/tenants/', data={'instance_name': self.slave1.instance_name,
+                                            'sql_content': some_sql,
+                                            'db_names': 'db1,db2',
+                                            'limit_num': 100})
+        _get_engine.return_value.filter_sql.assert_called_once_with(sql=some_sql, limit_num=100)
+        self.assertEqual(_query_tenants.call_args[0][1], {'db1': 10, 'db2': 100})
+        self.assertEqual(r.json()['data']['column_list'], ['db_name', 'cnt'])
+        self.assertEqual(dict(QueryLog.objects.filter(db_name__in=['db1', 'db2']).values_list('db_name', 'priv_check')),
+                         {'db1': True, 'db2': False})
+        _get_engine.return_value.close.assert_called_once()
+        # 任意库无权限时不执行
+        _query_tenants.reset_mock()
+        _priv_check.side_effect = [{'status': 1, 'msg': '你无db1数据库的查询权限！', 'data': {}}]
+        r = c.post('/query/tenants/', data={'instance_name': self.slave1.instance_name,
+                                            'sql_content': some_sql,
+                                            'db_names': 'db1,db2',
+                                            'limit_num': 100})
+        self.assertEqual(r.json()['status'], 1)
+        _query_tenants.assert_not_called()
+        self.assertEqual(_get_engine.return_value.close.call_count, 2)
+
     @patch('sql.query.query_priv_check')
     def testStarOptionOn(self, _priv_check):
         c = Client()
@@ -1471,24 +1515,95 @@ class TestSchemaSync(TestCase):
         self.master.delete()
         self.sys_config.replace(json.dumps({}))
 
-    def test_schema_sync(self):
+    @patch('sql.instance.schema_diff')
+    def test_schema_sync(self, _schema_diff):
         """
         测试SchemaSync
         :return:
         """
+        _schema_diff.return_value = {'diff': ['test: 新增表 t1'], 'patch': ['CREATE TABLE `t1` (...);'],
+                                     'revert': ['DROP TABLE `t1`;']}
         data = {"instance_name": "test_instance",
-                "db_name": "*",
+                "db_name": "all",
                 "target_instance_name": "test_instance",
-                "target_db_name": "*",
+                "target_db_name": "all",
                 "sync_auto_inc": True,
                 "sync_comments": False}
         r = self.client.post(path='/instance/schemasync/', data=data)
-        self.assertEqual(json.loads(r.content)['status'], 1)
-        self.assertEqual(json.loads(r.content)['msg'], '请配置SchemaSync路径！')
-        self.sys_config.set('schemasync', '/opt/venv4schemasync/bin/schemasync')
-        self.sys_config.get_all_config()
+        self.assertEqual(json.loads(r.content), {'status': 0, 'msg': 'ok', 'data': {
+            'diff_stdout': 'test: 新增表 t1', 'patch_stdout': 'CREATE TABLE `t1` (...);',
+            'revert_stdout': 'DROP TABLE `t1`;'}})
+        _schema_diff.assert_called_once_with(self.master, '*', self.master, '*',
+                                             sync_auto_inc=False, sync_comments=False)
+        _schema_diff.side_effect = RuntimeError('connect error')
         r = self.client.post(path='/instance/schemasync/', data=data)
-        self.assertEqual(json.loads(r.content)['status'], 0)
+        self.assertEqual(json.loads(r.content)['status'], 1)
+
+
+class TestInstanceAccount(TestCase):
+    """
+    测试实例账号管理
+    """
+
+    def setUp(self):
+        self.superuser = User.objects.create(username='super', is_superuser=True)
+        self.ins = Instance.objects.create(instance_name='account_ins', type='master', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.client = Client()
+        self.client.force_login(self.superuser)
+
+    def tearDown(self):
+        self.superuser.delete()
+        self.ins.delete()
+
+    @patch('sql.instance_account.get_engine')
+    def test_users(self, _get_engine):
+        """一次查询获取全部用户的权限"""
+        grants = [("'u1'@'%'", '*', '*', '', 'USAGE', 'NO'),
+                  ("'u1'@'%'", 'db1', '*', '', 'SELECT', 'NO'),
+                  ("'u1'@'%'", 'db1', '*', '', 'INSERT', 'NO'),
+                  ("'u1'@'%'", 'db1', 't1', 'c1', 'UPDATE', 'NO'),
+                  ("'u1'@'%'", 'db1', 't1', 'c2', 'UPDATE', 'NO'),
+                  ("'u1'@'%'", 'db1', 't2', '', 'SELECT', 'NO'),
+                  ("'u1'@'%'", 'db1', 't2', 'c1', 'SELECT', 'NO'),
+                  ("'root'@'localhost'", '*', '*', '', 'SELECT', 'YES')]
+        role_edges_error = ResultSet()
+        role_edges_error.error = "Table 'mysql.role_edges' doesn't exist"
+        _get_engine.return_value.query.side_effect = [
+            ResultSet(rows=[('`u1`@`%`', 'u1', '%'), ('`u2`@`%`', 'u2', '%')]), ResultSet(rows=grants),
+            ResultSet(rows=[]), role_edges_error]
+        r = self.client.post('/instance/user/list', data={'instance_id': self.ins.id})
+        rows = json.loads(r.content)['rows']
+        self.assertEqual(rows[0]['privileges'], ["GRANT USAGE ON *.* TO 'u1'@'%'",
+                                                 "GRANT SELECT, INSERT ON `db1`.* TO 'u1'@'%'",
+                                                 "GRANT UPDATE (`c1`, `c2`) ON `db1`.`t1` TO 'u1'@'%'",
+                                                 "GRANT SELECT, SELECT (`c1`) ON `db1`.`t2` TO 'u1'@'%'"])
+        self.assertEqual(rows[1]['privileges'], [])
+        self.assertEqual(_get_engine.return_value.query.call_count, 4)
+
+    @patch('sql.instance_account.get_engine')
+    def test_users_show_grants(self, _get_engine):
+        """存在存储过程、代理、角色授权的用户使用SHOW GRANTS"""
+        grants = [("'u1'@'%'", '*', '*', '', 'USAGE', 'NO')]
+        show_grants = [("GRANT USAGE ON *.* TO `u1`@`%`",),
+                       ("GRANT EXECUTE ON PROCEDURE `db1`.`p1` TO `u1`@`%`",)]
+        _get_engine.return_value.query.side_effect = [
+            ResultSet(rows=[('`u1`@`%`', 'u1', '%')]), ResultSet(rows=grants),
+            ResultSet(rows=[('u1', '%')]), ResultSet(rows=[]), ResultSet(rows=show_grants)]
+        r = self.client.post('/instance/user/list', data={'instance_id': self.ins.id})
+        rows = json.loads(r.content)['rows']
+        self.assertEqual(rows[0]['privileges'], [row[0] for row in show_grants])
+        _get_engine.return_value.query.assert_called_with('mysql', 'show grants for `u1`@`%`;', close_conn=False)
+
+    @patch('sql.instance_account.get_engine')
+    def test_users_grants_error(self, _get_engine):
+        """获取权限报错时返回错误信息"""
+        grants_error = ResultSet()
+        grants_error.error = 'SELECT command denied'
+        _get_engine.return_value.query.side_effect = [ResultSet(rows=[('`u1`@`%`', 'u1', '%')]), grants_error]
+        r = self.client.post('/instance/user/list', data={'instance_id': self.ins.id})
+        self.assertEqual(json.loads(r.content), {'status': 1, 'msg': 'SELECT command denied'})
+        _get_engine.return_value.close.assert_called_once()
 
 
 class TestAsync(TestCase):
@@ -1666,18 +1781,17 @@ class TestBinLog(TestCase):
         print(json.loads(r.content))
         # self.assertEqual(json.loads(r.content).get('status'), 1)
 
-    def test_binlog2sql_path_not_exist(self):
+    def test_binlog2sql_start_file_not_exist(self):
         """
-        测试获取解析binlog，path未设置
+        测试获取解析binlog，起始文件未设置
         :return:
         """
         data = {"instance_name": "test_instance",
                 "save_sql": "false",
                 "no_pk": "false",
                 "flashback": "false",
-                "back_interval": "",
                 "num": "",
-                "start_file": "mysql-bin.000045",
+                "start_file": "",
                 "start_pos": "",
                 "end_file": "",
                 "end_pos": "",
@@ -1687,22 +1801,22 @@ class TestBinLog(TestCase):
                 "only_dml": "true",
                 "sql_type": ""}
         r = self.client.post(path='/binlog/binlog2sql/', data=data)
-        self.assertEqual(json.loads(r.content), {'status': 1, 'msg': '可执行文件路径不能为空！', 'data': {}})
+        self.assertEqual(json.loads(r.content), {'status': 1, 'msg': '起始binlog文件不能为空！', 'data': {}})
 
-    @patch('sql.plugins.plugin.subprocess')
-    def test_binlog2sql(self, _subprocess):
+    @patch('sql.binlog.async_task')
+    @patch('sql.binlog.BinlogParser')
+    def test_binlog2sql(self, _parser, _async_task):
         """
-        测试获取解析binlog，path设置
-        :param _subprocess:
+        测试获取解析binlog，返回下一页游标
+        :param _parser:
         :return:
         """
-        self.sys_config.set('binlog2sql', '/opt/binlog2sql')
-        self.sys_config.get_all_config()
+        _parser.return_value.parse.return_value = ([{"sql": "sql", "binlog_info": "info"}],
+                                                   'mysql-bin.000045:4:1')
         data = {"instance_name": "test_instance",
-                "save_sql": "1",
+                "save_sql": "true",
                 "no_pk": "false",
                 "flashback": "false",
-                "back_interval": "",
                 "num": "1",
                 "start_file": "mysql-bin.000045",
                 "start_pos": "",
@@ -1714,36 +1828,32 @@ class TestBinLog(TestCase):
                 "only_dml": "true",
                 "sql_type": ""}
         r = self.client.post(path='/binlog/binlog2sql/', data=data)
-        self.assertEqual(json.loads(r.content), {"status": 0, "msg": "ok", "data": [{"sql": {}, "binlog_info": {}}]})
-
-    @patch('builtins.iter')
-    @patch('sql.plugins.plugin.subprocess')
-    def test_binlog2sql_file(self, _subprocess, _iter):
+        self.assertEqual(json.loads(r.content), {"status": 0, "msg": "ok", "cursor": 'mysql-bin.000045:4:1',
+                                                 "data": [{"sql": "sql", "binlog_info": "info"}]})
+        _parser.return_value.parse.assert_called_once_with(1, cursor=None)
+        _async_task.assert_called_once()
+        # 翻页时不重复保存文件
+        data['cursor'] = 'mysql-bin.000045:4:1'
+        self.client.post(path='/binlog/binlog2sql/', data=data)
+        _parser.return_value.parse.assert_called_with(1, cursor='mysql-bin.000045:4:1')
+        _async_task.assert_called_once()
+
+    @patch('sql.binlog.BinlogParser')
+    def test_binlog2sql_file(self, _parser):
         """
         测试保存文件
-        :param _subprocess:
+        :param _parser:
         :return:
         """
-        args = {"instance_name": "test_instance",
-                "save_sql": "1",
-                "no_pk": "false",
-                "flashback": "false",
-                "back_interval": "",
-                "num": "1",
-                "start_file": "",
-                "start_pos": "",
-                "end_file": "",
-                "end_pos": "",
-                "stop_time": "",
-                "start_time": "",
-                "only_schemas": "",
-                "only_dml": "true",
-                "sql_type": "",
+        args = {"no_pk": False,
+                "flashback": False,
+                "start_file": "mysql-bin.000045",
+                "only_dml": True,
                 "instance": self.master}
-        _subprocess.Popen.return_value.stdout.return_value.readline.return_value = 'sql'
-        _iter.return_value = ''
         r = binlog2sql_file(args=args, user=self.superuser)
         self.assertEqual(self.superuser, r[0])
+        _parser.assert_called_once_with(**args)
+        _parser.return_value.parse_to_file.assert_called_once_with(r[1])
 
     def test_del_binlog_instance_not_exist(self):
         """
@@ -14,6 +14,7 @@ from sql.utils import tasks, ding_api
 urlpatterns = [
     path('', views.index),
     path('jsi18n/', JavaScriptCatalog.as_view(), name='javascript-catalog'),
+    path('metrics/', dashboard.metrics),
     path('index/', views.index),
     path('login/', views.login, name='login'),
     path('logout/', auth.sign_out),
@@ -108,6 +109,7 @@ urlpatterns = [
     path('param/edit/', instance.param_edit),
 
     path('query/', query.query),
+    path('query/tenants/', query.query_tenants),
     path('query/querylog/', query.querylog),
     path('query/favorite/', query.favorite),
     path('query/explain/', sql.sql_optimize.explain),
@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+历史数据归档，将超过保留天数的查询日志、工单内容、慢日志明细按主键范围分批迁移到归档表
+"""
+import datetime
+import logging
+
+from django.db import connection, transaction
+
+from common.config import SysConfig
+from sql.models import QueryLog, QueryLogArchive, SqlWorkflowContent, SqlWorkflowContentArchive, SlowQueryHistory
+
+logger = logging.getLogger('default')
+
+ARCHIVE_BATCH_SIZE = 1000
+# 慢日志明细表不由Django管理，归档表需执行升级脚本创建
+SLOW_QUERY_HISTORY_ARCHIVE_TABLE = 'mysql_slow_query_review_history_archive'
+# 仅归档已结束的工单
+ARCHIVE_WORKFLOW_STATUS = ('workflow_finish', 'workflow_abort', 'workflow_autoreviewwrong', 'workflow_exception')
+
+
+def table_columns(table):
+    """读取表的实际字段，不依赖模型定义，非Django管理的表可能包含模型未声明的字段"""
+    with connection.cursor() as cursor:
+        return [column.name for column in connection.introspection.get_table_description(cursor, table)]
+
+
+def archive_rows(model, archive_table, where, params, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    按主键范围分批将满足条件的数据迁移到归档表，每批在一个事务内完成写入和删除
+    :param model: 源表模型
+    :param archive_table: 归档表名，表结构需包含源表全部字段，缺少字段时不归档
+    :param where: 归档条件
+    :param params: 归档条件参数
+    :param batch_size: 每批主键范围大小
+    :return: 归档行数
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    pk = qn(model._meta.pk.column)
+    source_columns = table_columns(model._meta.db_table)
+    missing = set(source_columns) - set(table_columns(archive_table))
+    if missing:
+        raise Exception(f'归档表{archive_table}缺少字段：{",".join(sorted(missing))}')
+    columns = ','.join(qn(column) for column in source_columns)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT MIN({pk}),MAX({pk}) FROM {table} WHERE {where}', params)
+        min_pk, max_pk = cursor.fetchone()
+    if min_pk is None:
+        return 0
+    count = 0
+    for start in range(min_pk, max_pk + 1, batch_size):
+        range_where = f'{pk}>=%s AND {pk}<%s AND {where}'
+        range_params = [start, start + batch_size] + list(params)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {qn(archive_table)} ({columns}) '
+                           f'SELECT {columns} FROM {table} WHERE {range_where}', range_params)
+            cursor.execute(f'DELETE FROM {table} WHERE {range_where}', range_params)
+            count += cursor.rowcount
+    return count
+
+
+def archive_query_log(days):
+    """归档查询日志，已收藏的语句不归档"""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    return archive_rows(QueryLog, QueryLogArchive._meta.db_table, 'create_time<%s AND favorite=%s', [cutoff, False])
+
+
+def archive_workflow_content(days):
+    """归档已结束工单的内容，工单本身保留"""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    status = ','.join(['%s'] * len(ARCHIVE_WORKFLOW_STATUS))
+    where = f'workflow_id IN (SELECT id FROM sql_workflow WHERE create_time<%s AND status IN ({status}))'
+    return archive_rows(SqlWorkflowContent, SqlWorkflowContentArchive._meta.db_table, where,
+                        [cutoff, *ARCHIVE_WORKFLOW_STATUS])
+
+
+def archive_slow_query_history(days):
+    """归档慢日志明细，趋势图使用汇总表，不受归档影响"""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    return archive_rows(SlowQueryHistory, SLOW_QUERY_HISTORY_ARCHIVE_TABLE, 'ts_min<%s', [cutoff])
+
+
+def archive():
+    """按系统配置的保留天数归档历史数据，由定时任务调用，未配置保留天数的数据不归档"""
+    config = SysConfig()
+    jobs = [(archive_query_log, config.get('archive_query_log_days')),
+            (archive_workflow_content, config.get('archive_workflow_days')),
+            (archive_slow_query_history, config.get('archive_slow_query_days'))]
+    result = {}
+    for func, days in jobs:
+        if not days or int(days) <= 0:
+            continue
+        try:
+            result[func.__name__] = func(int(days))
+        except Exception as e:
+            logger.error(f'历史数据归档{func.__name__}失败，错误信息：{e}')
+    logger.debug(f'历史数据归档完成，归档行数：{result}')
+    return result
+
+
+def workflow_content(workflow):
+    """
+    获取工单内容，已归档的工单从归档表读取并挂载到workflow.sqlworkflowcontent，不写回源表
+    :param workflow: SqlWorkflow对象
+    :return: SqlWorkflowContent对象
+    """
+    try:
+        return workflow.sqlworkflowcontent
+    except SqlWorkflowContent.DoesNotExist:
+        archived = SqlWorkflowContentArchive.objects.get(workflow_id=workflow.id)
+        content = SqlWorkflowContent(id=archived.id,
+                                     sql_content=archived.sql_content,
+                                     review_content=archived.review_content,
+                                     execute_result=archived.execute_result)
+        workflow.sqlworkflowcontent = content
+        return content
+
+
+def restore_query_log(query_log_id):
+    """将已归档的查询日志恢复到查询日志表，用于收藏归档的语句"""
+    with transaction.atomic():
+        for archived in QueryLogArchive.objects.filter(id=query_log_id).values():
+            QueryLog.objects.bulk_create([QueryLog(**archived)])
+        QueryLogArchive.objects.filter(id=query_log_id).delete()
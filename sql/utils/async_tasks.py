@@ -4,11 +4,17 @@ __author__ = 'sunnywalden@gmail.com'
 
 import asyncio
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from common.utils.get_logger import get_logger
+from sql.engines.models import ReviewResult, ReviewSet
 
 logger = get_logger()
 
+# 多租户并行执行的库数上限
+TENANT_WORKERS = 8
+
 
 async def async_tasks(func, tenants, *args):
     """异步执行多个租户"""
@@ -22,3 +28,34 @@ async def async_tasks(func, tenants, *args):
     end = time.perf_counter()
     # 打印耗时
     logger.info("{0} seconds spent".format(end - start))
+
+
+def thread_tasks(func, tenants, *args, max_workers=TENANT_WORKERS):
+    """线程池并行执行多个租户，并行数不超过max_workers，返回{租户: 结果}"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(tenants)), 1)) as executor:
+        results = dict(zip(tenants, executor.map(lambda tenant: func(tenant, *args), tenants)))
+    logger.info("{0} seconds spent".format(time.perf_counter() - start))
+    return results
+
+
+def execute_tenants(engine, db_names, sql):
+    """
+    多租户并行执行上线单，每个库使用独立的引擎实例，调用engine.execute执行
+    :return: {db_name: ReviewResult字典列表}，与execute_callback处理的结果一致
+    """
+
+    def execute(db_name):
+        try:
+            result = engine.__class__(instance=engine.instance).execute(db_name=db_name, sql=sql)
+        except Exception as e:
+            logger.warning(f"租户{db_name}执行报错，错误信息：{traceback.format_exc()}")
+            result = ReviewSet(full_sql=sql)
+            result.error = str(e)
+            result.rows = [ReviewResult(id=1, errlevel=2, stagestatus='Execute Failed',
+                                        errormessage=f'异常信息：{e}', sql=sql)]
+        for row in result.rows:
+            row.db_name = db_name
+        return result.to_dict()
+
+    return thread_tasks(execute, db_names)
@@ -0,0 +1,210 @@
+# -*- coding: UTF-8 -*-
+"""
+上线单分批提交，连续的DML语句在同一个事务中执行，每batch_size条提交一次，其他语句执行前后均提交
+相同表、相同字段的单行INSERT合并为一条语句执行，合并语句执行失败时回滚当前事务并逐条重新执行，定位失败语句
+"""
+import logging
+import re
+import traceback
+
+from common.utils.timer import FuncTimer
+from sql.engines.models import ReviewResult
+
+logger = logging.getLogger('default')
+
+# 单条合并语句包含的INSERT数上限
+INSERT_BATCH_SIZE = 500
+DML = re.compile(r'^\s*(insert|update|delete|merge)\b', re.I)
+INSERT_VALUES = re.compile(r'^\s*insert\s+into\s+(?P<table>[\w.$#"]+)\s*(?P<columns>\([^()]*\))?\s*'
+                           r'values\s*(?P<values>\(.*\))\s*$', re.I | re.S)
+
+
+def _single_row(values):
+    """values是否为单个完整的括号，如(1, 'a')，多行、后接on conflict等子句时返回False"""
+    depth = 0
+    in_quote = False
+    for position, char in enumerate(values):
+        if char == "'":
+            in_quote = not in_quote
+        elif in_quote:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return position == len(values) - 1
+    return False
+
+
+def _value_count(values):
+    """单行values中的值个数，按最外层括号内的逗号计算"""
+    depth = 0
+    in_quote = False
+    count = 1
+    for char in values:
+        if char == "'":
+            in_quote = not in_quote
+        elif in_quote:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 1:
+            count += 1
+    return count
+
+
+def parse_insert(statement):
+    """
+    解析单行INSERT语句
+    :param statement: INSERT INTO table[(columns)] VALUES (...)
+    :return: ((table, columns), values)，不是单行INSERT时返回None
+    """
+    match = INSERT_VALUES.match(statement)
+    if not match or not _single_row(match.group('values')):
+        return None
+    columns = re.sub(r'\s+', '', match.group('columns') or '')
+    return (match.group('table'), columns), match.group('values')
+
+
+class BatchExecutor(object):
+    def __init__(self, conn, batch_size=1, coalesce=None, max_coalesce_values=0):
+        """
+        :param conn: 数据库连接
+        :param batch_size: 每个事务中的DML语句数，为1时逐条提交
+        :param coalesce: 合并INSERT的函数，参数为(table, columns, values列表)，返回合并后的语句，返回None时不合并
+        :param max_coalesce_values: 合并语句中值的总数上限，0为不限制，如Oracle INSERT ALL不能超过999
+        """
+        self.conn = conn
+        self.batch_size = max(int(batch_size), 1)
+        self.coalesce = coalesce
+        self.max_coalesce_values = max_coalesce_values
+        self.statements = []
+        self.rows = []
+        # 当前事务中已执行、未提交的语句序号
+        self.batch = []
+        self.current = None
+
+    def execute(self, statements):
+        """
+        执行全部语句
+        :param statements: 已切分的语句
+        :return: (ReviewResult列表, 错误信息)
+        """
+        self.statements = statements
+        cursor = self.conn.cursor()
+        index = 0
+        try:
+            while index < len(statements):
+                if self.batch_size == 1 or not DML.match(statements[index]):
+                    self._commit()
+                    self._execute(cursor, [index])
+                    self._commit()
+                    index += 1
+                    continue
+                group, sql = self._insert_group(index)
+                try:
+                    self._execute(cursor, group, sql)
+                except Exception:
+                    if len(group) == 1:
+                        raise
+                    # 合并语句执行失败，回滚当前事务并逐条重新执行
+                    logger.warning(f'合并语句执行失败，逐条重新执行，错误信息：{traceback.format_exc()}')
+                    self.conn.rollback()
+                    retry = self.batch + group
+                    del self.rows[len(self.rows) - len(self.batch):]
+                    self.batch = []
+                    for retry_index in retry:
+                        self._execute(cursor, [retry_index])
+                index = group[-1] + 1
+            self._commit()
+        except Exception as e:
+            logger.warning(f"语句执行报错，语句：{statements[self.current]}，错误信息：{traceback.format_exc()}")
+            self._failed(e)
+            return self.rows, str(e)
+        return self.rows, None
+
+    def _insert_group(self, index):
+        """
+        从index开始可合并执行的INSERT，不超过当前事务剩余的语句数
+        :return: (语句序号列表, 合并后的语句)，不可合并时返回([index], None)
+        """
+        parsed = parse_insert(self.statements[index]) if self.coalesce else None
+        if not parsed:
+            return [index], None
+        key, values = parsed
+        limit = min(INSERT_BATCH_SIZE, self.batch_size - len(self.batch))
+        if self.max_coalesce_values:
+            limit = min(limit, max(self.max_coalesce_values // _value_count(values), 1))
+        group, group_values = [index], [values]
+        for next_index in range(index + 1, min(index + limit, len(self.statements))):
+            next_parsed = parse_insert(self.statements[next_index])
+            if not next_parsed or next_parsed[0] != key:
+                break
+            group.append(next_index)
+            group_values.append(next_parsed[1])
+        sql = self.coalesce(*key, group_values) if len(group) > 1 else None
+        return (group, sql) if sql else ([index], None)
+
+    def _execute(self, cursor, group, sql=None):
+        if len(group) == 1:
+            self.current = group[0]
+            sql = self.statements[self.current]
+        with FuncTimer() as t:
+            cursor.execute(sql)
+        # 合并执行的单行INSERT影响行数均为1，执行时间平均分配
+        affected_rows = cursor.rowcount if len(group) == 1 else 1
+        self.current = group[-1]
+        for i in group:
+            self.rows.append(ReviewResult(
+                id=i + 1,
+                errlevel=0,
+                stagestatus='Execute Successfully',
+                errormessage='None',
+                sql=self.statements[i],
+                affected_rows=affected_rows,
+                execute_time=round(t.cost / len(group), 6),
+            ))
+            self.batch.append(i)
+        if len(self.batch) >= self.batch_size:
+            self._commit()
+
+    def _commit(self):
+        if self.batch:
+            self.conn.commit()
+            self.batch = []
+
+    def _failed(self, e):
+        """回滚当前事务，追加失败语句和未执行语句"""
+        try:
+            self.conn.rollback()
+        except Exception as rollback_error:
+            logger.warning(f'回滚失败，错误信息：{rollback_error}')
+        # 提交失败时归属到事务中的最后一条语句
+        if self.batch and self.batch[-1] == self.current:
+            self.rows.pop()
+            self.batch.pop()
+        for row in self.rows[len(self.rows) - len(self.batch):]:
+            row.stagestatus += '\nRollback Successfully'
+        self.rows.append(ReviewResult(
+            id=self.current + 1,
+            errlevel=2,
+            stagestatus='Execute Failed',
+            errormessage=f'异常信息：{e}',
+            sql=self.statements[self.current],
+            affected_rows=0,
+            execute_time=0,
+        ))
+        # 报错语句后面的语句标记为审核通过、未执行
+        for i in range(self.current + 1, len(self.statements)):
+            self.rows.append(ReviewResult(
+                id=i + 1,
+                errlevel=0,
+                stagestatus='Audit completed',
+                errormessage='前序语句失败, 未执行',
+                sql=self.statements[i],
+                affected_rows=0,
+                execute_time=0,
+            ))
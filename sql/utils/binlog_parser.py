@@ -0,0 +1,249 @@
+# -*- coding: UTF-8 -*-
+"""
+binlog解析，基于mysql-replication读取binlog事件生成SQL和回滚SQL
+支持通过游标断点续读分页，保存文件时按binlog文件并行解析
+"""
+import collections
+import datetime
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
+from pymysql.converters import escape_item
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.event import QueryEvent, RotateEvent
+from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, TableMapEvent
+
+from sql.engines import get_engine
+
+logger = logging.getLogger('default')
+
+SQL_TYPE_EVENTS = {'INSERT': WriteRowsEvent, 'UPDATE': UpdateRowsEvent, 'DELETE': DeleteRowsEvent}
+# 保存文件时并行解析的binlog文件数
+PARSE_WORKERS = 4
+
+
+def encode_cursor(log_file, log_pos, skip=0):
+    """游标格式 binlog文件:起始位置:需跳过的行数"""
+    return f'{log_file}:{log_pos}:{skip}'
+
+
+def decode_cursor(cursor):
+    log_file, log_pos, skip = cursor.rsplit(':', 2)
+    return log_file, int(log_pos), int(skip)
+
+
+def _escape(value):
+    """转换为SQL字面量"""
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, set):
+        value = ','.join(sorted(value))
+    return escape_item(value, 'utf8mb4')
+
+
+def _where(values):
+    return ' AND '.join(f'`{k}` IS NULL' if v is None else f'`{k}`={_escape(v)}' for k, v in values.items())
+
+
+def _insert(table, values):
+    columns = ', '.join(f'`{k}`' for k in values)
+    return f"INSERT INTO {table}({columns}) VALUES ({', '.join(_escape(v) for v in values.values())});"
+
+
+def _update(table, set_values, where_values):
+    sets = ', '.join(f'`{k}`={_escape(v)}' for k, v in set_values.items())
+    return f'UPDATE {table} SET {sets} WHERE {_where(where_values)} LIMIT 1;'
+
+
+def _delete(table, values):
+    return f'DELETE FROM {table} WHERE {_where(values)} LIMIT 1;'
+
+
+class BinlogParser(object):
+    def __init__(self, instance, start_file, start_pos=None, end_file=None, end_pos=None,
+                 start_time=None, stop_time=None, only_schemas=None, only_tables=None,
+                 only_dml=True, sql_type=None, no_pk=False, flashback=False):
+        self.instance = instance
+        self.start_file = start_file
+        self.start_pos = start_pos or 4
+        self.end_file = end_file or None
+        self.end_pos = end_pos or None
+        self.start_time = self._timestamp(start_time)
+        self.stop_time = self._timestamp(stop_time)
+        self.only_schemas = [i for i in only_schemas or [] if i] or None
+        self.only_tables = [i for i in only_tables or [] if i] or None
+        self.only_dml = only_dml
+        self.sql_type = sql_type or list(SQL_TYPE_EVENTS)
+        self.no_pk = no_pk
+        self.flashback = flashback
+
+    @staticmethod
+    def _timestamp(value):
+        if not value:
+            return None
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
+
+    def _stream(self, log_file, log_pos):
+        """binlog事件流，库表和语句类型过滤在读取时完成，未命中的行事件不做解码"""
+        only_events = [RotateEvent, TableMapEvent] + [SQL_TYPE_EVENTS[t] for t in self.sql_type
+                                                      if t in SQL_TYPE_EVENTS]
+        if not self.only_dml and not self.flashback:
+            only_events.append(QueryEvent)
+        return BinLogStreamReader(
+            connection_settings={'host': self.instance.host, 'port': int(self.instance.port),
+                                 'user': self.instance.user, 'passwd': self.instance.password,
+                                 'charset': 'utf8mb4'},
+            # 每个解析流使用不同的server_id，避免并行解析时互相断开
+            server_id=random.randint(100000000, 4294967295),
+            log_file=log_file, log_pos=log_pos, resume_stream=True, blocking=False,
+            only_events=only_events, only_schemas=self.only_schemas, only_tables=self.only_tables,
+            skip_to_timestamp=self.start_time)
+
+    def _row_sql(self, event, row):
+        """生成行事件对应的SQL，flashback时生成回滚SQL"""
+        table = f'`{event.schema}`.`{event.table}`'
+        if isinstance(event, WriteRowsEvent):
+            if self.flashback:
+                return _delete(table, row['values'])
+            values = row['values']
+            if self.no_pk and event.primary_key:
+                primary_key = event.primary_key if isinstance(event.primary_key, tuple) else (event.primary_key,)
+                values = collections.OrderedDict((k, v) for k, v in values.items() if k not in primary_key)
+            return _insert(table, values)
+        if isinstance(event, DeleteRowsEvent):
+            if self.flashback:
+                return _insert(table, row['values'])
+            return _delete(table, row['values'])
+        if self.flashback:
+            return _update(table, row['before_values'], row['after_values'])
+        return _update(table, row['after_values'], row['before_values'])
+
+    def events(self, log_file, log_pos, skip=0, end_file=None, end_pos=None):
+        """
+        逐行生成SQL
+        :param log_file: 起始binlog文件
+        :param log_pos: 起始位置
+        :param skip: 起始位置之后需跳过的行数，用于从游标恢复
+        :param end_file: 结束binlog文件，为空时使用解析参数中的结束位置
+        :param end_pos: 结束位置，为空时解析到end_file结束
+        :return: ({'sql', 'binlog_info'}, 下一行的游标)
+        """
+        end_file = end_file or self.end_file
+        end_pos = end_pos if end_file != self.end_file else end_pos or self.end_pos
+        stream = self._stream(log_file, log_pos)
+        current_file = log_file
+        # 续读位置为同一语句的首个TableMapEvent，保证行事件可以解码
+        resume_pos = log_pos
+        rows_after_resume = 0
+        prev_table_map = False
+        try:
+            for event in stream:
+                if isinstance(event, RotateEvent):
+                    if end_file and event.next_binlog > end_file:
+                        break
+                    current_file = event.next_binlog
+                    prev_table_map = False
+                    continue
+                # 未订阅的事件不会返回，起始位置需由事件自身计算
+                next_pos = event.packet.log_pos
+                start_pos = next_pos - event.event_size
+                if end_file and end_pos and (current_file, start_pos) >= (end_file, end_pos):
+                    break
+                if self.stop_time and event.timestamp > self.stop_time:
+                    break
+                if isinstance(event, TableMapEvent):
+                    if not prev_table_map:
+                        resume_pos, rows_after_resume = start_pos, 0
+                    prev_table_map = True
+                    continue
+                prev_table_map = False
+                if self.start_time and event.timestamp < self.start_time:
+                    continue
+                event_time = datetime.datetime.fromtimestamp(event.timestamp)
+                binlog_info = f'start {start_pos} end {next_pos} time {event_time}'
+                if isinstance(event, QueryEvent):
+                    if event.query == 'BEGIN':
+                        continue
+                    schema = event.schema.decode() if isinstance(event.schema, bytes) else event.schema
+                    sql = f'USE `{schema}`;\n{event.query};' if schema else f'{event.query};'
+                    yield {'sql': sql, 'binlog_info': binlog_info}, encode_cursor(current_file, next_pos)
+                    continue
+                for row in event.rows:
+                    rows_after_resume += 1
+                    if rows_after_resume <= skip:
+                        continue
+                    yield {'sql': self._row_sql(event, row), 'binlog_info': binlog_info}, \
+                        encode_cursor(current_file, resume_pos, rows_after_resume)
+                # 续读位置之后的行已全部跳过
+                if rows_after_resume >= skip:
+                    skip = 0
+        finally:
+            stream.close()
+
+    def parse(self, num, cursor=None):
+        """
+        分页解析，flashback时返回结束位置之前的最后num条回滚SQL(倒序)
+        :param num: 返回行数
+        :param cursor: 上一页返回的游标，为空时从起始位置开始
+        :return: (rows, next_cursor)，next_cursor为None时表示已解析完成
+        """
+        log_file, log_pos, skip = decode_cursor(cursor) if cursor else (self.start_file, self.start_pos, 0)
+        if self.flashback:
+            rows = collections.deque(maxlen=num)
+            for row, _ in self.events(log_file, log_pos, skip):
+                rows.append(row)
+            return list(reversed(rows)), None
+        rows = []
+        last_cursor = None
+        for row, row_cursor in self.events(log_file, log_pos, skip):
+            if len(rows) >= num:
+                return rows, last_cursor
+            rows.append(row)
+            last_cursor = row_cursor
+        return rows, None
+
+    def binlog_files(self):
+        """解析范围内的binlog文件列表"""
+        query_result = get_engine(instance=self.instance).query('information_schema', 'show binary logs;')
+        if query_result.error:
+            raise Exception(query_result.error)
+        files = [row[0] for row in query_result.rows]
+        return [f for f in files if f >= self.start_file and (not self.end_file or f <= self.end_file)]
+
+    def _parse_file_part(self, filename, log_file):
+        """解析单个binlog文件到临时文件，flashback时文件内的SQL倒序"""
+        log_pos = self.start_pos if log_file == self.start_file else 4
+        end_pos = self.end_pos if log_file == self.end_file else None
+        lines = [f"{row['sql']} #{row['binlog_info']}\n"
+                 for row, _ in self.events(log_file, log_pos, end_file=log_file, end_pos=end_pos)]
+        if self.flashback:
+            lines.reverse()
+        with open(filename, 'w') as f:
+            f.writelines(lines)
+        return filename
+
+    def parse_to_file(self, filename):
+        """
+        解析全部范围并保存到文件，多个binlog文件并行解析后按顺序合并，flashback时按文件倒序合并
+        :param filename:
+        :return:
+        """
+        files = self.binlog_files()
+        if not files:
+            open(filename, 'w').close()
+            return filename
+        parts = [(f'{filename}.{index}.part', log_file) for index, log_file in enumerate(files)]
+        with ThreadPoolExecutor(max_workers=min(PARSE_WORKERS, len(parts))) as executor:
+            part_files = list(executor.map(lambda part: self._parse_file_part(*part), parts))
+        if self.flashback:
+            part_files.reverse()
+        with open(filename, 'w') as f:
+            for part_file in part_files:
+                with open(part_file) as part:
+                    for line in part:
+                        f.write(line)
+                os.remove(part_file)
+        return filename
@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+"""
+问题诊断采样，定时采集MySQL实例的进程列表、InnoDB事务和锁等待，
+每个实例保存到一个定长的Redis Stream中，问题诊断页面可查询历史采样，事后分析阻塞
+"""
+import datetime
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
+from django_redis import get_redis_connection
+
+from common.utils.extend_json_encoder import ExtendJSONEncoder
+from sql.engines import get_engine
+from sql.models import Instance, AliyunRdsConfig
+
+logger = logging.getLogger('default')
+
+# 并行采样的实例数
+SAMPLE_WORKERS = 8
+SAMPLE_KEY = 'diagnostic_sample:{}'
+# 每分钟采样一次，保留最近一天
+SAMPLE_MAXLEN = 1440
+SAMPLE_TIMEOUT = 86400
+
+PROCESSLIST_SQL = """SELECT id, user, host, db, command, time, state, IFNULL(info,'') AS info
+FROM information_schema.processlist;"""
+TRX_SQL = """SELECT trx_id, trx_state, trx_started, trx_wait_started, trx_mysql_thread_id, trx_query,
+    trx_tables_locked, trx_rows_locked, trx_rows_modified
+FROM information_schema.INNODB_TRX;"""
+# 锁等待链，与问题诊断--锁等待的实时查询共用
+LOCK_WAITS_SQL = """
+SELECT
+  rtrx.`trx_state`                                                        AS "等待的状态",
+  rtrx.`trx_started`                                                      AS "等待事务开始时间",
+  rtrx.`trx_wait_started`                                                 AS "等待事务等待开始时间",
+  lw.`requesting_trx_id`                                                  AS "等待事务ID",
+  rtrx.trx_mysql_thread_id                                                AS "等待事务线程ID",
+  rtrx.`trx_query`                                                        AS "等待事务的sql",
+  CONCAT(rl.`lock_mode`, '-', rl.`lock_table`, '(', rl.`lock_index`, ')') AS "等待的表信息",
+  rl.`lock_id`                                                            AS "等待的锁id",
+  lw.`blocking_trx_id`                                                    AS "运行的事务id",
+  trx.trx_mysql_thread_id                                                 AS "运行的事务线程id",
+  CONCAT(l.`lock_mode`, '-', l.`lock_table`, '(', l.`lock_index`, ')')    AS "运行的表信息",
+  l.lock_id                                                               AS "运行的锁id",
+  trx.`trx_state`                                                         AS "运行事务的状态",
+  trx.`trx_started`                                                       AS "运行事务的时间",
+  trx.`trx_wait_started`                                                  AS "运行事务的等待开始时间",
+  trx.`trx_query`                                                         AS "运行事务的sql"
+FROM information_schema.`INNODB_LOCKS` rl
+  , information_schema.`INNODB_LOCKS` l
+  , information_schema.`INNODB_LOCK_WAITS` lw
+  , information_schema.`INNODB_TRX` rtrx
+  , information_schema.`INNODB_TRX` trx
+WHERE rl.`lock_id` = lw.`requested_lock_id`
+      AND l.`lock_id` = lw.`blocking_lock_id`
+      AND lw.requesting_trx_id = rtrx.trx_id
+      AND lw.blocking_trx_id = trx.trx_id;"""
+# 8.0.1开始锁信息移到performance_schema
+LOCK_WAITS_SQL_80 = """
+SELECT
+  rtrx.`trx_state`                                                           AS "等待的状态",
+  rtrx.`trx_started`                                                         AS "等待事务开始时间",
+  rtrx.`trx_wait_started`                                                    AS "等待事务等待开始时间",
+  lw.`REQUESTING_ENGINE_TRANSACTION_ID`                                      AS "等待事务ID",
+  rtrx.trx_mysql_thread_id                                                   AS "等待事务线程ID",
+  rtrx.`trx_query`                                                           AS "等待事务的sql",
+  CONCAT(rl.`lock_mode`, '-', rl.`OBJECT_SCHEMA`, '(', rl.`INDEX_NAME`, ')') AS "等待的表信息",
+  rl.`ENGINE_LOCK_ID`                                                        AS "等待的锁id",
+  lw.`BLOCKING_ENGINE_TRANSACTION_ID`                                        AS "运行的事务id",
+  trx.trx_mysql_thread_id                                                    AS "运行的事务线程id",
+  CONCAT(l.`lock_mode`, '-', l.`OBJECT_SCHEMA`, '(', l.`INDEX_NAME`, ')')    AS "运行的表信息",
+  l.ENGINE_LOCK_ID                                                           AS "运行的锁id",
+  trx.`trx_state`                                                            AS "运行事务的状态",
+  trx.`trx_started`                                                          AS "运行事务的时间",
+  trx.`trx_wait_started`                                                     AS "运行事务的等待开始时间",
+  trx.`trx_query`                                                            AS "运行事务的sql"
+FROM performance_schema.`data_locks` rl
+  , performance_schema.`data_locks` l
+  , performance_schema.`data_lock_waits` lw
+  , information_schema.`INNODB_TRX` rtrx
+  , information_schema.`INNODB_TRX` trx
+WHERE rl.`ENGINE_LOCK_ID` = lw.`REQUESTING_ENGINE_LOCK_ID`
+      AND l.`ENGINE_LOCK_ID` = lw.`BLOCKING_ENGINE_LOCK_ID`
+      AND lw.REQUESTING_ENGINE_TRANSACTION_ID = rtrx.trx_id
+      AND lw.BLOCKING_ENGINE_TRANSACTION_ID = trx.trx_id;"""
+
+
+def lock_waits_sql(server_version):
+    """锁等待链查询语句"""
+    return LOCK_WAITS_SQL if server_version < (8, 0, 1) else LOCK_WAITS_SQL_80
+
+
+def filter_processlist(rows, command_type):
+    """按command类型过滤进程列表，与实时查询的条件一致"""
+    if command_type == 'All':
+        return rows
+    if command_type == 'Not Sleep':
+        return [row for row in rows if row['command'] != 'Sleep']
+    return [row for row in rows if row['command'] == command_type]
+
+
+def _compact(query_result):
+    return {'column_list': query_result.column_list, 'rows': query_result.rows}
+
+
+def sample_instance(instance):
+    """
+    采样单个实例，仅存在锁等待的事务时才查询锁等待链
+    :param instance: 实例
+    :return: {'processlist', 'trx', 'lock_waits'}，均为{'column_list', 'rows'}
+    """
+    engine = get_engine(instance=instance)
+    processlist = engine.query('information_schema', PROCESSLIST_SQL, close_conn=False)
+    trx = engine.query('information_schema', TRX_SQL, close_conn=False)
+    if processlist.error or trx.error:
+        engine.close()
+        raise Exception(processlist.error or trx.error)
+    sample = {'processlist': _compact(processlist), 'trx': _compact(trx),
+              'lock_waits': {'column_list': [], 'rows': []}}
+    state_index = trx.column_list.index('trx_state')
+    if any(row[state_index] == 'LOCK WAIT' for row in trx.rows):
+        lock_waits = engine.query('information_schema', lock_waits_sql(engine.server_version), close_conn=False)
+        if lock_waits.error:
+            logger.warning(f'锁等待采样失败，实例：{instance.instance_name}，错误信息：{lock_waits.error}')
+        else:
+            sample['lock_waits'] = _compact(lock_waits)
+    engine.close()
+    return sample
+
+
+def save_sample(redis_conn, instance_id, sample):
+    """写入采样结果，超过SAMPLE_MAXLEN的旧采样自动淘汰"""
+    key = SAMPLE_KEY.format(instance_id)
+    data = zlib.compress(json.dumps(sample, cls=ExtendJSONEncoder, bigint_as_string=True).encode())
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.xadd(key, {'data': data}, maxlen=SAMPLE_MAXLEN, approximate=True)
+    # 实例删除后采样数据自动过期
+    pipe.expire(key, SAMPLE_TIMEOUT)
+    pipe.execute()
+
+
+def _decode(entry):
+    """Stream ID为写入时的毫秒时间戳，作为采样时间"""
+    entry_id, fields = entry
+    entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+    sample = json.loads(zlib.decompress(fields[b'data']))
+    sample_time = datetime.datetime.fromtimestamp(int(entry_id.split('-')[0]) / 1000)
+    sample['sample_time'] = sample_time.strftime('%Y-%m-%d %H:%M:%S')
+    for name in ('processlist', 'trx', 'lock_waits'):
+        column_list = sample[name]['column_list']
+        sample[name] = [dict(zip(column_list, row)) for row in sample[name]['rows']]
+    return sample
+
+
+def get_sample(instance_id, sample_time):
+    """
+    获取指定时间之前最近的一次采样
+    :param instance_id: 实例ID
+    :param sample_time: 采样时间，datetime
+    :return: {'sample_time', 'processlist', 'trx', 'lock_waits'}，不存在时返回None
+    """
+    redis_conn = get_redis_connection('default')
+    # 不含序号的ID作为上界时包含该毫秒内的全部采样
+    max_id = str(int(sample_time.timestamp() * 1000))
+    entries = redis_conn.xrevrange(SAMPLE_KEY.format(instance_id), max=max_id, min='-', count=1)
+    return _decode(entries[0]) if entries else None
+
+
+def collect():
+    """并行采样全部MySQL实例，阿里云RDS实例通过接口获取，不采样"""
+    rds = AliyunRdsConfig.objects.filter(is_enable=True).values_list('instance_id', flat=True)
+    instances = list(Instance.objects.filter(db_type='mysql').exclude(id__in=list(rds)))
+    if not instances:
+        return 0
+    redis_conn = get_redis_connection('default')
+
+    def sample(instance):
+        try:
+            save_sample(redis_conn, instance.id, sample_instance(instance))
+            return 1
+        except Exception as e:
+            logger.warning(f'问题诊断采样失败，实例：{instance.instance_name}，错误信息：{e}')
+            return 0
+
+    with ThreadPoolExecutor(max_workers=min(SAMPLE_WORKERS, len(instances))) as executor:
+        count = sum(executor.map(sample, instances))
+    logger.debug(f'问题诊断采样完成，实例数：{count}')
+    return count
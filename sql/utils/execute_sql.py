@@ -56,7 +56,8 @@ def execute_callback(task):
         logger.debug("Debug result {0}, {1}".format(type(exe_results), exe_results))
         for exe_result in exe_results:
             res_error = exe_result["errormessage"]
-            if res_error:
+            # 非MySQL引擎执行成功的语句errormessage为'None'
+            if res_error and res_error != 'None':
                 logger.error("Execute sql error:{0}".format(res_error))
                 result_error.append(res_error)
 
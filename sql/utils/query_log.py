@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+"""
+在线查询日志写入，开启query_log_async配置后先写入Redis队列，由定时任务批量入库，Redis不可用时同步写入
+批量入库定时任务在保存配置时添加
+"""
+import datetime
+import logging
+
+import simplejson as json
+from django.db import transaction
+from django_q.tasks import async_task
+from django_redis import get_redis_connection
+
+from common.config import SysConfig
+from sql.models import QueryLog
+
+logger = logging.getLogger('default')
+
+# 待写入队列，生产者LPUSH，消费者RPOPLPUSH到处理中队列，入库成功后删除处理中队列，保证至少写入一次
+BUFFER_KEY = 'query_log:buffer'
+PROCESSING_KEY = 'query_log:processing'
+FLUSH_LOCK_KEY = 'query_log:flush_lock'
+FLUSH_BATCH_SIZE = 500
+
+
+def _serialize(query_log):
+    """将未保存的QueryLog转换为json，保留生成时间"""
+    data = {f.attname: getattr(query_log, f.attname) for f in QueryLog._meta.concrete_fields
+            if f.attname not in ('id', 'sys_time')}
+    data['create_time'] = (query_log.create_time or datetime.datetime.now()).strftime('%Y-%m-%d %H:%M:%S.%f')
+    return json.dumps(data)
+
+
+def _deserialize(item):
+    data = json.loads(item)
+    data['create_time'] = datetime.datetime.strptime(data['create_time'], '%Y-%m-%d %H:%M:%S.%f')
+    return QueryLog(**data)
+
+
+def save_query_log(query_log):
+    """
+    保存查询日志，异步写入失败时同步写入
+    :param query_log: 未保存的QueryLog对象
+    :return:
+    """
+    if SysConfig().get('query_log_async'):
+        try:
+            redis_conn = get_redis_connection('default')
+            length = redis_conn.lpush(BUFFER_KEY, _serialize(query_log))
+            # 积压达到一个批次时立即触发一次入库，无需等待定时任务
+            if length == FLUSH_BATCH_SIZE:
+                async_task('sql.utils.query_log.flush_query_log')
+            return
+        except Exception as e:
+            logger.warning(f'查询日志写入队列失败，改为同步写入，错误信息：{e}')
+    query_log.save()
+
+
+def _write(items):
+    """批量入库"""
+    query_logs = [_deserialize(item) for item in items]
+    with transaction.atomic():
+        QueryLog.objects.bulk_create(query_logs, batch_size=FLUSH_BATCH_SIZE)
+    return len(query_logs)
+
+
+def flush_query_log(batch_size=FLUSH_BATCH_SIZE):
+    """
+    将队列中的查询日志批量写入数据库，由定时任务调用
+    :param batch_size: 每批次写入的条数
+    :return: 写入条数
+    """
+    redis_conn = get_redis_connection('default')
+    lock = redis_conn.lock(FLUSH_LOCK_KEY, timeout=300)
+    if not lock.acquire(blocking=False):
+        logger.debug('查询日志批量写入任务正在执行，跳过')
+        return 0
+    count = 0
+    try:
+        # 上次入库失败遗留的数据优先写入
+        pending = redis_conn.lrange(PROCESSING_KEY, 0, -1)
+        if pending:
+            count += _write(pending)
+            redis_conn.delete(PROCESSING_KEY)
+        while True:
+            pipe = redis_conn.pipeline(transaction=False)
+            for _ in range(batch_size):
+                pipe.rpoplpush(BUFFER_KEY, PROCESSING_KEY)
+            items = [item for item in pipe.execute() if item is not None]
+            if not items:
+                break
+            count += _write(items)
+            redis_conn.delete(PROCESSING_KEY)
+            if len(items) < batch_size:
+                break
+    finally:
+        lock.release()
+    if count:
+        logger.debug(f'查询日志批量写入完成，写入条数：{count}')
+    return count
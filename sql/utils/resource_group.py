@@ -1,6 +1,83 @@
 # -*- coding: UTF-8 -*-
 
-from sql.models import Users, Instance, ResourceGroup, ResourceGroup2Instance
+import logging
+import time
+
+from django.core.cache import cache
+
+from sql.models import Instance, ResourceGroup, InstanceTagRelations
+
+logger = logging.getLogger('default')
+
+# 用户可访问实例映射缓存，资源组、实例、标签及关联关系变更时递增版本号使全部用户的缓存失效
+ACCESS_MAP_VERSION_KEY = 'user_instances_version'
+ACCESS_MAP_TIMEOUT = 86400
+
+
+def _access_map_version():
+    """获取实例访问映射的版本号，不存在时初始化"""
+    version = cache.get(ACCESS_MAP_VERSION_KEY)
+    if version is None:
+        cache.add(ACCESS_MAP_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(ACCESS_MAP_VERSION_KEY)
+    return version
+
+
+def invalidate_access_map():
+    """使所有用户的实例访问映射失效，由信号或批量变更关联关系时调用"""
+    try:
+        cache.incr(ACCESS_MAP_VERSION_KEY)
+    except ValueError:
+        cache.set(ACCESS_MAP_VERSION_KEY, int(time.time() * 1000), timeout=None)
+    except Exception as e:
+        logger.error(f'更新实例访问映射版本号失败，错误信息：{e}')
+
+
+def _build_access_map(instances):
+    """
+    生成实例访问映射，按实例类型、数据库类型、标签分组的实例ID列表
+    :param instances: 可访问的实例
+    :return: {'all': [id], 'type': {type: [id]}, 'db_type': {db_type: [id]}, 'tag': {tag_code: [id]}}
+    """
+    access_map = {'all': [], 'type': {}, 'db_type': {}, 'tag': {}}
+    for ins in instances.values('id', 'type', 'db_type'):
+        access_map['all'].append(ins['id'])
+        access_map['type'].setdefault(ins['type'], []).append(ins['id'])
+        access_map['db_type'].setdefault(ins['db_type'], []).append(ins['id'])
+    tags = InstanceTagRelations.objects.filter(instance_id__in=access_map['all'], active=True,
+                                               instance_tag__active=True
+                                               ).values_list('instance_id', 'instance_tag__tag_code')
+    for instance_id, tag_code in tags:
+        access_map['tag'].setdefault(tag_code, []).append(instance_id)
+    return access_map
+
+
+def user_access_map(user):
+    """
+    获取用户的实例访问映射，优先读取缓存，拥有所有实例权限的用户共用一份
+    :param user:
+    :return:
+    """
+    query_all_instances = user.has_perm('sql.query_all_instances')
+    try:
+        cache_key = f"user_instances:{'all' if query_all_instances else user.id}:{_access_map_version()}"
+        access_map = cache.get(cache_key)
+    except Exception as e:
+        logger.error(f'读取实例访问映射缓存失败，错误信息：{e}')
+        cache_key, access_map = None, None
+    if access_map is None:
+        if query_all_instances:
+            instances = Instance.objects.all()
+        else:
+            # 通过资源组间接关联的实例
+            instances = Instance.objects.filter(resourcegroup__users=user).distinct()
+        access_map = _build_access_map(instances)
+        if cache_key:
+            try:
+                cache.set(cache_key, access_map, timeout=ACCESS_MAP_TIMEOUT)
+            except Exception as e:
+                logger.error(f'更新实例访问映射缓存失败，错误信息：{e}')
+    return access_map
 
 
 def user_groups(user):
@@ -12,45 +89,35 @@ def user_groups(user):
     if user.is_superuser:
         group_list = [group for group in ResourceGroup.objects.filter(is_deleted=0)]
     else:
-        group_list = [group for group in Users.objects.get(id=user.id).resourcegroup_set.filter(is_deleted=0)]
+        group_list = [group for group in ResourceGroup.objects.filter(users=user, is_deleted=0)]
     return group_list
 
 
 def user_instances(user, type=None, db_type=None, tag_codes=None):
     """
-    获取用户实例列表（通过资源组间接关联）
+    获取用户实例列表（通过资源组间接关联），根据缓存的实例访问映射计算实例ID
     :param user:
     :param type: 实例类型 all：全部，master主库，salve从库
     :param db_type: 数据库类型, ['mysql','mssql']
     :param tag_codes: 标签code列表, ['can_write', 'can_read']
     :return:
     """
-    # 拥有所有实例权限的用户
-    if user.has_perm('sql.query_all_instances'):
-        instances = Instance.objects.all()
-    else:
-        # 先获取用户关联的资源组
-        resource_groups = ResourceGroup.objects.filter(users=user)
-        # 再获取资源组和实例的关联关系
-        resource_group2instance = ResourceGroup2Instance.objects.filter(resource_group__in=resource_groups)
-        # 再获取实例
-        instances = Instance.objects.filter(resourcegroup2instance__in=resource_group2instance)
+    access_map = user_access_map(user)
+    instance_ids = set(access_map['all'])
     # 过滤type
     if type:
-        instances = instances.filter(type=type)
+        instance_ids &= set(access_map['type'].get(type, []))
 
     # 过滤db_type
     if db_type:
-        instances = instances.filter(db_type__in=db_type)
+        instance_ids &= set(i for t in db_type for i in access_map['db_type'].get(t, []))
 
     # 过滤tag
     if tag_codes:
         for tag_code in tag_codes:
-            instances = instances.filter(instancetag__tag_code=tag_code,
-                                         instancetag__active=True,
-                                         instancetagrelations__active=True)
+            instance_ids &= set(access_map['tag'].get(tag_code, []))
 
-    return instances.distinct()
+    return Instance.objects.filter(id__in=instance_ids)
 
 
 def auth_group_users(auth_group_names, group_id):
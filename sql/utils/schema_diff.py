@@ -0,0 +1,328 @@
+# -*- coding: UTF-8 -*-
+"""
+MySQL表结构对比，批量读取information_schema构建表结构模型，在内存中对比并生成变更和回滚DDL
+变更DDL作用于目标库，使目标库与源库结构一致
+"""
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pymysql.converters import escape_string
+
+from sql.engines import get_engine
+
+logger = logging.getLogger('default')
+
+# 每次查询的数据库个数
+LOAD_CHUNK_SIZE = 50
+# 并行读取的查询数
+LOAD_WORKERS = 8
+
+TABLES_SQL = """SELECT TABLE_SCHEMA, TABLE_NAME, ENGINE, TABLE_COLLATION, AUTO_INCREMENT, TABLE_COMMENT
+FROM information_schema.TABLES
+WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA IN ({schemas});"""
+
+COLUMNS_SQL = """SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_DEFAULT,
+    CHARACTER_SET_NAME, COLLATION_NAME, EXTRA, COLUMN_COMMENT, GENERATION_EXPRESSION
+FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA IN ({schemas})
+ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION;"""
+
+STATISTICS_SQL = """SELECT TABLE_SCHEMA, TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME, SUB_PART, INDEX_TYPE
+FROM information_schema.STATISTICS
+WHERE TABLE_SCHEMA IN ({schemas})
+ORDER BY TABLE_SCHEMA, TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;"""
+
+FOREIGN_KEYS_SQL = """SELECT k.TABLE_SCHEMA, k.TABLE_NAME, k.CONSTRAINT_NAME, k.COLUMN_NAME,
+    k.REFERENCED_TABLE_SCHEMA, k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME, r.UPDATE_RULE, r.DELETE_RULE
+FROM information_schema.KEY_COLUMN_USAGE k
+JOIN information_schema.REFERENTIAL_CONSTRAINTS r
+    ON r.CONSTRAINT_SCHEMA = k.CONSTRAINT_SCHEMA AND r.CONSTRAINT_NAME = k.CONSTRAINT_NAME
+WHERE k.TABLE_SCHEMA IN ({schemas}) AND k.REFERENCED_TABLE_NAME IS NOT NULL
+ORDER BY k.TABLE_SCHEMA, k.TABLE_NAME, k.CONSTRAINT_NAME, k.ORDINAL_POSITION;"""
+
+
+def _query(instance, sql):
+    # 每个线程使用独立的engine，避免共用连接池
+    query_result = get_engine(instance=instance).query('information_schema', sql)
+    if query_result.error:
+        raise Exception(query_result.error)
+    return query_result.rows
+
+
+def _load_chunk(instance, db_names):
+    """读取一批数据库的表结构，无论数据库个数均只执行4次查询"""
+    schemas = ','.join(f"'{escape_string(db_name)}'" for db_name in db_names)
+    model = {db_name: OrderedDict() for db_name in db_names}
+    for schema, table, engine, collation, auto_increment, comment in _query(
+            instance, TABLES_SQL.format(schemas=schemas)):
+        model[schema][table] = {
+            'options': {'engine': engine, 'collation': collation, 'auto_increment': auto_increment,
+                        'comment': comment},
+            'columns': OrderedDict(),
+            'indexes': OrderedDict(),
+            'foreign_keys': OrderedDict()}
+    for schema, table, column, column_type, nullable, default, charset, collation, extra, comment, expression \
+            in _query(instance, COLUMNS_SQL.format(schemas=schemas)):
+        if table in model[schema]:
+            generated = _generated(extra, expression)
+            if generated:
+                extra = ''
+            model[schema][table]['columns'][column] = {
+                'type': column_type, 'nullable': nullable == 'YES',
+                'default': _default_expression(default, column_type, extra), 'charset': charset,
+                'collation': collation, 'extra': extra.replace('DEFAULT_GENERATED', '').strip(), 'comment': comment,
+                'generated': generated}
+    for schema, table, index, non_unique, column, sub_part, index_type in _query(
+            instance, STATISTICS_SQL.format(schemas=schemas)):
+        if table in model[schema]:
+            index_info = model[schema][table]['indexes'].setdefault(
+                index, {'unique': not int(non_unique), 'type': index_type, 'columns': []})
+            index_info['columns'].append((column, sub_part))
+    for schema, table, name, column, ref_schema, ref_table, ref_column, update_rule, delete_rule in _query(
+            instance, FOREIGN_KEYS_SQL.format(schemas=schemas)):
+        if table in model[schema]:
+            # 引用同库的表时不记录库名，不同名数据库之间可以对比
+            fk = model[schema][table]['foreign_keys'].setdefault(
+                name, {'columns': [], 'ref_schema': None if ref_schema == schema else ref_schema, 'ref_table': ref_table, 'ref_columns': [],
+                       'update_rule': update_rule, 'delete_rule': delete_rule})
+            fk['columns'].append(column)
+            fk['ref_columns'].append(ref_column)
+    return model
+
+
+def load_schemas(instance, db_names):
+    """
+    读取多个数据库的表结构模型
+    :param instance: 实例
+    :param db_names: 数据库列表
+    :return: {db_name: {table_name: {'options', 'columns', 'indexes', 'foreign_keys'}}}
+    """
+    return _load_parallel([(instance, db_names)])[0]
+
+
+def _load_parallel(jobs):
+    """并行读取多组(instance, db_names)，按组返回表结构模型"""
+    results = [{} for _ in jobs]
+    tasks = [(index, instance, db_names[i:i + LOAD_CHUNK_SIZE])
+             for index, (instance, db_names) in enumerate(jobs)
+             for i in range(0, len(db_names), LOAD_CHUNK_SIZE)]
+    if not tasks:
+        return results
+    with ThreadPoolExecutor(max_workers=min(LOAD_WORKERS, len(tasks))) as executor:
+        for (index, _, _), model in zip(tasks, executor.map(lambda task: _load_chunk(*task[1:]), tasks)):
+            results[index].update(model)
+    return results
+
+
+def _quote(name):
+    return '`{}`'.format(name.replace('`', '``'))
+
+
+def _literal(value):
+    return "'{}'".format(escape_string(str(value)))
+
+
+def _generated(extra, expression):
+    """生成列的定义，EXTRA为VIRTUAL GENERATED或STORED GENERATED，非生成列返回None"""
+    for storage in ('VIRTUAL', 'STORED'):
+        if f'{storage} GENERATED' in extra.upper():
+            return f'GENERATED ALWAYS AS ({expression}) {storage}'
+    return None
+
+
+def _default_expression(default, column_type, extra):
+    """
+    字段默认值在DDL中的写法，MySQL 5.7与8.0的结果一致，对比时不产生差异
+    MySQL 8.0表达式默认值的EXTRA包含DEFAULT_GENERATED，需加括号，CURRENT_TIMESTAMP可直接使用
+    bit类型的默认值为b'0'格式，不加引号
+    """
+    if default is None:
+        return None
+    if default.upper().startswith('CURRENT_TIMESTAMP') or default.startswith('('):
+        return default
+    if 'DEFAULT_GENERATED' in extra.upper():
+        return f'({default})'
+    if column_type.lower().startswith('bit') and default.lower().startswith("b'"):
+        return default
+    return _literal(default)
+
+
+def column_definition(name, column, sync_comments=True):
+    """字段定义"""
+    sql = f"{_quote(name)} {column['type']}"
+    if column['charset']:
+        sql += f" CHARACTER SET {column['charset']} COLLATE {column['collation']}"
+    # 生成列的定义需在NULL属性之前，且不能指定默认值
+    if column.get('generated'):
+        sql += f" {column['generated']}"
+    sql += ' NULL' if column['nullable'] else ' NOT NULL'
+    if column['default'] is not None:
+        sql += f" DEFAULT {column['default']}"
+    elif column['nullable'] and not column.get('generated'):
+        sql += ' DEFAULT NULL'
+    if column['extra']:
+        sql += f" {column['extra']}"
+    if sync_comments and column['comment']:
+        sql += f" COMMENT {_literal(column['comment'])}"
+    return sql
+
+
+def index_definition(name, index):
+    """索引定义"""
+    columns = ','.join(_quote(column) + (f'({sub_part})' if sub_part else '')
+                       for column, sub_part in index['columns'])
+    if name == 'PRIMARY':
+        return f'PRIMARY KEY ({columns})'
+    if index['type'] in ('FULLTEXT', 'SPATIAL'):
+        return f"{index['type']} KEY {_quote(name)} ({columns})"
+    return f"{'UNIQUE ' if index['unique'] else ''}KEY {_quote(name)} ({columns})"
+
+
+def foreign_key_definition(name, fk):
+    """外键定义，引用同库的表时不指定库名"""
+    columns = ','.join(_quote(i) for i in fk['columns'])
+    ref_columns = ','.join(_quote(i) for i in fk['ref_columns'])
+    ref_table = _quote(fk['ref_table'])
+    if fk['ref_schema']:
+        ref_table = f"{_quote(fk['ref_schema'])}.{ref_table}"
+    return (f"CONSTRAINT {_quote(name)} FOREIGN KEY ({columns}) REFERENCES {ref_table} "
+            f"({ref_columns}) ON DELETE {fk['delete_rule']} ON UPDATE {fk['update_rule']}")
+
+
+def table_options(options, sync_auto_inc=False, sync_comments=True):
+    """表选项"""
+    sql = f"ENGINE={options['engine']}"
+    if options['collation']:
+        sql += f" DEFAULT CHARSET={options['collation'].split('_')[0]} COLLATE={options['collation']}"
+    if sync_auto_inc and options['auto_increment']:
+        sql += f" AUTO_INCREMENT={options['auto_increment']}"
+    if sync_comments and options['comment']:
+        sql += f" COMMENT={_literal(options['comment'])}"
+    return sql
+
+
+def create_table(name, table, sync_auto_inc=False, sync_comments=True):
+    """根据表结构模型生成建表语句"""
+    lines = [column_definition(column_name, column, sync_comments)
+             for column_name, column in table['columns'].items()]
+    lines += [index_definition(index_name, index) for index_name, index in table['indexes'].items()]
+    lines += [foreign_key_definition(fk_name, fk) for fk_name, fk in table['foreign_keys'].items()]
+    body = ',\n  '.join(lines)
+    return f"CREATE TABLE {_quote(name)} (\n  {body}\n) {table_options(table['options'], sync_auto_inc, sync_comments)};"
+
+
+def _drop_index(name):
+    return 'DROP PRIMARY KEY' if name == 'PRIMARY' else f'DROP INDEX {_quote(name)}'
+
+
+def _alter_clauses(source, target, sync_auto_inc, sync_comments):
+    """生成将target修改为source的ALTER子句"""
+    drop_fks, drops, columns, adds = [], [], [], []
+    # 先删除外键和索引，再变更字段，最后新增索引和外键
+    for name, fk in target['foreign_keys'].items():
+        if source['foreign_keys'].get(name) != fk:
+            drop_fks.append(f'DROP FOREIGN KEY {_quote(name)}')
+    for name, index in target['indexes'].items():
+        if source['indexes'].get(name) != index:
+            drops.append(_drop_index(name))
+    for name in target['columns']:
+        if name not in source['columns']:
+            columns.append(f'DROP COLUMN {_quote(name)}')
+
+    def comparable(column):
+        return column if sync_comments else dict(column, comment=None)
+
+    # 新增和位置变化的字段按源表顺序指定位置
+    target_order = [name for name in target['columns'] if name in source['columns']]
+    source_order = [name for name in source['columns'] if name in target['columns']]
+    previous = None
+    for name, column in source['columns'].items():
+        position = f' AFTER {_quote(previous)}' if previous else ' FIRST'
+        definition = column_definition(name, column, sync_comments)
+        if name not in target['columns']:
+            columns.append(f'ADD COLUMN {definition}{position}')
+        elif comparable(target['columns'][name]) != comparable(column):
+            columns.append(f'MODIFY COLUMN {definition}{position}')
+        elif target_order.index(name) != source_order.index(name):
+            columns.append(f'MODIFY COLUMN {definition}{position}')
+        previous = name
+
+    for name, index in source['indexes'].items():
+        if target['indexes'].get(name) != index:
+            adds.append(f'ADD {index_definition(name, index)}')
+    for name, fk in source['foreign_keys'].items():
+        if target['foreign_keys'].get(name) != fk:
+            adds.append(f'ADD {foreign_key_definition(name, fk)}')
+
+    options = []
+    source_options, target_options = source['options'], target['options']
+    if source_options['engine'] != target_options['engine']:
+        options.append(f"ENGINE={source_options['engine']}")
+    if source_options['collation'] != target_options['collation'] and source_options['collation']:
+        options.append(f"DEFAULT CHARSET={source_options['collation'].split('_')[0]} "
+                       f"COLLATE={source_options['collation']}")
+    if sync_auto_inc and source_options['auto_increment'] != target_options['auto_increment'] \
+            and source_options['auto_increment']:
+        options.append(f"AUTO_INCREMENT={source_options['auto_increment']}")
+    if sync_comments and source_options['comment'] != target_options['comment']:
+        options.append(f"COMMENT={_literal(source_options['comment'] or '')}")
+    return drop_fks + drops + columns + adds + options
+
+
+def _alter_table(name, clauses):
+    return f"ALTER TABLE {_quote(name)}\n  " + ',\n  '.join(clauses) + ';'
+
+
+def diff_database(source, target, sync_auto_inc=False, sync_comments=False):
+    """
+    对比单个数据库
+    :param source: 源库表结构模型 {table_name: table}
+    :param target: 目标库表结构模型
+    :return: (diff, patch, revert) 差异说明、变更语句、回滚语句列表
+    """
+    diff, patch, revert = [], [], []
+    for name, table in source.items():
+        if name not in target:
+            diff.append(f'新增表 {name}')
+            patch.append(create_table(name, table, sync_auto_inc, sync_comments))
+            revert.append(f'DROP TABLE {_quote(name)};')
+            continue
+        clauses = _alter_clauses(table, target[name], sync_auto_inc, sync_comments)
+        if clauses:
+            diff.append(f'修改表 {name}')
+            patch.append(_alter_table(name, clauses))
+            revert.append(_alter_table(name, _alter_clauses(target[name], table, sync_auto_inc, sync_comments)))
+    for name, table in target.items():
+        if name not in source:
+            diff.append(f'删除表 {name}')
+            patch.append(f'DROP TABLE {_quote(name)};')
+            revert.append(create_table(name, table, sync_auto_inc, sync_comments))
+    return diff, patch, revert
+
+
+def schema_diff(instance, db_name, target_instance, target_db_name, sync_auto_inc=False, sync_comments=False):
+    """
+    对比两个实例的数据库结构，db_name为*时对比两个实例中的同名数据库
+    :return: {'diff', 'patch', 'revert'}，多个数据库时按库生成USE语句
+    """
+    if db_name == '*':
+        source_dbs = get_engine(instance=instance).get_all_databases().rows
+        target_dbs = get_engine(instance=target_instance).get_all_databases().rows
+        pairs = [(db, db) for db in source_dbs if db in target_dbs]
+        missing = [db for db in source_dbs if db not in target_dbs]
+    else:
+        pairs, missing = [(db_name, target_db_name)], []
+    source_model, target_model = _load_parallel([(instance, [pair[0] for pair in pairs]),
+                                                 (target_instance, [pair[1] for pair in pairs])])
+    result = {'diff': [f'目标实例不存在数据库 {db}' for db in missing], 'patch': [], 'revert': []}
+    for source_db, target_db in pairs:
+        diff, patch, revert = diff_database(source_model.get(source_db, {}), target_model.get(target_db, {}),
+                                            sync_auto_inc, sync_comments)
+        if not diff:
+            continue
+        result['diff'] += [f'{target_db}: {line}' for line in diff]
+        use = [f'USE {_quote(target_db)};'] if len(pairs) > 1 else []
+        result['patch'] += use + patch
+        result['revert'] += use + revert[::-1]
+    return result
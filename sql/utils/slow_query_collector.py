@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志采集，定时读取MySQL实例performance_schema.events_statements_summary_by_digest，
+与上次快照的累计值做差，平均执行时长超过long_query_time的语句写入慢日志明细
+"""
+import datetime
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import transaction
+
+from common.utils.chart_rollup import add_slow_query_stats
+from sql.engines import get_engine
+from sql.models import Instance, AliyunRdsConfig, SlowQuery, SlowQueryHistory
+
+logger = logging.getLogger('default')
+
+# 并行采集的实例数
+COLLECT_WORKERS = 8
+SNAPSHOT_KEY = 'slow_query_digest:{}'
+SNAPSHOT_TIMEOUT = 86400
+# 计时单位为皮秒
+PICOSECOND = 1000000000000
+
+DIGEST_SQL = """SELECT SCHEMA_NAME, DIGEST, DIGEST_TEXT, COUNT_STAR, SUM_TIMER_WAIT, MAX_TIMER_WAIT, SUM_LOCK_TIME,
+    SUM_ROWS_SENT, SUM_ROWS_EXAMINED, SUM_ROWS_AFFECTED, SUM_NO_INDEX_USED, SUM_CREATED_TMP_TABLES,
+    SUM_CREATED_TMP_DISK_TABLES, SUM_SORT_MERGE_PASSES, SUM_SORT_SCAN
+FROM performance_schema.events_statements_summary_by_digest
+WHERE DIGEST IS NOT NULL;"""
+# 需做差的累计值，与DIGEST_SQL中COUNT_STAR开始的字段一一对应，MAX_TIMER_WAIT不做差
+COUNTERS = ('ts_cnt', 'query_time_sum', 'query_time_max', 'lock_time_sum', 'rows_sent_sum', 'rows_examined_sum',
+            'rows_affected_sum', 'full_scan_sum', 'tmp_table_sum', 'tmp_table_on_disk_sum', 'merge_passes_sum',
+            'filesort_sum')
+TIMERS = ('query_time_sum', 'query_time_max', 'lock_time_sum')
+
+
+def _checksum(hostname, schema, digest):
+    """不同实例、不同库的相同语句分别统计，避免同一时间段的明细冲突"""
+    return hashlib.md5(f'{hostname}:{schema}:{digest}'.encode()).hexdigest()
+
+
+def _delta(current, previous):
+    """计算两次快照的差值，计数器被重置(实例重启、truncate)时直接使用当前值"""
+    if previous is None or current['ts_cnt'] < previous['ts_cnt']:
+        return dict(current)
+    delta = {k: current[k] - previous[k] for k in COUNTERS}
+    delta['query_time_max'] = current['query_time_max']
+    return delta
+
+
+def sample_instance(instance, now=None):
+    """
+    采集单个实例，返回本次与上次快照之间的慢日志明细，不写入数据库
+    :param instance: 实例
+    :param now: 采集时间(UTC)，与pt-query-digest保持一致
+    :return: (SlowQuery列表, SlowQueryHistory列表)
+    """
+    now = now or datetime.datetime.utcnow().replace(microsecond=0)
+    engine = get_engine(instance=instance)
+    long_query_time = engine.query(sql='SELECT @@long_query_time;', close_conn=False)
+    query_result = engine.query(sql=DIGEST_SQL)
+    if long_query_time.error or query_result.error:
+        raise Exception(long_query_time.error or query_result.error)
+    long_query_time = float(long_query_time.rows[0][0])
+
+    snapshot_key = SNAPSHOT_KEY.format(instance.id)
+    previous = cache.get(snapshot_key)
+    hostname = f'{instance.host}:{instance.port}'
+    current = {}
+    texts = {}
+    for row in query_result.rows:
+        checksum = _checksum(hostname, row[0], row[1])
+        current[checksum] = {k: float(v or 0) for k, v in zip(COUNTERS, row[3:])}
+        texts[checksum] = (row[0], row[2])
+    cache.set(snapshot_key, {'time': now, 'rows': current}, SNAPSHOT_TIMEOUT)
+    # 首次采集只记录快照
+    if not previous:
+        return [], []
+
+    slow_queries, histories = [], []
+    for checksum, counters in current.items():
+        delta = _delta(counters, previous['rows'].get(checksum))
+        if delta['ts_cnt'] <= 0:
+            continue
+        for key in TIMERS:
+            delta[key] = delta[key] / PICOSECOND
+        if delta['query_time_sum'] / delta['ts_cnt'] < long_query_time:
+            continue
+        schema, text = texts[checksum]
+        slow_queries.append(SlowQuery(checksum=checksum, fingerprint=text, sample=text,
+                                      first_seen=previous['time'], last_seen=now))
+        histories.append(SlowQueryHistory(hostname_max=hostname, user_max='', db_max=schema,
+                                          checksum_id=checksum, sample=text,
+                                          ts_min=previous['time'], ts_max=now, **delta))
+    return slow_queries, histories
+
+
+def save_samples(slow_queries, histories):
+    """写入采集结果，已存在的语句仅更新最后出现时间"""
+    if not histories:
+        return 0
+    checksums = [i.checksum for i in slow_queries]
+    with transaction.atomic():
+        exists = set(SlowQuery.objects.filter(checksum__in=checksums).values_list('checksum', flat=True))
+        SlowQuery.objects.bulk_create([i for i in slow_queries if i.checksum not in exists])
+        SlowQuery.objects.filter(checksum__in=exists).update(last_seen=slow_queries[0].last_seen)
+        SlowQueryHistory.objects.bulk_create(histories)
+        add_slow_query_stats(histories)
+    return len(histories)
+
+
+def collect():
+    """并行采集全部MySQL实例，阿里云RDS实例通过接口获取慢日志，不采集"""
+    rds = AliyunRdsConfig.objects.filter(is_enable=True).values_list('instance_id', flat=True)
+    instances = list(Instance.objects.filter(db_type='mysql').exclude(id__in=list(rds)))
+    if not instances:
+        return 0
+
+    def sample(instance):
+        try:
+            return sample_instance(instance)
+        except Exception as e:
+            logger.warning(f'慢日志采集失败，实例：{instance.instance_name}，错误信息：{e}')
+            return [], []
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=min(COLLECT_WORKERS, len(instances))) as executor:
+        # 数据库写入在当前线程完成，采集线程只访问目标实例
+        for (slow_queries, histories), instance in zip(executor.map(sample, instances), instances):
+            try:
+                count += save_samples(slow_queries, histories)
+            except Exception as e:
+                logger.error(f'慢日志写入失败，实例：{instance.instance_name}，错误信息：{e}')
+    logger.debug(f'慢日志采集完成，写入条数：{count}')
+    return count
@@ -2,9 +2,17 @@
 
 __author__ = 'sunnywalden@gmail.com'
 
+import collections
+import logging
+import threading
+import time
+import weakref
+
 import MySQLdb
 from DBUtils.PooledDB import PooledDB
 
+logger = logging.getLogger('default')
+
 
 def setup_conn(host, port, creator=MySQLdb, charset='utf8', **args):
     """创建数据库连接池"""
@@ -23,3 +31,161 @@ def shutdown_conn(pool=None):
     """关闭数据库连接池"""
     if pool:
         pool.close()
+
+
+# 非MySQL引擎的连接池，按实例缓存，进程内复用
+POOL_MAX_SIZE = 10
+# 空闲超过该时间(秒)的连接不再复用，避免使用被服务端断开的连接
+POOL_MAX_IDLE_TIME = 300
+# 连接池已满时等待归还的时间(秒)
+POOL_WAIT_TIMEOUT = 30
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class Lease(object):
+    """
+    连接池借出的连接，代理DB-API连接的属性和方法
+    未归还即被回收时由finalizer关闭连接并释放连接池容量，记录连接泄漏
+    """
+
+    def __init__(self, raw, on_leak):
+        object.__setattr__(self, 'raw', raw)
+        object.__setattr__(self, '_finalizer', weakref.finalize(self, on_leak, raw))
+
+    def detach(self):
+        """标记为已归还，返回是否为首次归还"""
+        return self._finalizer.detach() is not None
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.raw, name, value)
+
+
+class ConnectionPool(object):
+    """
+    通用连接池，acquire获取连接的Lease，release归还时重置会话状态
+    :param connect: 创建连接的函数
+    :param reset: 归还时回滚事务、重置会话状态的函数，参数为连接，执行失败时关闭该连接
+    :param max_size: 最大连接数
+    """
+
+    def __init__(self, connect, reset=None, max_size=POOL_MAX_SIZE):
+        self.connect = connect
+        self.reset = reset
+        self.max_size = max_size
+        self._idle = collections.deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self.metrics = collections.Counter()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                # 优先复用最近归还的连接，过期的连接直接关闭
+                while self._idle:
+                    conn, released_at = self._idle.pop()
+                    if time.time() - released_at < POOL_MAX_IDLE_TIME:
+                        self._in_use += 1
+                        self.metrics['acquired'] += 1
+                        self.metrics['reused'] += 1
+                        return Lease(conn, self._leaked)
+                    self._discard(conn)
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    break
+                self.metrics['waits'] += 1
+                if not self._cond.wait(POOL_WAIT_TIMEOUT):
+                    raise TimeoutError(f'等待数据库连接超时，连接池已满({self.max_size})')
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.metrics['acquired'] += 1
+            self.metrics['created'] += 1
+        return Lease(conn, self._leaked)
+
+    def release(self, lease):
+        """归还连接，重复归还时忽略"""
+        if not lease.detach():
+            return
+        conn = lease.raw
+        reusable = self._reset(conn)
+        with self._cond:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def _leaked(self, conn):
+        """连接未归还即被回收，关闭连接，释放容量"""
+        logger.warning('数据库连接未归还连接池，已关闭该连接')
+        with self._cond:
+            self.metrics['leaked'] += 1
+            self._in_use -= 1
+            self._discard(conn)
+            self._cond.notify()
+
+    def _reset(self, conn):
+        try:
+            if self.reset:
+                self.reset(conn)
+            return True
+        except Exception as e:
+            logger.warning(f'连接归还时重置失败，关闭该连接，错误信息：{e}')
+            return False
+
+    def _discard(self, conn):
+        self.metrics['discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+
+    def status(self):
+        return dict(self.metrics, in_use=self._in_use, idle=len(self._idle), max_size=self.max_size)
+
+
+def get_pool(key, factory):
+    """
+    获取缓存的连接池，不存在时通过factory创建
+    :param key: 连接池标识，需包含实例连接信息，修改实例信息后使用新的连接池
+    :param factory: 创建连接池的函数
+    :return:
+    """
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = factory()
+                _pools[key] = pool
+    return pool
+
+
+def pool_status():
+    """全部连接池的状态，key中的密码不返回"""
+    return [dict(pool.status(), db_type=key[0], host=key[1], port=key[2], user=key[3])
+            for key, pool in list(_pools.items())]
+
+
+def close_pools():
+    """关闭并清空全部连接池"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -4,7 +4,7 @@ import sqlparse
 
 from sql.models import SqlWorkflow
 from common.config import SysConfig
-from sql.utils.resource_group import user_groups
+from sql.utils.workflow_context import WorkflowContext
 from sql.engines import get_engine
 
 
@@ -60,18 +60,7 @@ def can_execute(user, workflow_id):
     :param workflow_id:
     :return:
     """
-    workflow_detail = SqlWorkflow.objects.get(id=workflow_id)
-    result = False
-    # 只有审核通过和定时执行的数据才可以立即执行
-    if workflow_detail.status in ['workflow_review_pass', 'workflow_timingtask']:
-        # 当前登录用户有资源组粒度执行权限，并且为组内用户
-        group_ids = [group.group_id for group in user_groups(user)]
-        if workflow_detail.group_id in group_ids and user.has_perm('sql.sql_execute_for_resource_group'):
-            result = True
-        # 当前登录用户为提交人，并且有执行权限
-        if workflow_detail.engineer == user.username and user.has_perm('sql.sql_execute'):
-            result = True
-    return result
+    return WorkflowContext(user, workflow_id).is_can_execute
 
 
 def on_correct_time_period(workflow_id, run_date=None):
@@ -100,18 +89,7 @@ def can_timingtask(user, workflow_id):
     :param workflow_id:
     :return:
     """
-    workflow_detail = SqlWorkflow.objects.get(id=workflow_id)
-    result = False
-    # 只有审核通过和定时执行的数据才可以执行
-    if workflow_detail.status in ['workflow_review_pass', 'workflow_timingtask']:
-        # 当前登录用户有资源组粒度执行权限，并且为组内用户
-        group_ids = [group.group_id for group in user_groups(user)]
-        if workflow_detail.group_id in group_ids and user.has_perm('sql.sql_execute_for_resource_group'):
-            result = True
-        # 当前登录用户为提交人，并且有执行权限
-        if workflow_detail.engineer == user.username and user.has_perm('sql.sql_execute'):
-            result = True
-    return result
+    return WorkflowContext(user, workflow_id).is_can_timingtask
 
 
 def can_cancel(user, workflow_id):
@@ -123,14 +101,4 @@ def can_cancel(user, workflow_id):
     :param workflow_id:
     :return:
     """
-    workflow_detail = SqlWorkflow.objects.get(id=workflow_id)
-    result = False
-    # 审核中的工单，审核人和提交人可终止
-    if workflow_detail.status == 'workflow_manreviewing':
-        from sql.utils.workflow_audit import Audit
-        if Audit.can_review(user, workflow_id, 2) or user.username == workflow_detail.engineer:
-            result = True
-    # 审核通过但未执行的工单，执行人可以打回
-    if workflow_detail.status in ['workflow_review_pass', 'workflow_timingtask']:
-        result = True if can_execute(user, workflow_id) else False
-    return result
+    return WorkflowContext(user, workflow_id).is_can_cancel
@@ -30,6 +30,41 @@ def add_sync_ding_user_schedule():
              name='同步钉钉用户ID', schedule_type='D', repeats=-1, timeout=-1)
 
 
+def add_dashboard_rollup_schedule():
+    """添加报表汇总定时任务，每10分钟增量刷新一次"""
+    del_schedule(name='报表数据汇总')
+    schedule('common.utils.chart_rollup.refresh_rollup',
+             name='报表数据汇总', schedule_type='I', minutes=10, repeats=-1, timeout=-1)
+
+
+def add_query_log_flush_schedule():
+    """添加查询日志批量写入定时任务，每分钟执行一次"""
+    del_schedule(name='查询日志批量写入')
+    schedule('sql.utils.query_log.flush_query_log',
+             name='查询日志批量写入', schedule_type='I', minutes=1, repeats=-1, timeout=-1)
+
+
+def add_archive_schedule():
+    """添加历史数据归档定时任务，每天执行一次"""
+    del_schedule(name='历史数据归档')
+    schedule('sql.utils.archive.archive',
+             name='历史数据归档', schedule_type='D', repeats=-1, timeout=-1)
+
+
+def add_slow_query_collect_schedule():
+    """添加慢日志采集定时任务，每5分钟采集一次"""
+    del_schedule(name='慢日志采集')
+    schedule('sql.utils.slow_query_collector.collect',
+             name='慢日志采集', schedule_type='I', minutes=5, repeats=-1, timeout=-1)
+
+
+def add_diagnostic_sample_schedule():
+    """添加问题诊断采样定时任务，每分钟采样一次"""
+    del_schedule(name='问题诊断采样')
+    schedule('sql.utils.diagnostic_sampler.collect',
+             name='问题诊断采样', schedule_type='I', minutes=1, repeats=-1, timeout=-1)
+
+
 def del_schedule(name):
     """删除task"""
     try:
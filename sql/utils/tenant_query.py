@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+"""
+多租户查询，同一语句在多个库并行执行，结果按库名合并或跨库聚合
+并行数、读取的总行数、总耗时均有上限，超出后取消未完成的库正在执行的查询
+"""
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+from sql.engines.models import ResultSet, ColumnarRows
+from sql.utils.async_tasks import TENANT_WORKERS
+
+logger = logging.getLogger('default')
+
+# 默认读取的总行数上限
+TENANT_QUERY_MAX_ROWS = 10000
+
+# 跨库聚合函数，count在各库结果上求和
+AGGREGATES = {
+    'sum': lambda a, b: a + b,
+    'count': lambda a, b: a + b,
+    'min': min,
+    'max': max,
+}
+
+
+def _query(tenant_engine, db_name, sql, limit_num):
+    """使用独立的引擎实例查询单个库，pgsql的库名可为库名.schema名，完成后归还连接"""
+    try:
+        if tenant_engine.instance.db_type == 'pgsql':
+            db_name, _, schema_name = db_name.partition('.')
+            return tenant_engine.query(db_name, sql, limit_num, schema_name=schema_name or None)
+        return tenant_engine.query(db_name, sql, limit_num)
+    finally:
+        tenant_engine.close()
+
+
+def _cancel(tenant_engine, db_name):
+    """取消库正在执行的查询，释放查询占用的连接"""
+    try:
+        tenant_engine.cancel()
+    except Exception as e:
+        logger.warning(f'多租户查询取消失败，库：{db_name}，错误信息：{e}')
+
+
+class Aggregator(object):
+    """逐库合并聚合结果，未指定聚合函数的列作为分组列"""
+
+    def __init__(self, aggregate):
+        """
+        :param aggregate: {列名: sum|count|min|max}
+        """
+        unknown = set(aggregate.values()) - set(AGGREGATES)
+        if unknown:
+            raise ValueError(f'不支持的聚合函数：{",".join(unknown)}')
+        self.aggregate = aggregate
+        self.column_list = None
+        self.groups = {}
+
+    def add(self, result):
+        if self.column_list is None:
+            missing = set(self.aggregate) - set(result.column_list)
+            if missing:
+                raise ValueError(f'聚合列不存在：{",".join(missing)}')
+            self.column_list = list(result.column_list)
+        functions = [AGGREGATES.get(self.aggregate.get(column)) for column in self.column_list]
+        keys = [i for i, function in enumerate(functions) if function is None]
+        for row in result.rows:
+            key = tuple(row[i] for i in keys)
+            merged = self.groups.get(key)
+            if merged is None:
+                self.groups[key] = list(row)
+                continue
+            for i, function in enumerate(functions):
+                # 空值不参与聚合
+                if function is None or row[i] is None:
+                    continue
+                merged[i] = row[i] if merged[i] is None else function(merged[i], row[i])
+
+    @property
+    def rows(self):
+        return [tuple(row) for row in self.groups.values()]
+
+
+def query_tenants(engine, tenants, sql, max_rows=0, timeout=0, aggregate=None, on_result=None,
+                  max_workers=TENANT_WORKERS):
+    """
+    多个库并行执行查询并合并结果
+    :param engine: 实例的查询引擎
+    :param tenants: {db_name: limit_num}，各库权限校验后的limit
+    :param sql: 已改写的查询语句
+    :param max_rows: 读取的总行数上限，0为不限制
+    :param timeout: 总耗时上限，单位秒，0为不限制
+    :param aggregate: {列名: 聚合函数}，为空时按库名合并明细，首列为db_name
+    :param on_result: 在当前线程处理单个库的结果，如脱敏，参数为(db_name, ResultSet)，返回ResultSet
+    :return: ResultSet，tenants属性记录各库的状态
+    """
+    result = ResultSet(full_sql=sql)
+    result.tenants = {db_name: {'status': 'waiting', 'affected_rows': 0, 'msg': ''} for db_name in tenants}
+    aggregator = Aggregator(aggregate) if aggregate else None
+    details = {}
+    column_list = None
+    fetched = 0
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(min(max_workers, len(tenants)), 1))
+    tenant_engines = {db_name: engine.__class__(instance=engine.instance) for db_name in tenants}
+    futures = {executor.submit(_query, tenant_engines[db_name], db_name, sql, limit_num): db_name
+               for db_name, limit_num in tenants.items()}
+    try:
+        for future in as_completed(futures, timeout=timeout or None):
+            db_name = futures[future]
+            tenant = result.tenants[db_name]
+            try:
+                tenant_result = future.result()
+                if on_result and not tenant_result.error:
+                    tenant_result = on_result(db_name, tenant_result)
+                if tenant_result.error:
+                    raise Exception(tenant_result.error)
+                if column_list is None:
+                    column_list = list(tenant_result.column_list)
+                elif list(tenant_result.column_list) != column_list:
+                    raise Exception('返回列与其他库不一致')
+                rows = list(tenant_result.rows)
+                if max_rows:
+                    rows = rows[:max_rows - fetched]
+                if aggregator:
+                    aggregator.add(ResultSet(rows=rows, column_list=tenant_result.column_list))
+                    result.column_list = aggregator.column_list
+                else:
+                    details[db_name] = rows
+                    result.column_list = ['db_name', *column_list]
+                fetched += len(rows)
+                tenant.update(status='truncated' if len(rows) < len(tenant_result.rows) else 'success',
+                              affected_rows=len(rows))
+                for attr in ('is_masked', 'mask_rule_hit'):
+                    setattr(result, attr, getattr(result, attr) or getattr(tenant_result, attr))
+            except Exception as e:
+                logger.warning(f'多租户查询报错，库：{db_name}，语句：{sql}，错误信息：{traceback.format_exc()}')
+                tenant.update(status='failed', msg=str(e))
+            # 达到行数上限，未完成的库不再执行
+            if max_rows and fetched >= max_rows:
+                break
+    except TimeoutError:
+        logger.warning(f'多租户查询超时，语句：{sql}，超时时间：{timeout}')
+    finally:
+        # 超时或达到行数上限时未处理的库，未开始的不再执行，已开始的取消查询，不等待其结束
+        for future, db_name in futures.items():
+            if not future.cancel() and not future.done():
+                _cancel(tenant_engines[db_name], db_name)
+            if result.tenants[db_name]['status'] == 'waiting':
+                result.tenants[db_name]['status'] = 'skipped' if max_rows and fetched >= max_rows else 'timeout'
+        executor.shutdown(wait=False)
+
+    # 明细按传入的库顺序按列存储
+    if aggregator:
+        result.rows = aggregator.rows
+    elif column_list is not None:
+        result.rows = ColumnarRows(len(result.column_list), ((db_name, *row) for db_name in tenants
+                                                             for row in details.get(db_name, [])))
+    result.affected_rows = len(result.rows)
+    result.query_time = round(time.perf_counter() - start, 4)
+    unfinished = [db_name for db_name, tenant in result.tenants.items() if tenant['status'] != 'success']
+    if unfinished:
+        result.warning = f'部分库结果不完整：{",".join(unfinished)}'
+    if all(tenant['status'] in ('failed', 'timeout') for tenant in result.tenants.values()):
+        result.error = f'全部库查询失败：{result.warning}'
+    return result
@@ -6,28 +6,47 @@
 @time: 2019/03/14
 """
 import datetime
+import gc
 import json
-from unittest.mock import patch, MagicMock
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, PropertyMock
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission, Group
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase, Client
 from django_q.models import Schedule
 
 from common.config import SysConfig
 from common.utils.const import WorkflowDict
-from sql.engines.models import ReviewResult, ReviewSet
+from sql.engines.models import ReviewResult, ReviewSet, ResultSet
 from sql.models import SqlWorkflow, SqlWorkflowContent, Instance, ResourceGroup, ResourceGroup2User, \
     ResourceGroup2Instance, WorkflowLog, WorkflowAudit, WorkflowAuditDetail, WorkflowAuditSetting, \
-    QueryPrivilegesApply, DataMaskingRules, DataMaskingColumns, InstanceTag, InstanceTagRelations
-from sql.utils.resource_group import user_groups, user_instances, auth_group_users
+    QueryPrivilegesApply, DataMaskingRules, DataMaskingColumns, InstanceTag, InstanceTagRelations, QueryLog, \
+    QueryLogArchive, SqlWorkflowContentArchive
+from sql.utils.resource_group import user_groups, user_instances, auth_group_users, user_access_map
 from sql.utils.sql_review import is_auto_review, can_execute, can_timingtask, can_cancel, on_correct_time_period
 from sql.utils.sql_utils import *
 from sql.utils.execute_sql import execute, execute_callback
 from sql.utils.tasks import add_sql_schedule, del_schedule, task_info
 from sql.utils.workflow_audit import Audit
+from sql.utils.workflow_context import WorkflowContext
 from sql.utils.data_masking import data_masking, brute_mask
+from sql.utils.query_log import save_query_log, flush_query_log
+from sql.utils.archive import archive, workflow_content, archive_slow_query_history, table_columns
+from sql.utils.binlog_parser import BinlogParser
+from sql.utils.schema_diff import load_schemas, diff_database, schema_diff
+from sql.utils.slow_query_collector import sample_instance, collect, SNAPSHOT_KEY
+from sql.utils import diagnostic_sampler
+from sql.utils.tenant_query import query_tenants
+from sql.utils.batch_execute import BatchExecutor, parse_insert
+from sql.utils.sql_conn import ConnectionPool, get_pool, pool_status, close_pools
 
 User = get_user_model()
 __author__ = 'hhyo'
@@ -351,7 +370,7 @@ class TestSQLReview(TestCase):
         r = can_timingtask(user=self.user, workflow_id=self.wfc1.workflow_id)
         self.assertFalse(r)
 
-    @patch('sql.utils.workflow_audit.Audit.can_review')
+    @patch('sql.utils.workflow_context.WorkflowContext.is_can_review', new_callable=PropertyMock)
     def test_can_cancel_true_for_apply_user(self, _can_review):
         """
         测试是否能取消，审核中的工单，提交人可终止
@@ -365,7 +384,7 @@ class TestSQLReview(TestCase):
         r = can_cancel(user=self.user, workflow_id=self.wfc1.workflow_id)
         self.assertTrue(r)
 
-    @patch('sql.utils.workflow_audit.Audit.can_review')
+    @patch('sql.utils.workflow_context.WorkflowContext.is_can_review', new_callable=PropertyMock)
     def test_can_cancel_true_for_audit_user(self, _can_review):
         """
         测试是否能取消，审核中的工单，审核人可终止
@@ -623,6 +642,829 @@ class TestTasks(TestCase):
             Schedule.objects.get(name='some_name1')
 
 
+class TestQueryLogWriter(TestCase):
+    """查询日志异步写入"""
+
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.redis_conn = MagicMock()
+        self.buffer = []
+        self.processing = []
+        self.redis_conn.lpush.side_effect = lambda key, item: self.buffer.insert(0, item) or len(self.buffer)
+        self.redis_conn.lrange.side_effect = lambda key, start, end: list(self.processing)
+        self.redis_conn.delete.side_effect = lambda key: self.processing.clear()
+        self.redis_conn.pipeline.return_value.execute.side_effect = self._rpoplpush
+
+    def tearDown(self):
+        self.sys_config.purge()
+        QueryLog.objects.all().delete()
+        Schedule.objects.all().delete()
+
+    def _rpoplpush(self):
+        items = []
+        for _ in range(self.redis_conn.pipeline.return_value.rpoplpush.call_count):
+            item = self.buffer.pop() if self.buffer else None
+            if item is not None:
+                self.processing.insert(0, item)
+            items.append(item)
+        self.redis_conn.pipeline.return_value.rpoplpush.reset_mock()
+        return items
+
+    @staticmethod
+    def _query_log(**kwargs):
+        return QueryLog(instance_name='some_ins', db_name='some_db', sqllog='select 1', effect_row=1,
+                        username='some_user', **kwargs)
+
+    def test_save_query_log_sync(self):
+        """未开启异步写入时同步保存"""
+        save_query_log(self._query_log())
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log.get_redis_connection')
+    def test_save_query_log_fallback(self, _conn):
+        """队列不可用时同步保存"""
+        self.sys_config.set('query_log_async', 'true')
+        _conn.side_effect = Exception('redis down')
+        save_query_log(self._query_log())
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log.get_redis_connection')
+    def test_save_and_flush_query_log(self, _conn):
+        """写入队列后批量入库，保留查询时间"""
+        self.sys_config.set('query_log_async', 'true')
+        _conn.return_value = self.redis_conn
+        create_time = datetime.datetime(2020, 1, 1, 10, 0, 0)
+        for _ in range(3):
+            save_query_log(self._query_log(create_time=create_time))
+        self.assertEqual(QueryLog.objects.count(), 0)
+        # 查询时不添加定时任务
+        self.assertFalse(Schedule.objects.filter(name='查询日志批量写入').exists())
+        self.assertEqual(flush_query_log(batch_size=2), 3)
+        self.assertEqual(QueryLog.objects.filter(create_time=create_time).count(), 3)
+        self.assertEqual(self.processing, [])
+
+    @patch('sql.utils.query_log.get_redis_connection')
+    def test_flush_query_log_pending(self, _conn):
+        """上次入库失败遗留的数据重新写入"""
+        _conn.return_value = self.redis_conn
+        self.processing.append(json.dumps({'instance_name': 'some_ins', 'db_name': 'some_db', 'sqllog': 'select 1',
+                                           'effect_row': 1, 'username': 'some_user',
+                                           'create_time': '2020-01-01 10:00:00.000000'}))
+        self.assertEqual(flush_query_log(), 1)
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log.get_redis_connection')
+    def test_flush_query_log_locked(self, _conn):
+        """已有入库任务执行时跳过"""
+        _conn.return_value = self.redis_conn
+        self.redis_conn.lock.return_value.acquire.return_value = False
+        self.assertEqual(flush_query_log(), 0)
+
+
+class TestArchive(TestCase):
+    """历史数据归档"""
+
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.superuser = User.objects.create(username='super', is_superuser=True)
+        self.ins = Instance.objects.create(instance_name='archive_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        old = datetime.datetime.now() - datetime.timedelta(days=40)
+        for i in range(5):
+            QueryLog.objects.create(instance_name='some_ins', db_name='some_db', sqllog=f'select {i}', effect_row=1,
+                                    username='some_user', favorite=i == 0,
+                                    create_time=old if i < 3 else datetime.datetime.now())
+        self.wf = SqlWorkflow.objects.create(workflow_name='some_name', group_id=1, group_name='g1',
+                                             engineer='some_user', audit_auth_groups='some_group',
+                                             status='workflow_finish', is_backup=True, instance=self.ins,
+                                             db_names='some_db', syntax_type=1)
+        SqlWorkflow.objects.filter(pk=self.wf.pk).update(create_time=old)
+        SqlWorkflowContent.objects.create(workflow=self.wf, sql_content='some_sql',
+                                          review_content='some_review', execute_result='some_result')
+
+    def tearDown(self):
+        self.sys_config.purge()
+        QueryLog.objects.all().delete()
+        QueryLogArchive.objects.all().delete()
+        SqlWorkflowContentArchive.objects.all().delete()
+        SqlWorkflow.objects.all().delete()
+        self.ins.delete()
+        self.superuser.delete()
+
+    def test_archive_not_configured(self):
+        """未配置保留天数时不归档"""
+        self.assertEqual(archive(), {})
+        self.assertEqual(QueryLog.objects.count(), 5)
+
+    def test_archive(self):
+        """超过保留天数的数据迁移到归档表，收藏的语句和工单本身保留"""
+        self.sys_config.set('archive_query_log_days', '30')
+        self.sys_config.set('archive_workflow_days', '30')
+        result = archive()
+        self.assertEqual(result, {'archive_query_log': 2, 'archive_workflow_content': 1})
+        self.assertEqual(QueryLog.objects.count(), 3)
+        self.assertEqual(QueryLogArchive.objects.count(), 2)
+        self.assertFalse(SqlWorkflowContent.objects.filter(workflow=self.wf).exists())
+        wf = SqlWorkflow.objects.get(pk=self.wf.pk)
+        self.assertEqual(workflow_content(wf).sql_content, 'some_sql')
+        self.assertEqual(wf.sqlworkflowcontent.execute_result, 'some_result')
+
+    def test_query_log_include_archived(self):
+        """查询历史包含归档数据，收藏归档的语句时恢复"""
+        self.sys_config.set('archive_query_log_days', '30')
+        archive()
+        c = Client()
+        c.force_login(self.superuser)
+        data = {"limit": 14, "offset": 0}
+        self.assertEqual(c.get('/query/querylog/', data=data).json()['total'], 3)
+        data['include_archived'] = 'true'
+        r = c.get('/query/querylog/', data=data).json()
+        self.assertEqual(r['total'], 5)
+        self.assertEqual([row['id'] for row in r['rows']],
+                         sorted(list(QueryLog.objects.values_list('id', flat=True)) +
+                                list(QueryLogArchive.objects.values_list('id', flat=True)), reverse=True))
+        archived_id = QueryLogArchive.objects.first().id
+        c.post('/query/favorite/', data={'query_log_id': archived_id, 'star': 'true', 'alias': 'some_alias'})
+        self.assertTrue(QueryLog.objects.get(id=archived_id).favorite)
+        self.assertFalse(QueryLogArchive.objects.filter(id=archived_id).exists())
+
+    def test_archive_slow_query_history_all_columns(self):
+        """慢日志明细表包含模型未声明的字段，归档时源表全部字段都写入归档表"""
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE mysql_slow_query_review_history (id integer PRIMARY KEY, checksum char(32), '
+                           'ts_min datetime, Query_time_sum float, Bytes_sum float, Bytes_min float, '
+                           'Bytes_pct_95 float, Bytes_stddev float, Bytes_median float)')
+            cursor.execute('CREATE TABLE mysql_slow_query_review_history_archive AS '
+                           'SELECT * FROM mysql_slow_query_review_history WHERE 0')
+            cursor.execute('INSERT INTO mysql_slow_query_review_history VALUES '
+                           "(1, 'c1', %s, 1.5, 100, 10, 90, 5, 50), (2, 'c2', %s, 2.5, 200, 20, 180, 6, 60)",
+                           [datetime.datetime.now() - datetime.timedelta(days=40), datetime.datetime.now()])
+        self.assertEqual(archive_slow_query_history(30), 1)
+        columns = table_columns('mysql_slow_query_review_history')
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {",".join(columns)} FROM mysql_slow_query_review_history_archive')
+            archived = cursor.fetchall()
+            cursor.execute('SELECT id FROM mysql_slow_query_review_history')
+            remained = cursor.fetchall()
+        self.assertEqual(len(archived), 1)
+        self.assertEqual(dict(zip(columns, archived[0]))['checksum'], 'c1')
+        self.assertEqual(archived[0][3:], (1.5, 100, 10, 90, 5, 50))
+        self.assertEqual(remained, [(2,)])
+
+    def test_archive_table_missing_column(self):
+        """归档表缺少源表字段时不归档，源表数据保留"""
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE mysql_slow_query_review_history (id integer PRIMARY KEY, ts_min datetime, '
+                           'Bytes_sum float)')
+            cursor.execute('CREATE TABLE mysql_slow_query_review_history_archive (id integer, ts_min datetime)')
+            cursor.execute('INSERT INTO mysql_slow_query_review_history VALUES (1, %s, 100)',
+                           [datetime.datetime.now() - datetime.timedelta(days=40)])
+        with self.assertRaisesMessage(Exception, 'Bytes_sum'):
+            archive_slow_query_history(30)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM mysql_slow_query_review_history')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class TestBinlogParser(TestCase):
+    """binlog解析，使用录制的binlog事件回放"""
+
+    def setUp(self):
+        from pymysqlreplication.event import QueryEvent, RotateEvent
+        from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, TableMapEvent
+        self.event_types = {'query': QueryEvent, 'rotate': RotateEvent, 'table_map': TableMapEvent,
+                            'write': WriteRowsEvent, 'update': UpdateRowsEvent, 'delete': DeleteRowsEvent}
+        with open(os.path.join(settings.BASE_DIR, 'sql/fixtures/binlog_events.json')) as f:
+            self.recorded = json.load(f)
+        self.ins = Instance(instance_name='binlog_ins', host='some_host', port=3306, user='ins_user',
+                            password='some_str')
+        patcher = patch('sql.utils.binlog_parser.BinLogStreamReader', side_effect=self._stream)
+        self.stream_reader = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _event(self, item):
+        cls = self.event_types[item['type']]
+        event = cls.__new__(cls)
+        event.packet = SimpleNamespace(log_pos=item.get('log_pos', 0))
+        event.event_size = item.get('event_size', 0)
+        event.timestamp = item.get('timestamp', 0)
+        for key in ('schema', 'table', 'primary_key', 'query', 'next_binlog', 'position'):
+            if key in item:
+                setattr(event, key, item[key])
+        if 'rows' in item:
+            event._RowsEvent__rows = item['rows']
+        return event
+
+    def _stream(self, log_file, log_pos, only_events, only_tables=None, **kwargs):
+        """按起始位置和事件类型、表过滤回放录制的事件"""
+        yield self._event({'type': 'rotate', 'next_binlog': log_file, 'position': log_pos})
+        current_file, start_pos = log_file, 4
+        for item in self.recorded:
+            if item['log_file'] < log_file:
+                continue
+            if item['log_file'] != current_file:
+                current_file, start_pos = item['log_file'], 4
+                yield self._event({'type': 'rotate', 'next_binlog': current_file, 'position': 4})
+            item_pos, start_pos = start_pos, item['log_pos']
+            if current_file == log_file and item_pos < log_pos:
+                continue
+            event = self._event(item)
+            if type(event) not in only_events:
+                continue
+            if only_tables and 'rows' in item and item['table'] not in only_tables:
+                continue
+            yield event
+
+    def test_parse(self):
+        rows, cursor = BinlogParser(self.ins, 'mysql-bin.000001').parse(10)
+        self.assertIsNone(cursor)
+        self.assertEqual([row['sql'] for row in rows], [
+            "INSERT INTO `test_db`.`t1`(`id`, `name`, `memo`) VALUES (1, 'a', NULL);",
+            "INSERT INTO `test_db`.`t1`(`id`, `name`, `memo`) VALUES (2, 'b\\'c', 'x');",
+            "UPDATE `test_db`.`t1` SET `id`=1, `name`='aa', `memo`=NULL WHERE `id`=1 AND `name`='a' AND `memo` IS NULL LIMIT 1;",
+            "DELETE FROM `test_db`.`t1` WHERE `id`=2 AND `name`='b\\'c' AND `memo`='x' LIMIT 1;"])
+        self.assertTrue(rows[0]['binlog_info'].startswith('start 360 end 420 time '))
+        self.assertTrue(rows[3]['binlog_info'].startswith('start 200 end 260 time '))
+
+    def test_parse_cursor(self):
+        """按游标分页与一次解析的结果一致"""
+        parser = BinlogParser(self.ins, 'mysql-bin.000001')
+        expected, _ = parser.parse(10)
+        rows, cursors, cursor = [], [], None
+        while True:
+            page, cursor = parser.parse(1, cursor=cursor)
+            rows += page
+            if not cursor:
+                break
+            cursors.append(cursor)
+        self.assertEqual(rows, expected)
+        self.assertEqual(cursors, ['mysql-bin.000001:300:1', 'mysql-bin.000001:300:2', 'mysql-bin.000001:420:1'])
+
+    def test_parse_filter(self):
+        parser = BinlogParser(self.ins, 'mysql-bin.000001', only_dml=False, sql_type=['UPDATE'])
+        rows, _ = parser.parse(10)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['sql'], 'USE `test_db`;\nalter table t1 add column c int;')
+        self.assertNotIn('UPDATE', str(self.stream_reader.call_args[1]['only_events']).upper().replace(
+            'UPDATEROWSEVENT', ''))
+        rows, _ = BinlogParser(self.ins, 'mysql-bin.000001', only_tables=['t2']).parse(10)
+        self.assertEqual(rows, [])
+        rows, _ = BinlogParser(self.ins, 'mysql-bin.000001', end_file='mysql-bin.000001', end_pos=480).parse(10)
+        self.assertEqual(len(rows), 2)
+
+    def test_parse_no_pk(self):
+        rows, _ = BinlogParser(self.ins, 'mysql-bin.000001', sql_type=['INSERT'], no_pk=True).parse(1)
+        self.assertEqual(rows[0]['sql'], "INSERT INTO `test_db`.`t1`(`name`, `memo`) VALUES ('a', NULL);")
+
+    def test_parse_flashback(self):
+        rows, cursor = BinlogParser(self.ins, 'mysql-bin.000001', flashback=True).parse(10)
+        self.assertIsNone(cursor)
+        self.assertEqual([row['sql'] for row in rows], [
+            "INSERT INTO `test_db`.`t1`(`id`, `name`, `memo`) VALUES (2, 'b\\'c', 'x');",
+            "UPDATE `test_db`.`t1` SET `id`=1, `name`='a', `memo`=NULL WHERE `id`=1 AND `name`='aa' AND `memo` IS NULL LIMIT 1;",
+            "DELETE FROM `test_db`.`t1` WHERE `id`=2 AND `name`='b\\'c' AND `memo`='x' LIMIT 1;",
+            "DELETE FROM `test_db`.`t1` WHERE `id`=1 AND `name`='a' AND `memo` IS NULL LIMIT 1;"])
+
+    @patch('sql.utils.binlog_parser.BinlogParser.binlog_files')
+    def test_parse_to_file(self, _binlog_files):
+        """按文件并行解析，合并后与分页解析的顺序一致"""
+        _binlog_files.return_value = ['mysql-bin.000001', 'mysql-bin.000002']
+        for flashback in (False, True):
+            parser = BinlogParser(self.ins, 'mysql-bin.000001', flashback=flashback)
+            expected, _ = parser.parse(10)
+            with tempfile.TemporaryDirectory() as path:
+                filename = parser.parse_to_file(os.path.join(path, 'binlog.sql'))
+                with open(filename) as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(os.listdir(path), ['binlog.sql'])
+            self.assertEqual(lines, [f"{row['sql']} #{row['binlog_info']}" for row in expected])
+
+
+class TestSchemaDiff(TestCase):
+    """表结构对比"""
+
+    def setUp(self):
+        self.ins = Instance(instance_name='diff_ins', host='some_host', port=3306, user='ins_user',
+                            password='some_str')
+        self.rows = {
+            'TABLES': [('db1', 't1', 'InnoDB', 'utf8mb4_general_ci', 10, 'tb comment'),
+                       ('db2', 't1', 'InnoDB', 'utf8mb4_general_ci', 5, ''),
+                       ('db2', 't2', 'InnoDB', 'utf8mb4_general_ci', None, '')],
+            'COLUMNS': [('db1', 't1', 'id', 'int(11)', 'NO', None, None, None, 'auto_increment', '', ''),
+                        ('db1', 't1', 'name', 'varchar(20)', 'YES', None, 'utf8mb4', 'utf8mb4_general_ci', '', '', ''),
+                        ('db1', 't1', 'ctime', 'datetime', 'NO', 'CURRENT_TIMESTAMP', None, None,
+                         'DEFAULT_GENERATED', 'create time', ''),
+                        ('db2', 't1', 'id', 'int(11)', 'NO', None, None, None, 'auto_increment', '', ''),
+                        ('db2', 't1', 'ctime', 'datetime', 'NO', 'CURRENT_TIMESTAMP', None, None, '', '', ''),
+                        ('db2', 't2', 'id', 'bigint(20)', 'NO', '0', None, None, '', '', '')],
+            'STATISTICS': [('db1', 't1', 'PRIMARY', 0, 'id', None, 'BTREE'),
+                           ('db1', 't1', 'idx_name', 1, 'name', 10, 'BTREE'),
+                           ('db2', 't1', 'PRIMARY', 0, 'id', None, 'BTREE'),
+                           ('db2', 't2', 'PRIMARY', 0, 'id', None, 'BTREE')],
+            'KEY_COLUMN_USAGE': []}
+
+    def _query(self, instance, sql):
+        for table, rows in self.rows.items():
+            if f'information_schema.{table}' in sql:
+                return [row for row in rows if f"'{row[0]}'" in sql]
+
+    def test_load_schemas(self):
+        with patch('sql.utils.schema_diff._query', side_effect=self._query) as _query:
+            model = load_schemas(self.ins, ['db1', 'db2'])
+        # 多个数据库只执行4次查询
+        self.assertEqual(_query.call_count, 4)
+        self.assertEqual(list(model['db2']), ['t1', 't2'])
+        self.assertEqual(list(model['db1']['t1']['columns']), ['id', 'name', 'ctime'])
+        self.assertEqual(model['db1']['t1']['columns']['ctime']['extra'], '')
+        self.assertEqual(model['db1']['t1']['indexes']['idx_name']['columns'], [('name', 10)])
+
+    def test_diff_database(self):
+        with patch('sql.utils.schema_diff._query', side_effect=self._query):
+            model = load_schemas(self.ins, ['db1', 'db2'])
+        diff, patch_sql, revert_sql = diff_database(model['db1'], model['db2'])
+        self.assertEqual(diff, ['修改表 t1', '删除表 t2'])
+        self.assertEqual(patch_sql[0], "ALTER TABLE `t1`\n"
+                                       "  ADD COLUMN `name` varchar(20) CHARACTER SET utf8mb4 COLLATE "
+                                       "utf8mb4_general_ci NULL DEFAULT NULL AFTER `id`,\n"
+                                       "  ADD KEY `idx_name` (`name`(10));")
+        self.assertEqual(patch_sql[1], 'DROP TABLE `t2`;')
+        self.assertEqual(revert_sql[0], "ALTER TABLE `t1`\n  DROP INDEX `idx_name`,\n  DROP COLUMN `name`;")
+        self.assertEqual(revert_sql[1], "CREATE TABLE `t2` (\n  `id` bigint(20) NOT NULL DEFAULT '0',\n"
+                                        "  PRIMARY KEY (`id`)\n) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 "
+                                        "COLLATE=utf8mb4_general_ci;")
+        # 同步注释和自增值
+        diff, patch_sql, _ = diff_database(model['db1'], model['db2'], sync_auto_inc=True, sync_comments=True)
+        self.assertIn("MODIFY COLUMN `ctime` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'create time' "
+                      "AFTER `name`", patch_sql[0])
+        self.assertIn("AUTO_INCREMENT=10,\n  COMMENT='tb comment';", patch_sql[0])
+        # 结构一致
+        self.assertEqual(diff_database(model['db1'], model['db1']), ([], [], []))
+
+    def test_default_expression(self):
+        """表达式和bit类型的默认值不加引号，字符默认值加引号"""
+        self.rows['TABLES'].append(('db1', 't3', 'InnoDB', 'utf8mb4_general_ci', None, ''))
+        self.rows['COLUMNS'] += [
+            ('db1', 't3', 'uid', 'char(36)', 'NO', 'uuid()', 'utf8mb4', 'utf8mb4_general_ci', 'DEFAULT_GENERATED', '',
+             ''),
+            ('db1', 't3', 'flag', 'bit(1)', 'NO', "b'0'", None, None, '', '', ''),
+            ('db1', 't3', 'name', 'varchar(20)', 'NO', "b'0'", 'utf8mb4', 'utf8mb4_general_ci', '', '', '')]
+        with patch('sql.utils.schema_diff._query', side_effect=self._query):
+            model = load_schemas(self.ins, ['db1'])
+        _, patch_sql, _ = diff_database(model['db1'], {})
+        self.assertEqual(patch_sql[1], "CREATE TABLE `t3` (\n"
+                                       "  `uid` char(36) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL "
+                                       "DEFAULT (uuid()),\n"
+                                       "  `flag` bit(1) NOT NULL DEFAULT b'0',\n"
+                                       "  `name` varchar(20) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL "
+                                       "DEFAULT 'b\\'0\\''\n"
+                                       ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;")
+
+    def test_generated_column(self):
+        """生成列使用GENERATED ALWAYS AS定义，不指定默认值"""
+        self.rows['TABLES'].append(('db1', 't3', 'InnoDB', 'utf8mb4_general_ci', None, ''))
+        self.rows['COLUMNS'] += [
+            ('db1', 't3', 'a', 'int(11)', 'YES', None, None, None, '', '', ''),
+            ('db1', 't3', 'g', 'int(11)', 'YES', None, None, None, 'VIRTUAL GENERATED', '', '(`a` + 1)'),
+            ('db1', 't3', 's', 'int(11)', 'NO', None, None, None, 'STORED GENERATED', '', '`a` * 2')]
+        with patch('sql.utils.schema_diff._query', side_effect=self._query):
+            model = load_schemas(self.ins, ['db1'])
+        _, patch_sql, revert_sql = diff_database({}, model['db1'])
+        self.assertEqual(revert_sql[1], "CREATE TABLE `t3` (\n"
+                                        "  `a` int(11) NULL DEFAULT NULL,\n"
+                                        "  `g` int(11) GENERATED ALWAYS AS ((`a` + 1)) VIRTUAL NULL,\n"
+                                        "  `s` int(11) GENERATED ALWAYS AS (`a` * 2) STORED NOT NULL\n"
+                                        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;")
+
+    @patch('sql.utils.schema_diff.get_engine')
+    def test_schema_diff_all(self, _get_engine):
+        """对比全部同名数据库"""
+        _get_engine.return_value.get_all_databases.side_effect = [MagicMock(rows=['db1', 'db2', 'db3']),
+                                                                  MagicMock(rows=['db1', 'db2'])]
+        with patch('sql.utils.schema_diff._query', side_effect=self._query):
+            result = schema_diff(self.ins, '*', self.ins, '*')
+        self.assertEqual(result['diff'], ['目标实例不存在数据库 db3'])
+        self.assertEqual(result['patch'], [])
+
+
+class TestSlowQueryCollector(TestCase):
+    """performance_schema慢日志采集"""
+
+    def setUp(self):
+        self.ins = Instance.objects.create(instance_name='collect_ins', type='master', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        cache.delete(SNAPSHOT_KEY.format(self.ins.id))
+
+    def tearDown(self):
+        cache.delete(SNAPSHOT_KEY.format(self.ins.id))
+        self.ins.delete()
+
+    @staticmethod
+    def _digest(count, timer_wait):
+        """SCHEMA_NAME, DIGEST, DIGEST_TEXT, COUNT_STAR, SUM_TIMER_WAIT, MAX_TIMER_WAIT, SUM_LOCK_TIME ..."""
+        return [('db1', 'd1', 'SELECT * FROM t1 WHERE id = ?', count, timer_wait, 3 * 10 ** 12, 0, count, count * 10,
+                 0, 0, 0, 0, 0, 0),
+                ('db1', 'd2', 'SELECT ?', count * 100, count, count, 0, count * 100, 0, 0, 0, 0, 0, 0, 0)]
+
+    def _engine(self, _get_engine, rows):
+        _get_engine.return_value.query.side_effect = [ResultSet(rows=[(1.0,)]), ResultSet(rows=rows)]
+
+    @patch('sql.utils.slow_query_collector.get_engine')
+    def test_sample_instance(self, _get_engine):
+        t1 = datetime.datetime(2019, 1, 1, 0, 0)
+        t2 = datetime.datetime(2019, 1, 1, 0, 5)
+        # 首次采集只记录快照
+        self._engine(_get_engine, self._digest(10, 20 * 10 ** 12))
+        self.assertEqual(sample_instance(self.ins, now=t1), ([], []))
+        self._engine(_get_engine, self._digest(14, 30 * 10 ** 12))
+        slow_queries, histories = sample_instance(self.ins, now=t2)
+        # 快查询不记录
+        self.assertEqual(len(histories), 1)
+        history = histories[0]
+        self.assertEqual(slow_queries[0].checksum, history.checksum_id)
+        self.assertEqual((history.hostname_max, history.db_max, history.ts_min, history.ts_max),
+                         ('some_host:3306', 'db1', t1, t2))
+        self.assertEqual((history.ts_cnt, history.query_time_sum, history.query_time_max, history.rows_examined_sum),
+                         (4, 10, 3, 40))
+
+    @patch('sql.utils.slow_query_collector.get_engine')
+    def test_sample_instance_reset(self, _get_engine):
+        """计数器重置时使用当前值"""
+        self._engine(_get_engine, self._digest(10, 20 * 10 ** 12))
+        sample_instance(self.ins)
+        self._engine(_get_engine, self._digest(2, 4 * 10 ** 12))
+        _, histories = sample_instance(self.ins)
+        self.assertEqual((histories[0].ts_cnt, histories[0].query_time_sum), (2, 4))
+
+    @patch('sql.utils.slow_query_collector.save_samples')
+    @patch('sql.utils.slow_query_collector.sample_instance')
+    def test_collect(self, _sample_instance, _save_samples):
+        """单个实例采集失败不影响其他实例"""
+        ins2 = Instance.objects.create(instance_name='collect_ins2', type='master', db_type='mysql',
+                                       host='some_host', port=3307, user='ins_user', password='some_str')
+        _sample_instance.side_effect = lambda instance: ([], ['history']) if instance == ins2 else 1 / 0
+        _save_samples.side_effect = lambda slow_queries, histories: len(histories)
+        self.assertEqual(collect(), 1)
+        _save_samples.assert_any_call([], ['history'])
+        ins2.delete()
+
+
+class TestDiagnosticSampler(TestCase):
+    """问题诊断采样"""
+
+    def setUp(self):
+        self.ins = Instance.objects.create(instance_name='sample_ins', type='master', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.redis_conn = diagnostic_sampler.get_redis_connection('default')
+        self.redis_conn.delete(diagnostic_sampler.SAMPLE_KEY.format(self.ins.id))
+
+    def tearDown(self):
+        self.redis_conn.delete(diagnostic_sampler.SAMPLE_KEY.format(self.ins.id))
+        self.ins.delete()
+
+    @staticmethod
+    def _trx(state):
+        return ResultSet(column_list=['trx_id', 'trx_state', 'trx_started'],
+                         rows=[('1', state, datetime.datetime(2019, 1, 1, 0, 0))])
+
+    @patch('sql.utils.diagnostic_sampler.get_engine')
+    def test_sample_instance(self, _get_engine):
+        """无锁等待时不查询锁等待链"""
+        processlist = ResultSet(column_list=['id', 'command'], rows=[(1, 'Query'), (2, 'Sleep')])
+        _get_engine.return_value.query.side_effect = [processlist, self._trx('RUNNING')]
+        sample = diagnostic_sampler.sample_instance(self.ins)
+        self.assertEqual(sample['processlist']['rows'], [(1, 'Query'), (2, 'Sleep')])
+        self.assertEqual(sample['lock_waits']['rows'], [])
+        self.assertEqual(_get_engine.return_value.query.call_count, 2)
+
+    @patch('sql.utils.diagnostic_sampler.get_engine')
+    def test_sample_instance_lock_wait(self, _get_engine):
+        engine = _get_engine.return_value
+        engine.server_version = (8, 0, 18)
+        lock_waits = ResultSet(column_list=['等待事务ID'], rows=[('1',)])
+        engine.query.side_effect = [ResultSet(column_list=['id'], rows=[]), self._trx('LOCK WAIT'), lock_waits]
+        sample = diagnostic_sampler.sample_instance(self.ins)
+        self.assertEqual(sample['lock_waits']['rows'], [('1',)])
+        self.assertEqual(engine.query.call_args[0][1], diagnostic_sampler.LOCK_WAITS_SQL_80)
+
+    def test_save_and_get_sample(self):
+        """按时间获取最近一次采样"""
+        before = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        sample = {'processlist': {'column_list': ['id', 'command'], 'rows': [(1, 'Query'), (2, 'Sleep')]},
+                  'trx': {'column_list': ['trx_id', 'trx_started'],
+                          'rows': [('1', datetime.datetime(2019, 1, 1, 0, 0))]},
+                  'lock_waits': {'column_list': [], 'rows': []}}
+        diagnostic_sampler.save_sample(self.redis_conn, self.ins.id, sample)
+        self.assertIsNone(diagnostic_sampler.get_sample(self.ins.id, before))
+        result = diagnostic_sampler.get_sample(self.ins.id, datetime.datetime.now() + datetime.timedelta(seconds=1))
+        self.assertEqual(result['trx'], [{'trx_id': '1', 'trx_started': '2019-01-01 00:00:00'}])
+        self.assertEqual(diagnostic_sampler.filter_processlist(result['processlist'], 'Not Sleep'),
+                         [{'id': 1, 'command': 'Query'}])
+
+    @patch('sql.utils.diagnostic_sampler.save_sample')
+    @patch('sql.utils.diagnostic_sampler.sample_instance')
+    def test_collect(self, _sample_instance, _save_sample):
+        """单个实例采样失败不影响其他实例"""
+        ins2 = Instance.objects.create(instance_name='sample_ins2', type='master', db_type='mysql',
+                                       host='some_host', port=3307, user='ins_user', password='some_str')
+        _sample_instance.side_effect = lambda instance: {} if instance == ins2 else 1 / 0
+        self.assertEqual(diagnostic_sampler.collect(), 1)
+        self.assertEqual(_save_sample.call_args[0][1:], (ins2.id, {}))
+        ins2.delete()
+
+
+class TestConnectionPool(TestCase):
+    """非MySQL引擎连接池"""
+
+    def tearDown(self):
+        close_pools()
+
+    def test_reuse_and_reset(self):
+        """归还时重置会话，再次获取复用同一连接"""
+        connect = MagicMock()
+        reset = MagicMock()
+        pool = ConnectionPool(connect=connect, reset=reset, max_size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        reset.assert_called_once_with(conn.raw)
+        reused = pool.acquire()
+        self.assertIs(reused.raw, conn.raw)
+        connect.assert_called_once()
+        self.assertDictEqual(pool.status(), {'acquired': 2, 'created': 1, 'reused': 1,
+                                             'in_use': 1, 'idle': 0, 'max_size': 2})
+
+    def test_reset_failed(self):
+        """重置失败的连接关闭，不再复用"""
+        pool = ConnectionPool(connect=MagicMock(), reset=MagicMock(side_effect=Exception('server closed')))
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.raw.close.assert_called_once()
+        self.assertEqual(pool.status()['discarded'], 1)
+        self.assertEqual(pool.status()['idle'], 0)
+
+    @patch('sql.utils.sql_conn.POOL_WAIT_TIMEOUT', 0.01)
+    def test_max_size(self):
+        """达到最大连接数后等待归还，超时报错"""
+        pool = ConnectionPool(connect=MagicMock(), max_size=1)
+        conn = pool.acquire()
+        with self.assertRaises(TimeoutError):
+            pool.acquire()
+        self.assertEqual(pool.status()['waits'], 1)
+        pool.release(conn)
+
+    def test_leaked(self):
+        """未归还即被回收的连接关闭并释放容量，重复归还时忽略"""
+        pool = ConnectionPool(connect=MagicMock(), max_size=1)
+        conn = pool.acquire()
+        raw = conn.raw
+        del conn
+        gc.collect()
+        raw.close.assert_called_once()
+        self.assertEqual(pool.status()['leaked'], 1)
+        self.assertEqual(pool.status()['in_use'], 0)
+        conn = pool.acquire()
+        pool.release(conn)
+        pool.release(conn)
+        self.assertEqual(pool.status()['in_use'], 0)
+        self.assertEqual(pool.status()['idle'], 1)
+
+    def test_get_pool(self):
+        """相同实例复用连接池，状态中不返回密码"""
+        factory = MagicMock(return_value=ConnectionPool(connect=MagicMock()))
+        key = ('pgsql', 'some_host', 5432, 'some_user', 'some_password', 'some_db')
+        self.assertIs(get_pool(key, factory), get_pool(key, factory))
+        factory.assert_called_once()
+        status = pool_status()
+        self.assertEqual(status[0]['host'], 'some_host')
+        self.assertNotIn('some_password', status[0].values())
+
+
+class TestBatchExecutor(TestCase):
+    """工单语句分批提交"""
+
+    def setUp(self):
+        import sqlite3
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('create table t (id int primary key, name varchar(10))')
+        self.coalesce = lambda table, columns, values: f"insert into {table}{columns} values {', '.join(values)}"
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_parse_insert(self):
+        self.assertEqual(parse_insert("insert into t (id, name) values (1, 'a,(b)')"),
+                         (('t', '(id,name)'), "(1, 'a,(b)')"))
+        self.assertIsNone(parse_insert("insert into t values (1, 'a'), (2, 'b')"))
+        self.assertIsNone(parse_insert("insert into t values (1, 'a') on conflict (id) do nothing"))
+        self.assertIsNone(parse_insert("update t set name='a'"))
+
+    def test_execute_coalesce(self):
+        """连续的INSERT合并执行，逐条返回结果"""
+        statements = [f"insert into t(id, name) values ({i}, 'n{i}')" for i in range(5)]
+        statements.append("update t set name='x' where id < 2")
+        self.conn.set_trace_callback(lambda sql: executed.append(sql))
+        executed = []
+        rows, error = BatchExecutor(self.conn, batch_size=100, coalesce=self.coalesce).execute(statements)
+        self.assertIsNone(error)
+        self.assertEqual([row.id for row in rows], [1, 2, 3, 4, 5, 6])
+        self.assertEqual([row.affected_rows for row in rows], [1, 1, 1, 1, 1, 2])
+        self.assertEqual(len([sql for sql in executed if sql.startswith('insert')]), 1)
+        self.assertEqual(self.conn.execute('select count(*) from t').fetchone()[0], 5)
+
+    def test_execute_coalesce_max_values(self):
+        """合并语句中值的总数不超过上限，如Oracle INSERT ALL"""
+        statements = [f"insert into t(id, name) values ({i}, 'n,{i}')" for i in range(5)]
+        self.conn.set_trace_callback(lambda sql: executed.append(sql))
+        executed = []
+        rows, error = BatchExecutor(self.conn, batch_size=100, coalesce=self.coalesce,
+                                    max_coalesce_values=5).execute(statements)
+        self.assertIsNone(error)
+        self.assertEqual([sql.count('(') - 1 for sql in executed if sql.startswith('insert')], [2, 2, 1])
+        self.assertEqual(self.conn.execute('select count(*) from t').fetchone()[0], 5)
+
+    def test_execute_failed(self):
+        """合并语句失败后逐条执行定位失败语句，当前批次回滚，已提交批次保留"""
+        statements = ["insert into t values (1, 'a')", "insert into t values (2, 'b')",
+                      "insert into t values (3, 'c')", "insert into t values (3, 'd')",
+                      "insert into t values (4, 'e')"]
+        rows, error = BatchExecutor(self.conn, batch_size=2, coalesce=self.coalesce).execute(statements)
+        self.assertIn('UNIQUE', error)
+        self.assertEqual([row.stagestatus for row in rows], [
+            'Execute Successfully', 'Execute Successfully', 'Execute Successfully\nRollback Successfully',
+            'Execute Failed', 'Audit completed'])
+        self.assertEqual(rows[3].sql, "insert into t values (3, 'd')")
+        self.assertEqual(self.conn.execute('select id from t').fetchall(), [(1,), (2,)])
+
+
+
+class TenantEngine(object):
+    """按库名返回固定结果的查询引擎，结果为None时阻塞到查询被取消"""
+    results = {}
+    closed = []
+    cancelled = []
+
+    def __init__(self, instance=None):
+        self.instance = instance
+        self.db_name = None
+        self._cancelled = threading.Event()
+
+    def query(self, db_name, sql, limit_num):
+        self.db_name = db_name
+        result = self.results[db_name]
+        if result is None:
+            self._cancelled.wait(5)
+            raise RuntimeError('cancelled')
+        if isinstance(result, Exception):
+            raise result
+        return ResultSet(full_sql=sql, rows=result[:limit_num or None], column_list=['city', 'cnt'])
+
+    def cancel(self):
+        self.cancelled.append(self.db_name)
+        self._cancelled.set()
+
+    def close(self):
+        self.closed.append(self.db_name)
+
+
+class TestTenantQuery(TestCase):
+    def setUp(self):
+        TenantEngine.results = {'db1': [('bj', 1), ('sh', 2)], 'db2': [('bj', 3)], 'db3': RuntimeError('down'),
+                                'db4': None}
+        TenantEngine.closed = []
+        TenantEngine.cancelled = []
+        self.engine = TenantEngine(instance=SimpleNamespace(db_type='mysql'))
+
+    def test_merge(self):
+        """按库顺序合并明细，失败的库单独记录"""
+        result = query_tenants(self.engine, {'db1': 100, 'db2': 100, 'db3': 100}, 'select city, cnt from t')
+        self.assertEqual(result.column_list, ['db_name', 'city', 'cnt'])
+        self.assertEqual(result.rows, [('db1', 'bj', 1), ('db1', 'sh', 2), ('db2', 'bj', 3)])
+        self.assertEqual(result.tenants['db3']['status'], 'failed')
+        self.assertIn('db3', result.warning)
+        self.assertIsNone(result.error)
+
+    def test_aggregate(self):
+        """未指定聚合函数的列作为分组列"""
+        result = query_tenants(self.engine, {'db1': 100, 'db2': 100}, 'select city, cnt from t',
+                               aggregate={'cnt': 'sum'})
+        self.assertEqual(result.column_list, ['city', 'cnt'])
+        self.assertEqual(sorted(result.rows), [('bj', 4), ('sh', 2)])
+        with self.assertRaises(ValueError):
+            query_tenants(self.engine, {'db1': 100}, 'select city, cnt from t', aggregate={'cnt': 'avg'})
+
+    def test_max_rows(self):
+        """达到总行数上限后截断，剩余的库不再读取"""
+        result = query_tenants(self.engine, {'db1': 100, 'db2': 100}, 'select city, cnt from t', max_rows=1,
+                               max_workers=1)
+        self.assertEqual(result.rows, [('db1', 'bj', 1)])
+        self.assertEqual(result.tenants['db1']['status'], 'truncated')
+        self.assertEqual(result.tenants['db2']['status'], 'skipped')
+        self.assertEqual(result.affected_rows, 1)
+
+    def test_all_failed(self):
+        result = query_tenants(self.engine, {'db3': 100}, 'select city, cnt from t')
+        self.assertIn('db3', result.error)
+
+    def test_timeout_cancel(self):
+        """超时后取消正在执行的查询，各库的连接均归还"""
+        result = query_tenants(self.engine, {'db1': 100, 'db4': 100}, 'select city, cnt from t', timeout=1)
+        self.assertEqual(result.tenants['db1']['status'], 'success')
+        self.assertEqual(result.tenants['db4']['status'], 'timeout')
+        self.assertEqual(TenantEngine.cancelled, ['db4'])
+        for _ in range(50):
+            if len(TenantEngine.closed) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(sorted(TenantEngine.closed), ['db1', 'db4'])
+
+
+class TestWorkflowContext(TestCase):
+    """工单详情页上下文"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='context_user', display='中文显示', is_active=True)
+        self.user.user_permissions.add(Permission.objects.get(codename='sql_review'),
+                                       Permission.objects.get(codename='sql_execute_for_resource_group'))
+        self.auth_group = Group.objects.create(name='context_auth_group')
+        self.user.groups.add(self.auth_group)
+        self.res_group = ResourceGroup.objects.create(group_id=101, group_name='context_group')
+        ResourceGroup2User.objects.create(user=self.user, resource_group=self.res_group)
+        self.ins = Instance.objects.create(instance_name='context_ins', type='master', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.wf = SqlWorkflow.objects.create(workflow_name='some_name', group_id=self.res_group.group_id,
+                                             group_name=self.res_group.group_name, engineer='some_user',
+                                             audit_auth_groups=str(self.auth_group.id),
+                                             status='workflow_manreviewing', is_backup=True, instance=self.ins,
+                                             db_names='some_db', syntax_type=1)
+        SqlWorkflowContent.objects.create(workflow=self.wf, sql_content='some_sql', execute_result='')
+        self.audit = WorkflowAudit.objects.create(group_id=self.res_group.group_id,
+                                                  group_name=self.res_group.group_name,
+                                                  workflow_id=self.wf.id,
+                                                  workflow_type=WorkflowDict.workflow_type['sqlreview'],
+                                                  workflow_title='some_name',
+                                                  audit_auth_groups=str(self.auth_group.id),
+                                                  current_audit=str(self.auth_group.id),
+                                                  next_audit='-1',
+                                                  current_status=WorkflowDict.workflow_status['audit_wait'])
+        WorkflowLog.objects.create(audit_id=self.audit.audit_id, operation_type=0, operation_info='some_info')
+
+    def tearDown(self):
+        WorkflowLog.objects.all().delete()
+        self.audit.delete()
+        self.wf.delete()
+        self.ins.delete()
+        self.res_group.delete()
+        self.auth_group.delete()
+        self.user.delete()
+
+    def _assert_same_as_legacy(self, user):
+        context = WorkflowContext(user, self.wf.id)
+        self.assertEqual(context.review_info(), Audit.review_info(self.wf.id, 2))
+        self.assertEqual(context.is_can_review, Audit.can_review(user, self.wf.id, 2))
+        self.assertEqual(context.is_can_execute, can_execute(user, self.wf.id))
+        self.assertEqual(context.is_can_timingtask, can_timingtask(user, self.wf.id))
+        self.assertEqual(context.is_can_cancel, can_cancel(user, self.wf.id))
+
+    def test_same_as_legacy(self):
+        """判断结果与原有方法一致"""
+        self._assert_same_as_legacy(User.objects.get(id=self.user.id))
+        self.assertTrue(WorkflowContext(self.user, self.wf.id).is_can_review)
+        SqlWorkflow.objects.filter(id=self.wf.id).update(status='workflow_review_pass')
+        WorkflowAudit.objects.filter(audit_id=self.audit.audit_id).update(
+            current_status=WorkflowDict.workflow_status['audit_success'], current_audit='-1')
+        self._assert_same_as_legacy(User.objects.get(id=self.user.id))
+        self.assertTrue(WorkflowContext(self.user, self.wf.id).is_can_execute)
+
+    def test_num_queries(self):
+        """详情页所需的全部判断只查询一次工单、审核信息、权限组和用户资源组"""
+        user = User.objects.get(id=self.user.id)
+        # 工单、审核信息、权限组名称、审核人校验、用户权限(2)、审核日志
+        with self.assertNumQueries(7):
+            context = WorkflowContext(user, self.wf.id)
+            self.assertEqual(context.review_info(), ('context_auth_group', 'context_auth_group'))
+            self.assertTrue(context.is_can_review)
+            self.assertFalse(context.is_can_execute)
+            self.assertFalse(context.is_can_timingtask)
+            self.assertTrue(context.is_can_cancel)
+            self.assertEqual(context.last_operation_info, 'some_info')
+        SqlWorkflow.objects.filter(id=self.wf.id).update(status='workflow_review_pass')
+        user = User.objects.get(id=self.user.id)
+        # 工单、用户资源组、用户权限(2)
+        with self.assertNumQueries(4):
+            context = WorkflowContext(user, self.wf.id)
+            self.assertTrue(context.is_can_execute)
+            self.assertTrue(context.is_can_timingtask)
+            self.assertTrue(context.is_can_cancel)
+
+    def test_detail_view(self):
+        """工单详情页使用上下文渲染"""
+        c = Client()
+        c.force_login(self.user)
+        r = c.get(f'/detail/{self.wf.id}/')
+        self.assertContains(r, 'some_info')
+        self.assertTrue(r.context['is_can_review'])
+        self.assertTrue(r.context['is_can_cancel'])
+
+
 class TestAudit(TestCase):
     def setUp(self):
         self.sys_config = SysConfig()
@@ -932,85 +1774,80 @@ class TestAudit(TestCase):
         ws = WorkflowAuditSetting.objects.get(workflow_type=1, group_id=1)
         self.assertEqual(ws.audit_auth_groups, '1,2')
 
-    @patch('sql.utils.workflow_audit.auth_group_users')
-    @patch('sql.utils.workflow_audit.Audit.detail_by_workflow_id')
-    def test_can_review_sql_review(self, _detail_by_workflow_id, _auth_group_users):
+    def _audit_by(self, user, workflow_type, workflow_id):
+        """将用户加入资源组和当前审批权限组"""
+        aug = Group.objects.create(name='auth_group')
+        user.groups.add(aug)
+        res_group = ResourceGroup.objects.create(group_id=1, group_name='some_group')
+        ResourceGroup2User.objects.create(resource_group=res_group, user=user)
+        self.audit.workflow_type = workflow_type
+        self.audit.workflow_id = workflow_id
+        self.audit.current_audit = str(aug.id)
+        self.audit.save()
+
+    def test_can_review_sql_review(self):
         """测试判断用户当前是否是可审核上线工单，非管理员拥有权限"""
         sql_review = Permission.objects.get(codename='sql_review')
         self.user.user_permissions.add(sql_review)
-        aug = Group.objects.create(name='auth_group')
-        _detail_by_workflow_id.return_value.current_audit = aug.id
-        _auth_group_users.return_value.filter.exists = True
-        self.audit.workflow_type = WorkflowDict.workflow_type['sqlreview']
-        self.audit.workflow_id = self.wf.id
-        self.audit.save()
+        self._audit_by(self.user, WorkflowDict.workflow_type['sqlreview'], self.wf.id)
         r = Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
         self.assertEqual(r, True)
 
-    @patch('sql.utils.workflow_audit.auth_group_users')
-    @patch('sql.utils.workflow_audit.Audit.detail_by_workflow_id')
-    def test_can_review_query_review(self, _detail_by_workflow_id, _auth_group_users):
+    def test_can_review_query_review(self):
         """测试判断用户当前是否是可审核查询工单，非管理员拥有权限"""
         query_review = Permission.objects.get(codename='query_review')
         self.user.user_permissions.add(query_review)
-        aug = Group.objects.create(name='auth_group')
-        _detail_by_workflow_id.return_value.current_audit = aug.id
-        _auth_group_users.return_value.filter.exists = True
-        self.audit.workflow_type = WorkflowDict.workflow_type['query']
-        self.audit.workflow_id = self.query_apply_1.apply_id
-        self.audit.save()
+        self._audit_by(self.user, WorkflowDict.workflow_type['query'], self.query_apply_1.apply_id)
         r = Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
         self.assertEqual(r, True)
 
-    @patch('sql.utils.workflow_audit.auth_group_users')
-    @patch('sql.utils.workflow_audit.Audit.detail_by_workflow_id')
-    def test_can_review_sql_review_super(self, _detail_by_workflow_id, _auth_group_users):
+    def test_can_review_query_review_wrong_prem(self):
+        """测试判断用户当前是否是可审核查询工单，仅有上线工单审核权限"""
+        sql_review = Permission.objects.get(codename='sql_review')
+        self.user.user_permissions.add(sql_review)
+        self._audit_by(self.user, WorkflowDict.workflow_type['query'], self.query_apply_1.apply_id)
+        r = Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
+        self.assertEqual(r, False)
+
+    def test_can_review_sql_review_super(self):
         """测试判断用户当前是否是可审核查询工单，用户是管理员"""
         aug = Group.objects.create(name='auth_group')
-        _detail_by_workflow_id.return_value.current_audit = aug.id
-        _auth_group_users.return_value.filter.exists = True
         self.audit.workflow_type = WorkflowDict.workflow_type['sqlreview']
         self.audit.workflow_id = self.wf.id
+        self.audit.current_audit = str(aug.id)
         self.audit.save()
         r = Audit.can_review(self.su, self.audit.workflow_id, self.audit.workflow_type)
         self.assertEqual(r, True)
 
-    @patch('sql.utils.workflow_audit.auth_group_users')
-    @patch('sql.utils.workflow_audit.Audit.detail_by_workflow_id')
-    def test_can_review_wrong_status(self, _detail_by_workflow_id, _auth_group_users):
+    def test_can_review_wrong_status(self):
         """测试判断用户当前是否是可审核，非待审核工单"""
-        aug = Group.objects.create(name='auth_group')
-        _detail_by_workflow_id.return_value.current_audit = aug.id
-        _auth_group_users.return_value.filter.exists = True
-        self.audit.workflow_type = WorkflowDict.workflow_type['sqlreview']
-        self.audit.workflow_id = self.wf.id
+        sql_review = Permission.objects.get(codename='sql_review')
+        self.user.user_permissions.add(sql_review)
+        self._audit_by(self.user, WorkflowDict.workflow_type['sqlreview'], self.wf.id)
         self.audit.current_status = WorkflowDict.workflow_status['audit_success']
         self.audit.save()
         r = Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
         self.assertEqual(r, False)
 
-    @patch('sql.utils.workflow_audit.auth_group_users')
-    @patch('sql.utils.workflow_audit.Audit.detail_by_workflow_id')
-    def test_can_review_no_prem(self, _detail_by_workflow_id, _auth_group_users):
+    def test_can_review_no_prem(self):
         """测试判断用户当前是否是可审核，普通用户无权限"""
-        aug = Group.objects.create(name='auth_group')
-        _detail_by_workflow_id.return_value.current_audit = aug.id
-        _auth_group_users.return_value.filter.exists = True
-        self.audit.workflow_type = WorkflowDict.workflow_type['sqlreview']
-        self.audit.workflow_id = self.wf.id
-        self.audit.save()
+        self._audit_by(self.user, WorkflowDict.workflow_type['sqlreview'], self.wf.id)
         r = Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
         self.assertEqual(r, False)
 
-    @patch('sql.utils.workflow_audit.auth_group_users')
-    @patch('sql.utils.workflow_audit.Audit.detail_by_workflow_id')
-    def test_can_review_no_prem(self, _detail_by_workflow_id, _auth_group_users):
+    def test_can_review_not_in_auth_group(self):
+        """测试判断用户当前是否是可审核，不在当前审批权限组"""
+        sql_review = Permission.objects.get(codename='sql_review')
+        self.user.user_permissions.add(sql_review)
+        self._audit_by(self.su, WorkflowDict.workflow_type['sqlreview'], self.wf.id)
+        r = Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
+        self.assertEqual(r, False)
+
+    def test_can_review_auth_group_not_exists(self):
         """测试判断用户当前是否是可审核，权限组不存在"""
-        Group.objects.create(name='auth_group')
-        _detail_by_workflow_id.side_effect = RuntimeError()
-        _auth_group_users.return_value.filter.exists = True
         self.audit.workflow_type = WorkflowDict.workflow_type['sqlreview']
         self.audit.workflow_id = self.wf.id
+        self.audit.current_audit = '0'
         self.audit.save()
         with self.assertRaisesMessage(Exception, '当前审批auth_group_id不存在，请检查并清洗历史数据'):
             Audit.can_review(self.user, self.audit.workflow_id, self.audit.workflow_type)
@@ -1322,6 +2159,27 @@ class TestResourceGroup(TestCase):
         ins = user_instances(self.user)
         self.assertEqual(ins.__len__(), 0)
 
+    def test_user_instances_filter(self):
+        """获取用户实例列表，按类型、数据库类型、标签过滤"""
+        ResourceGroup2User.objects.create(resource_group=self.rgp1, user=self.user)
+        ResourceGroup2Instance.objects.create(resource_group=self.rgp1, instance=self.ins1)
+        ResourceGroup2Instance.objects.create(resource_group=self.rgp1, instance=self.ins2)
+        tag = InstanceTag.objects.create(tag_code='can_read', tag_name='支持查询', active=True)
+        InstanceTagRelations.objects.create(instance=self.ins1, instance_tag=tag, active=True)
+        self.assertEqual(list(user_instances(self.user, tag_codes=['can_read'])), [self.ins1])
+        self.assertEqual(user_instances(self.user, type='slave', db_type=['mysql']).count(), 2)
+        self.assertEqual(user_instances(self.user, db_type=['mssql']).count(), 0)
+
+    def test_user_access_map_cache(self):
+        """实例访问映射缓存命中时不查询数据库，关联关系变更后失效"""
+        ResourceGroup2User.objects.create(resource_group=self.rgp1, user=self.user)
+        ResourceGroup2Instance.objects.create(resource_group=self.rgp1, instance=self.ins1)
+        self.assertEqual(user_access_map(self.user)['all'], [self.ins1.id])
+        with self.assertNumQueries(0):
+            user_access_map(self.user)
+        ResourceGroup2Instance.objects.create(resource_group=self.rgp1, instance=self.ins2)
+        self.assertEqual(sorted(user_access_map(self.user)['all']), sorted([self.ins1.id, self.ins2.id]))
+
     def test_auth_group_users(self):
         """获取资源组内关联指定权限组的用户"""
         # 用户关联权限组
@@ -2,8 +2,9 @@
 from django.contrib.auth.models import Group
 from django.utils import timezone
 
-from sql.utils.resource_group import user_groups, auth_group_users
+from sql.utils.resource_group import user_groups
 from sql.utils.sql_review import is_auto_review
+from sql.utils.workflow_context import WorkflowContext
 from common.utils.const import WorkflowDict
 from sql.models import WorkflowAudit, WorkflowAuditDetail, WorkflowAuditSetting, WorkflowLog, ResourceGroup, \
     SqlWorkflow, QueryPrivilegesApply, Users
@@ -313,45 +314,12 @@ class Audit(object):
     # 判断用户当前是否是可审核
     @staticmethod
     def can_review(user, workflow_id, workflow_type):
-        audit_info = WorkflowAudit.objects.get(workflow_id=workflow_id, workflow_type=workflow_type)
-        group_id = audit_info.group_id
-        result = False
-        # 只有待审核状态数据才可以审核
-        if audit_info.current_status == WorkflowDict.workflow_status['audit_wait']:
-            try:
-                auth_group_id = Audit.detail_by_workflow_id(workflow_id, workflow_type).current_audit
-                audit_auth_group = Group.objects.get(id=auth_group_id).name
-            except Exception:
-                raise Exception('当前审批auth_group_id不存在，请检查并清洗历史数据')
-            if auth_group_users([audit_auth_group], group_id).filter(id=user.id).exists() or user.is_superuser == 1:
-                if workflow_type == 1:
-                    if user.has_perm('sql.query_review'):
-                        result = True
-                elif workflow_type == 2:
-                    if user.has_perm('sql.sql_review'):
-                        result = True
-        return result
+        return WorkflowContext(user, workflow_id, workflow_type=workflow_type).is_can_review
 
     # 获取当前工单审批流程和当前审核组
     @staticmethod
     def review_info(workflow_id, workflow_type):
-        audit_info = WorkflowAudit.objects.get(workflow_id=workflow_id, workflow_type=workflow_type)
-        if audit_info.audit_auth_groups == '':
-            audit_auth_group = '无需审批'
-        else:
-            try:
-                audit_auth_group = '->'.join([Group.objects.get(id=auth_group_id).name for auth_group_id in
-                                              audit_info.audit_auth_groups.split(',')])
-            except Exception:
-                audit_auth_group = audit_info.audit_auth_groups
-        if audit_info.current_audit == '-1':
-            current_audit_auth_group = None
-        else:
-            try:
-                current_audit_auth_group = Group.objects.get(id=audit_info.current_audit).name
-            except Exception:
-                current_audit_auth_group = audit_info.current_audit
-        return audit_auth_group, current_audit_auth_group
+        return WorkflowContext(None, workflow_id, workflow_type=workflow_type).review_info()
 
     # 新增工单日志
     @staticmethod
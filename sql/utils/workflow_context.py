@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+"""
+工单权限判断上下文，工单、审核信息、权限组名称、用户资源组只加载一次，权限判断均基于已加载的数据
+sql.utils.sql_review、sql.utils.workflow_audit.Audit中的同名方法均调用此处实现
+"""
+from django.contrib.auth.models import Group
+from django.utils.functional import cached_property
+
+from common.utils.const import WorkflowDict
+from sql.models import SqlWorkflow, WorkflowAudit, WorkflowLog, Users, ResourceGroup
+
+# 各工单类型对应的审核权限
+REVIEW_PERMISSIONS = {
+    WorkflowDict.workflow_type['query']: 'sql.query_review',
+    WorkflowDict.workflow_type['sqlreview']: 'sql.sql_review',
+}
+
+
+class WorkflowContext(object):
+    """
+    :param user: 当前用户，仅获取审批流程时可为None
+    :param workflow_id: 工单ID
+    :param workflow: 已获取的SQL上线工单，避免重复查询
+    :param workflow_type: 工单类型，执行、终止等判断仅支持SQL上线工单
+    """
+
+    def __init__(self, user, workflow_id, workflow=None, workflow_type=WorkflowDict.workflow_type['sqlreview']):
+        self.user = user
+        self.workflow_id = workflow_id
+        self.workflow_type = workflow_type
+        if workflow is not None:
+            self.__dict__['workflow'] = workflow
+
+    @cached_property
+    def workflow(self):
+        return SqlWorkflow.objects.select_related('instance', 'sqlworkflowcontent').get(pk=self.workflow_id)
+
+    @cached_property
+    def audit(self):
+        """审核信息，自动审核不通过等情况可能不存在"""
+        return WorkflowAudit.objects.filter(workflow_id=self.workflow_id, workflow_type=self.workflow_type).first()
+
+    @cached_property
+    def auth_group_names(self):
+        """审批流程中的权限组ID与名称的映射"""
+        if not self.audit:
+            return {}
+        group_ids = [i for i in self.audit.audit_auth_groups.split(',') if i] + [self.audit.current_audit]
+        group_ids = [int(i) for i in group_ids if i.lstrip('-').isdigit()]
+        return {str(group_id): name for group_id, name in
+                Group.objects.filter(id__in=group_ids).values_list('id', 'name')}
+
+    @cached_property
+    def user_group_ids(self):
+        """用户关联的资源组ID，与user_groups一致，不再重复获取用户信息"""
+        group_list = ResourceGroup.objects.filter(is_deleted=0)
+        if not self.user.is_superuser:
+            group_list = group_list.filter(users=self.user)
+        return list(group_list.values_list('group_id', flat=True))
+
+    def review_info(self):
+        """当前工单审批流程和当前审核组"""
+        audit_info = self.audit
+        if not audit_info:
+            return None, None
+        if audit_info.audit_auth_groups == '':
+            audit_auth_group = '无需审批'
+        else:
+            auth_group_ids = audit_info.audit_auth_groups.split(',')
+            if all(i in self.auth_group_names for i in auth_group_ids):
+                audit_auth_group = '->'.join([self.auth_group_names[i] for i in auth_group_ids])
+            else:
+                audit_auth_group = audit_info.audit_auth_groups
+        if audit_info.current_audit == '-1':
+            current_audit_auth_group = None
+        else:
+            current_audit_auth_group = self.auth_group_names.get(audit_info.current_audit, audit_info.current_audit)
+        return audit_auth_group, current_audit_auth_group
+
+    @cached_property
+    def is_can_review(self):
+        """当前用户是否可审核"""
+        audit_info = self.audit
+        if not audit_info or audit_info.current_status != WorkflowDict.workflow_status['audit_wait']:
+            return False
+        if audit_info.current_audit not in self.auth_group_names:
+            raise Exception('当前审批auth_group_id不存在，请检查并清洗历史数据')
+        # 资源组内关联当前审批权限组的用户
+        in_auth_group = Users.objects.filter(id=self.user.id,
+                                             resourcegroup__group_id=audit_info.group_id,
+                                             groups__id=audit_info.current_audit).exists()
+        permission = REVIEW_PERMISSIONS.get(self.workflow_type)
+        if permission and (in_auth_group or self.user.is_superuser == 1):
+            return self.user.has_perm(permission)
+        return False
+
+    @cached_property
+    def is_can_execute(self):
+        """当前用户是否可执行，定时执行的判断条件与执行一致"""
+        workflow = self.workflow
+        result = False
+        if workflow.status in ['workflow_review_pass', 'workflow_timingtask']:
+            if workflow.group_id in self.user_group_ids and self.user.has_perm('sql.sql_execute_for_resource_group'):
+                result = True
+            if workflow.engineer == self.user.username and self.user.has_perm('sql.sql_execute'):
+                result = True
+        return result
+
+    @property
+    def is_can_timingtask(self):
+        return self.is_can_execute
+
+    @cached_property
+    def is_can_cancel(self):
+        """当前用户是否可终止"""
+        workflow = self.workflow
+        result = False
+        if workflow.status == 'workflow_manreviewing':
+            if self.is_can_review or self.user.username == workflow.engineer:
+                result = True
+        if workflow.status in ['workflow_review_pass', 'workflow_timingtask']:
+            result = self.is_can_execute
+        return result
+
+    @cached_property
+    def last_operation_info(self):
+        """最后一条审核日志"""
+        if not self.audit:
+            return ''
+        last_log = WorkflowLog.objects.filter(audit_id=self.audit.audit_id).order_by('-id').first()
+        return last_log.operation_info if last_log else ''
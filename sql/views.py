@@ -17,10 +17,11 @@ from common.utils.get_logger import get_logger
 from common.utils.permission import superuser_required
 from sql.engines import get_engine
 from sql.engines.models import ReviewSet
+from sql.utils.archive import workflow_content
 from sql.utils.resource_group import user_groups
-from sql.utils.sql_review import can_execute, can_timingtask, can_cancel
 from sql.utils.tasks import task_info
 from sql.utils.workflow_audit import Audit
+from sql.utils.workflow_context import WorkflowContext
 from .models import Users, SqlWorkflow, QueryPrivileges, ResourceGroup, \
     QueryPrivilegesApply, Config, SQL_WORKFLOW_CHOICES, InstanceTag, Instance, QueryLog
 
@@ -96,7 +97,10 @@ def submit_sql(request):
 
 def detail(request, workflow_id):
     """展示SQL工单详细页面"""
-    workflow_detail = get_object_or_404(SqlWorkflow, pk=workflow_id)
+    workflow_detail = get_object_or_404(SqlWorkflow.objects.select_related('instance', 'sqlworkflowcontent'),
+                                        pk=workflow_id)
+    # 已归档的工单从归档表获取内容
+    workflow_content(workflow_detail)
     if workflow_detail.status in ['workflow_finish', 'workflow_exception']:
         rows = workflow_detail.sqlworkflowcontent.execute_result
     else:
@@ -104,26 +108,22 @@ def detail(request, workflow_id):
 
     # 自动审批不通过的不需要获取下列信息
     if workflow_detail.status != 'workflow_autoreviewwrong':
+        # 工单、审核信息和用户资源组只加载一次
+        workflow_context = WorkflowContext(request.user, workflow_id, workflow=workflow_detail)
         # 获取当前审批和审批流程
-        audit_auth_group, current_audit_auth_group = Audit.review_info(workflow_id, 2)
+        audit_auth_group, current_audit_auth_group = workflow_context.review_info()
 
         # 是否可审核
-        is_can_review = Audit.can_review(request.user, workflow_id, 2)
+        is_can_review = workflow_context.is_can_review
         # 是否可执行
-        is_can_execute = can_execute(request.user, workflow_id)
+        is_can_execute = workflow_context.is_can_execute
         # 是否可定时执行
-        is_can_timingtask = can_timingtask(request.user, workflow_id)
+        is_can_timingtask = workflow_context.is_can_timingtask
         # 是否可取消
-        is_can_cancel = can_cancel(request.user, workflow_id)
+        is_can_cancel = workflow_context.is_can_cancel
 
         # 获取审核日志
-        try:
-            audit_id = Audit.detail_by_workflow_id(workflow_id=workflow_id,
-                                                   workflow_type=WorkflowDict.workflow_type['sqlreview']).audit_id
-            last_operation_info = Audit.logs(audit_id=audit_id).latest('id').operation_info
-        except Exception as e:
-            logger.debug(f'无审核日志记录，错误信息{e}')
-            last_operation_info = ''
+        last_operation_info = workflow_context.last_operation_info
     else:
         audit_auth_group = '系统自动驳回'
         current_audit_auth_group = '系统自动驳回'
@@ -180,6 +180,7 @@ def rollback(request):
         context = {'errMsg': 'workflow_id参数为空.'}
         return render(request, 'error.html', context)
     workflow = SqlWorkflow.objects.get(id=int(workflow_id))
+    workflow_content(workflow)
 
     query_engine = get_engine(instance=workflow.instance)
     try:
@@ -0,0 +1,90 @@
+-- 报表按天汇总表，由定时任务增量维护
+CREATE TABLE `stats_workflow_daily` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `stat_date` date NOT NULL COMMENT '统计日期',
+  `group_id` int(11) NOT NULL COMMENT '组ID',
+  `group_name` varchar(100) NOT NULL COMMENT '组名称',
+  `engineer_display` varchar(50) NOT NULL DEFAULT '' COMMENT '发起人中文名',
+  `syntax_type` int(11) NOT NULL DEFAULT 0 COMMENT '工单类型 0、未知，1、DDL，2、DML',
+  `workflow_cnt` int(11) NOT NULL DEFAULT 0 COMMENT '工单数量',
+  PRIMARY KEY (`id`),
+  KEY `idx_stat_date` (`stat_date`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE `stats_query_log_daily` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `stat_date` date NOT NULL COMMENT '统计日期',
+  `user_display` varchar(50) NOT NULL DEFAULT '' COMMENT '操作人中文名',
+  `db_name` varchar(64) NOT NULL COMMENT '数据库名称',
+  `query_cnt` int(11) NOT NULL DEFAULT 0 COMMENT '查询次数',
+  `effect_row_sum` bigint(20) NOT NULL DEFAULT 0 COMMENT '返回行数',
+  PRIMARY KEY (`id`),
+  KEY `idx_stat_date` (`stat_date`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE `stats_slow_query_daily` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `checksum` varchar(32) NOT NULL,
+  `hostname_max` varchar(64) NOT NULL,
+  `db_max` varchar(64) DEFAULT NULL,
+  `stat_date` date NOT NULL COMMENT '统计日期',
+  `ts_max` datetime(6) DEFAULT NULL COMMENT '最后出现时间',
+  `ts_cnt` double NOT NULL DEFAULT 0 COMMENT '执行次数',
+  `query_time_sum` double NOT NULL DEFAULT 0 COMMENT '执行总时长',
+  `query_time_max` double NOT NULL DEFAULT 0 COMMENT '最大执行时长',
+  `query_time_pct_95` double NOT NULL DEFAULT 0 COMMENT '95%执行时长',
+  `lock_time_sum` double NOT NULL DEFAULT 0 COMMENT '锁定总时长',
+  `rows_examined_sum` double NOT NULL DEFAULT 0 COMMENT '扫描总行数',
+  `rows_sent_sum` double NOT NULL DEFAULT 0 COMMENT '返回总行数',
+  PRIMARY KEY (`id`),
+  KEY `idx_checksum_stat_date` (`checksum`, `stat_date`),
+  KEY `idx_hostname_max_stat_date` (`hostname_max`, `stat_date`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- 报表汇总定时任务，每10分钟增量刷新，首次执行时回填全部历史
+INSERT INTO django_q_schedule (name, func, args, kwargs, schedule_type, minutes, repeats, next_run)
+SELECT '报表数据汇总', 'common.utils.chart_rollup.refresh_rollup', '()', '{''timeout'': -1}', 'I', 10, -1, NOW()
+FROM DUAL WHERE NOT EXISTS (SELECT 1 FROM django_q_schedule WHERE name = '报表数据汇总');
+
+-- 查询日志批量写入定时任务，已开启query_log_async时添加，之后由保存配置时添加或删除
+INSERT INTO django_q_schedule (name, func, args, kwargs, schedule_type, minutes, repeats, next_run)
+SELECT '查询日志批量写入', 'sql.utils.query_log.flush_query_log', '()', '{''timeout'': -1}', 'I', 1, -1, NOW()
+FROM DUAL WHERE NOT EXISTS (SELECT 1 FROM django_q_schedule WHERE name = '查询日志批量写入')
+  AND EXISTS (SELECT 1 FROM sql_config WHERE item = 'query_log_async' AND value IN ('true', 'True'));
+
+-- 汇总任务按天范围扫描源表
+alter table sql_workflow add index idx_create_time(create_time);
+alter table query_log add index idx_create_time(create_time);
+
+-- 列表页常用筛选条件的组合索引，列表按主键排序和翻页，筛选条件后接主键
+alter table sql_workflow add index idx_status_id(status, id),
+  add index idx_group_id_id(group_id, id),
+  add index idx_engineer_id(engineer, id);
+alter table workflow_audit add index idx_current_status_current_audit_group_id(current_status, current_audit, group_id);
+alter table query_log add index idx_username_id(username, id);
+
+-- 列表搜索全文索引(MySQL 5.7.6+)，字段顺序需与代码中搜索字段一致，创建后在系统配置中开启FULLTEXT_SEARCH
+alter table query_log add fulltext index ft_sqllog_user_display_alias(sqllog, user_display, alias) with parser ngram;
+alter table sql_workflow add fulltext index ft_workflow_name_engineer_display(workflow_name, engineer_display) with parser ngram;
+alter table workflow_audit add fulltext index ft_workflow_title(workflow_title) with parser ngram;
+-- 慢日志SQL指纹检索
+alter table mysql_slow_query_review add fulltext index ft_fingerprint(fingerprint) with parser ngram;
+
+-- 历史数据归档表，归档任务按主键范围从源表迁移，在系统配置中设置保留天数后生效
+CREATE TABLE `query_log_archive` LIKE `query_log`;
+ALTER TABLE `query_log_archive` MODIFY `id` int(11) NOT NULL, ROW_FORMAT=COMPRESSED;
+CREATE TABLE `sql_workflow_content_archive` (
+  `id` int(11) NOT NULL,
+  `workflow_id` int(11) NOT NULL COMMENT '工单ID',
+  `sql_content` longtext NOT NULL COMMENT '具体sql内容',
+  `review_content` longtext NOT NULL COMMENT '自动审核内容的JSON格式',
+  `execute_result` longtext NOT NULL COMMENT '执行结果的JSON格式',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `workflow_id` (`workflow_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 ROW_FORMAT=COMPRESSED;
+CREATE TABLE `mysql_slow_query_review_history_archive` LIKE `mysql_slow_query_review_history`;
+ALTER TABLE `mysql_slow_query_review_history_archive` MODIFY `id` int(11) NOT NULL, ROW_FORMAT=COMPRESSED;
+
+-- 在线查询各阶段耗时，json格式，单位毫秒
+alter table query_log add column `timings` varchar(1000) NOT NULL DEFAULT '' COMMENT '各阶段耗时(毫秒)' after `alias`;
+alter table query_log_archive add column `timings` varchar(1000) NOT NULL DEFAULT '' COMMENT '各阶段耗时(毫秒)' after `alias`;